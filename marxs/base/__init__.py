@@ -3,3 +3,4 @@ from .base import (GeometryError, VisualizationWarning,
                   MarxsElement, SimulationSequenceElement,
                   _parse_position_keywords
                   )
+from .photonstore import PhotonStore, SharedPhotonStore
@@ -8,6 +8,8 @@ from transforms3d import affines
 from astropy.table import Column
 from astropy.extern.six import with_metaclass
 
+from ..math.utils import affine_inverse
+
 
 class GeometryError(Exception):
     pass
@@ -60,6 +62,14 @@ class MarxsElement(with_metaclass(DocMeta,object)):
     display = {}
     'Dictionary for display specifications, e.g. color'
 
+    _derived_attributes = ('_invpos4d', '_pos4d_decomposed')
+    '''Attributes that only cache values derived from other attributes.
+
+    They are ignored when the configuration of elements is compared, see
+    `marxs.simulator.checkpoint.fingerprint`. Each class lists only its own
+    attributes; the lists of all base classes are combined.
+    '''
+
     def __init__(self, **kwargs):
         '''Define a new MARXS element.'''
         if 'name' in kwargs:
@@ -70,6 +80,42 @@ class MarxsElement(with_metaclass(DocMeta,object)):
         if len(kwargs) > 0:
             raise ValueError('Initialization arguments {0} not understood'.format(', '.join(kwargs.keys())))
 
+    @property
+    def pos4d(self):
+        '''Affine 4*4 matrix that describes the position of the element.
+
+        Not all elements have a position. For those that do, assigning a new
+        matrix to ``pos4d`` resets the cached values of `invpos4d` and
+        `pos4d_decomposed`. (Changing values of ``pos4d`` in place does not.)
+        '''
+        try:
+            return self.__dict__['_pos4d']
+        except KeyError:
+            raise AttributeError("'{0}' object has no attribute 'pos4d'".format(self.__class__.__name__))
+
+    @pos4d.setter
+    def pos4d(self, value):
+        self._pos4d = value
+        self._invpos4d = None
+        self._pos4d_decomposed = None
+
+    @property
+    def invpos4d(self):
+        '''Inverse of ``pos4d`` (cached).'''
+        if getattr(self, '_invpos4d', None) is None:
+            self._invpos4d = affine_inverse(self.pos4d)
+        return self._invpos4d
+
+    @property
+    def pos4d_decomposed(self):
+        '''``pos4d`` decomposed into translation, rotation, zoom and shear (cached).
+
+        See `transforms3d.affines.decompose44` for details.
+        '''
+        if getattr(self, '_pos4d_decomposed', None) is None:
+            self._pos4d_decomposed = affines.decompose44(self.pos4d)
+        return self._pos4d_decomposed
+
     def describe(self):
         return OrderedDict(element=self.name)
 
@@ -0,0 +1,374 @@
+'''A lightweight, columnar container for photon lists.
+
+Marxs uses `astropy.table.Table` to represent photon lists, which is convenient
+for the user (e.g. for reading and writing files or for the analysis of
+results). However, for large photon numbers, the overhead of the
+`~astropy.table.Table` and `~astropy.table.Column` classes for indexing and
+adding columns becomes comparable to the time needed for the ray-trace
+itself. `PhotonStore` implements the subset of the `~astropy.table.Table`
+interface that is used by the optical elements in marxs, but each column is
+just a contiguous `numpy.ndarray`. A typical use is to convert the photon list
+at the start of a simulation, run all optical elements on the `PhotonStore`,
+and convert it back to a `~astropy.table.Table` at the end; `marxs.simulator.Sequence`
+can do this automatically.
+'''
+from collections import OrderedDict
+
+import numpy as np
+from astropy.table import Table, Column
+from astropy.extern import six
+
+try:
+    from multiprocessing import shared_memory
+    HAS_SHARED_MEMORY = True
+except ImportError:
+    HAS_SHARED_MEMORY = False
+
+# Python < 3.8 has no shared memory, so the doctest cannot run.
+__doctest_requires__ = {'SharedPhotonStore': ['multiprocessing.shared_memory']}
+
+
+_column_attributes = ('unit', 'description', 'format', 'meta')
+'''Attributes of `astropy.table.Column` that are kept in a `PhotonStore`.'''
+
+
+def _get_column_attributes(col):
+    '''Return the attributes of an `astropy.table.Column` that are set.'''
+    attrs = {}
+    for a in _column_attributes:
+        value = getattr(col, a, None)
+        if (value is None) or (a == 'meta' and len(value) == 0):
+            continue
+        attrs[a] = OrderedDict(value) if a == 'meta' else value
+    return attrs
+
+
+class PhotonStore(object):
+    '''Photon list stored as a dictionary of contiguous numpy arrays.
+
+    The number of rows is fixed when the `PhotonStore` is created; all columns
+    have exactly that number of rows. Indexing with a string returns the
+    column as a `numpy.ndarray` (not a copy); indexing with anything else
+    (a slice, a boolean mask or an index array) selects rows and returns a new
+    `PhotonStore`, similar to `astropy.table.Table`.
+
+    Column attributes such as ``unit`` and ``description`` of columns that are
+    added as `astropy.table.Column` (e.g. by `from_table`) are kept separately
+    and restored in `to_table`. Assigning new values to an existing column keeps
+    its attributes.
+
+    Parameters
+    ----------
+    columns : dict or ``None``
+        Dictionary of column names and column values.
+    meta : dict or ``None``
+        Meta data (e.g. header keywords).
+    length : int or ``None``
+        Number of rows. This is only required if ``columns`` is empty, otherwise
+        it is set from the length of the columns.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from marxs.base import PhotonStore
+    >>> photons = PhotonStore({'energy': np.ones(5), 'probability': np.ones(5)})
+    >>> photons['probability'][:2] = 0.5
+    >>> photons = photons[photons['probability'] > 0.6]
+    >>> len(photons)
+    3
+    >>> tab = photons.to_table()
+    '''
+    def __init__(self, columns=None, meta=None, length=None):
+        self._columns = OrderedDict()
+        self._attrs = {}
+        self.meta = OrderedDict() if meta is None else OrderedDict(meta)
+        self._length = length
+        if columns is not None:
+            for k, v in columns.items():
+                self._set_column(k, v, copy=False)
+        if self._length is None:
+            self._length = 0
+
+    @classmethod
+    def from_table(cls, table, copy=False):
+        '''Make a `PhotonStore` from an `astropy.table.Table`.
+
+        Parameters
+        ----------
+        table : `astropy.table.Table`
+            Input photon list.
+        copy : bool
+            If ``False`` (the default), the columns of the `PhotonStore` are views
+            of the table columns, i.e. changing values in place will also
+            change the table.
+        '''
+        columns = OrderedDict()
+        for n in table.colnames:
+            columns[n] = np.array(table[n], copy=copy)
+        out = cls(columns, meta=table.meta, length=len(table))
+        out._attrs = dict((n, _get_column_attributes(table[n])) for n in table.colnames)
+        return out
+
+    def to_table(self):
+        '''Convert to an `astropy.table.Table`.
+
+        The columns of the table are not copied.
+        '''
+        return Table([Column(v, name=k, copy=False, **self._attrs.get(k, {}))
+                      for k, v in self._columns.items()],
+                     meta=self.meta, copy=False)
+
+    @property
+    def colnames(self):
+        '''List of column names.'''
+        return list(self._columns.keys())
+
+    def keys(self):
+        return self.colnames
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield OrderedDict((k, v[i]) for k, v in self._columns.items())
+
+    def __getitem__(self, item):
+        if isinstance(item, six.string_types):
+            return self._columns[item]
+        else:
+            columns = OrderedDict((k, v[item]) for k, v in self._columns.items())
+            if np.isscalar(item) or isinstance(item, np.integer):
+                return columns
+            if isinstance(item, slice):
+                length = len(six.moves.range(*item.indices(len(self))))
+            elif len(columns) > 0:
+                length = next(iter(columns.values())).shape[0]
+            else:
+                item = np.asarray(item)
+                length = item.sum() if item.dtype == bool else len(item)
+            out = self.__class__(columns, meta=self.meta, length=length)
+            out._attrs = self._attrs.copy()
+            return out
+
+    def _set_column(self, name, value, copy=True):
+        if isinstance(value, Column):
+            self._attrs[name] = _get_column_attributes(value)
+        value = np.asarray(value)
+        if (self._length is None) and (value.ndim > 0):
+            self._length = value.shape[0]
+        if (value.ndim > 0) and (value.shape[0] == self._length):
+            if copy:
+                col = np.array(value, order='C')
+            else:
+                col = np.ascontiguousarray(value)
+        else:
+            # broadcast a scalar or a single row to all rows
+            col = np.empty((self._length, ) + value.shape, dtype=value.dtype)
+            col[:] = value
+        self._columns[name] = col
+
+    def __setitem__(self, name, value):
+        if (name in self._columns) and (value is self._columns[name]):
+            # in-place operations such as ``photons['x'] *= 2`` end up here
+            return
+        # Like astropy.table.Table, assigning a column copies the data.
+        self._set_column(name, value)
+
+    def add_column(self, col, name=None):
+        '''Add a new column.
+
+        Parameters
+        ----------
+        col : `astropy.table.Column` or `numpy.ndarray`
+            Values for the new column.
+        name : string or ``None``
+            Name of the column. Required unless ``col`` has a ``name`` attribute,
+            e.g. for an `astropy.table.Column`.
+        '''
+        if name is None:
+            name = col.name
+        if name in self._columns:
+            raise ValueError('Duplicate column names')
+        self[name] = col
+
+    def remove_column(self, name):
+        del self._columns[name]
+        self._attrs.pop(name, None)
+
+    def rename_column(self, name, new_name):
+        if new_name in self._columns:
+            raise KeyError('Column {0} already exists'.format(new_name))
+        columns = OrderedDict()
+        for k, v in self._columns.items():
+            columns[new_name if k == name else k] = v
+        self._columns = columns
+        if name in self._attrs:
+            self._attrs[new_name] = self._attrs.pop(name)
+
+    def copy(self):
+        '''Return a deep copy of the photon list.'''
+        out = self.__class__(OrderedDict((k, v.copy()) for k, v in self._columns.items()),
+                             meta=self.meta.copy(), length=len(self))
+        out._attrs = dict((k, dict(v)) for k, v in self._attrs.items())
+        return out
+
+
+class SharedPhotonStore(PhotonStore):
+    '''Photon list with columns in shared memory blocks.
+
+    Each column is held in a `multiprocessing.shared_memory.SharedMemory`
+    block, so that several processes can read and write the same photon list
+    without copying or pickling the data. The process that creates the
+    `SharedPhotonStore` with `from_store` owns the memory; other processes use
+    `handle` and `attach` to get views into the same memory.
+
+    Only values changed *in place* (e.g. ``photons['pos'][mask] = newpos``)
+    end up in the shared memory. Assigning a new column
+    (e.g. ``photons['dir'] = newdir``) replaces the column with an array in
+    the local process as for any `PhotonStore`; see
+    `marxs.simulator.ParallelRunner.run_shared` for a way to copy those values
+    back into the shared memory.
+
+    This requires Python 3.8 or later.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from marxs.base import PhotonStore, SharedPhotonStore
+    >>> photons = PhotonStore({'energy': np.ones(5)})
+    >>> with SharedPhotonStore.from_store(photons) as shared:
+    ...     other = SharedPhotonStore.attach(shared.handle)
+    ...     other['energy'][2] = 3.
+    ...     other.close()
+    ...     print(shared['energy'])
+    [1. 1. 3. 1. 1.]
+    '''
+    def __init__(self, columns=None, meta=None, length=None):
+        self._blocks = OrderedDict()
+        self._owner = False
+        super(SharedPhotonStore, self).__init__(columns, meta=meta, length=length)
+
+    @classmethod
+    def _from_blocks(cls, blocks, meta, length, owner):
+        columns = OrderedDict()
+        for name, (shm, dtype, shape) in blocks.items():
+            columns[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        out = cls(columns, meta=meta, length=length)
+        out._blocks = blocks
+        out._owner = owner
+        return out
+
+    @classmethod
+    def from_store(cls, photons, extra_columns={}):
+        '''Copy a photon list into shared memory.
+
+        Parameters
+        ----------
+        photons : `PhotonStore` or `astropy.table.Table`
+            Input photon list.
+        extra_columns : dict
+            Columns that do not exist in ``photons`` yet, but that will be
+            filled by the processes using the shared memory. Keys are the
+            column names, values are used to initialize the column; they can
+            be a scalar or an array that describes a single row.
+
+        Returns
+        -------
+        shared : `SharedPhotonStore`
+            Photon list in shared memory. Call `close` and `unlink` (or use the
+            object as a context manager) to release the memory.
+        '''
+        if not HAS_SHARED_MEMORY:
+            raise ImportError('Shared memory photon lists require multiprocessing.shared_memory (Python 3.8+).')
+        n = len(photons)
+        values = OrderedDict((name, np.asarray(photons[name])) for name in photons.colnames)
+        for name, value in extra_columns.items():
+            if name in values:
+                raise ValueError('Duplicate column names')
+            value = np.asarray(value)
+            values[name] = np.empty((n, ) + value.shape, dtype=value.dtype)
+            values[name][:] = value
+        blocks = OrderedDict()
+        try:
+            for name, value in values.items():
+                shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+                blocks[name] = (shm, value.dtype, value.shape)
+                np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[:] = value
+        except Exception:
+            for shm, dtype, shape in blocks.values():
+                shm.close()
+                shm.unlink()
+            raise
+        out = cls._from_blocks(blocks, photons.meta, n, owner=True)
+        if isinstance(photons, PhotonStore):
+            out._attrs = photons._attrs.copy()
+        else:
+            out._attrs = dict((name, _get_column_attributes(photons[name]))
+                              for name in photons.colnames)
+        return out
+
+    @property
+    def handle(self):
+        '''Picklable description of the shared memory blocks for `attach`.'''
+        return {'length': len(self), 'meta': self.meta,
+                'columns': OrderedDict((n, (b[0].name, b[1], b[2]))
+                                       for n, b in self._blocks.items())}
+
+    @classmethod
+    def attach(cls, handle):
+        '''Attach to the shared memory created in a different process.
+
+        Parameters
+        ----------
+        handle : dict
+            ``handle`` attribute of the `SharedPhotonStore` that owns the
+            memory.
+        '''
+        if not HAS_SHARED_MEMORY:
+            raise ImportError('Shared memory photon lists require multiprocessing.shared_memory (Python 3.8+).')
+        blocks = OrderedDict((n, (shared_memory.SharedMemory(name=v[0]), v[1], v[2]))
+                             for n, v in handle['columns'].items())
+        return cls._from_blocks(blocks, handle['meta'], handle['length'], owner=False)
+
+    def to_store(self):
+        '''Copy the data from shared memory into a `PhotonStore`.'''
+        out = PhotonStore(OrderedDict((k, v.copy()) for k, v in self._columns.items()),
+                          meta=self.meta.copy(), length=len(self))
+        out._attrs = self._attrs.copy()
+        return out
+
+    def close(self):
+        '''Close the access to the shared memory from this object.
+
+        After calling `close`, the columns are no longer accessible. The
+        columns of this object are released before the memory is closed, but
+        there must be no other references to them (e.g. views such as
+        ``e = photons['energy']`` or ``photons[:10]``) when `close` is called.
+        Otherwise, `multiprocessing.shared_memory.SharedMemory.close` raises
+        a `BufferError`; delete those references first.
+        '''
+        self._columns = OrderedDict()
+        for shm, dtype, shape in self._blocks.values():
+            shm.close()
+
+    def unlink(self):
+        '''Release the shared memory.
+
+        This should be called once by the process that owns the memory,
+        after all processes have called `close`.
+        '''
+        if self._owner:
+            for shm, dtype, shape in self._blocks.values():
+                shm.unlink()
+        self._blocks = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        self.unlink()
@@ -1,3 +1,5 @@
 from .rowland import (RowlandTorus,
                       GratingArrayStructure, LinearCCDArray,
                       find_radius_of_photon_shell)
+from .sweep import (DesignSweep, effective_area_factory,
+                    resolvingpower_factory)
@@ -3,7 +3,6 @@
 from __future__ import division
 
 import numpy as np
-from scipy import optimize
 import transforms3d
 from transforms3d.utils import normalized_vector
 
@@ -100,8 +99,7 @@ class RowlandTorus(MarxsElement):
             raise ValueError('Input coordinates must be defined in Eukledian space.')
 
         if transform:
-            invpos4d = np.linalg.inv(self.pos4d)
-            xyz = h2e(np.einsum('...ij,...j', invpos4d, e2h(xyz, 1)))
+            xyz = h2e(np.einsum('...ij,...j', self.invpos4d, e2h(xyz, 1)), 'pos')
         return ((xyz**2).sum(axis=-1) + self.R**2. - self.r**2.)**2. - 4. * self.R**2. * (xyz[..., [0,2]]**2).sum(axis=-1)
 
     def solve_quartic(self, x=None, y=None, z=None, interval=[0, 1], transform=True):
@@ -113,10 +111,14 @@ class RowlandTorus(MarxsElement):
         common use case. In more general cases, evaluate the :meth:`RowlandTorus.quartic` and
         search for the roots of that function.
 
+        The fixed coordinates can be arrays, in which case the quartic is solved for all
+        points at once by bisection.
+
         Parameters
         ----------
-        x, y, z : float or None
-            Set two of these coordinates to fixed numbers. This method will solve for the
+        x, y, z : float, np.array or None
+            Set two of these coordinates to fixed numbers (or arrays of numbers that
+            can be broadcast against each other). This method will solve for the
             coordinate set to ``None``.
             x, y, z are defined in the global coordinate system.
         interval : np.array
@@ -130,8 +132,9 @@ class RowlandTorus(MarxsElement):
 
         Returns
         -------
-        coo : float
-            Value of the fitted coordinate.
+        coo : float or np.array
+            Value of the fitted coordinate. This is an array of the same shape as
+            the fixed input coordinates, if those are arrays.
         '''
         n_Nones = 0
         for i, c in enumerate([x, y, z]):
@@ -140,19 +143,43 @@ class RowlandTorus(MarxsElement):
                 ind = i
         if n_Nones != 1:
             raise ValueError('Exactly one of the input numbers for x,y,z must be None.')
-        # Need to give it a number for vstack to work
+        # Need to give it a number for broadcasting to work
         if ind == 0: x = 0.
         if ind == 1: y = 0.
         if ind == 2: z = 0.
 
-        xyz = np.vstack([x,y,z]).T
+        coos = np.broadcast_arrays(np.asanyarray(x, dtype=float),
+                                   np.asanyarray(y, dtype=float),
+                                   np.asanyarray(z, dtype=float))
+        shape = coos[0].shape
+        xyz = np.vstack([c.ravel() for c in coos]).T
+
         def f(val_in):
-            xyz[..., ind] = val_in
+            xyz[:, ind] = val_in
             return self.quartic(xyz, transform=transform)
-        val_out, brent_out = optimize.brentq(f, interval[0], interval[1], full_output=True)
-        if not brent_out.converged:
+
+        lo = np.full(xyz.shape[0], interval[0], dtype=float)
+        hi = np.full(xyz.shape[0], interval[1], dtype=float)
+        sign_lo = np.sign(f(lo))
+        if np.any(sign_lo * np.sign(f(hi)) > 0):
+            raise ValueError('f(a) and f(b) must have different signs for all points.')
+        # Same tolerances as scipy.optimize.brentq
+        xtol = 2e-12 + 4 * np.finfo(float).eps * np.maximum(np.abs(lo), np.abs(hi))
+        for i in range(200):
+            mid = 0.5 * (lo + hi)
+            sign_mid = np.sign(f(mid))
+            # If the sign at mid is the same as at lo, the root is in [mid, hi].
+            right = sign_mid == sign_lo
+            lo = np.where(right, mid, lo)
+            hi = np.where(right, hi, mid)
+            if np.all((hi - lo) < xtol):
+                break
+        else:
             raise Exception('Intersection with torus not found.')
-        return val_out
+        val_out = 0.5 * (lo + hi)
+        if shape == ():
+            return val_out[0]
+        return val_out.reshape(shape)
 
     def parametric(self, theta, phi):
         '''Parametric description of the torus.
@@ -208,8 +235,7 @@ class RowlandTorus(MarxsElement):
         '''
         # For r,R  >> 1 even marginal differences lead to large
         # numbers on the quartic because of R**4 -> normalize
-        invpos4d = np.linalg.inv(self.pos4d)
-        xyz = h2e(np.einsum('...ij,...j', invpos4d, e2h(xyz, 1)))
+        xyz = h2e(np.einsum('...ij,...j', self.invpos4d, e2h(xyz, 1)), 'pos')
 
         if not np.allclose(self.quartic(xyz, transform=False) / self.R**4., 0.):
             raise ValueError('Gradient vector field is only defined for points on torus surface.')
@@ -230,7 +256,7 @@ class RowlandTorus(MarxsElement):
                 raise ValueError("'origin' must be 'raise' or Eukledian vector.")
 
         gradient = gradient / np.linalg.norm(gradient, axis=1)[:, None]
-        return h2e(np.einsum('...ij,...j', self.pos4d, e2h(gradient, 0)))
+        return h2e(np.einsum('...ij,...j', self.pos4d, e2h(gradient, 0)), 'dir')
 
     def xyz_from_radiusangle(self, radius, angle, interval):
         '''Get Cartesian coordiantes for radius, angle on the rowland circle.
@@ -246,6 +272,8 @@ class RowlandTorus(MarxsElement):
             optical axis is parallel to the x-axis and goes through the origin of the
             `RowlandTorus`.
             ``angle=0`` conicides with the local y-axis.
+            All points are calculated in a single call to `solve_quartic`, so placing
+            many elements at once is much faster than calling this method in a loop.
         interval : np.array
             [min, max] for the search. The quartic can have up to for solutions because a
             line can intersect a torus in four points and this interval must bracket one and only
@@ -256,6 +284,7 @@ class RowlandTorus(MarxsElement):
         xyz : np.array of shape (n, 3)
             Eukledian coordinates in the global coordinate system.
         '''
+        radius, angle = np.broadcast_arrays(np.atleast_1d(radius), np.atleast_1d(angle))
         y = radius * np.cos(angle)
         z = radius * np.sin(angle)
         x = self.solve_quartic(y=y,z=z, interval=interval, transform=False)
@@ -440,6 +469,54 @@ class LinearCCDArray(Parallel, OpticalElement):
         return np.mean(self.radius) + np.arange(- n / 2 + 0.5, n / 2 + 0.5) * self.d_element
 
 
+    def xyz_from_radiusangle(self, radius, angle):
+        '''Get Cartesian coordinates of element centers on the Rowland torus.
+
+        This is a wrapper around `RowlandTorus.xyz_from_radiusangle` that uses the
+        ``x_range`` of this array and raises an `ElementPlacementError` if the
+        torus is not found in that range.
+
+        Parameters
+        ----------
+        radius, angle : float or np.array of shape (n,)
+            Polar coordinates in a plane perpendicular to the optical axis.
+
+        Returns
+        -------
+        xyz : np.array of shape (n, 3)
+            Eukledian coordinates in the global coordinate system.
+        '''
+        try:
+            return self.rowland.xyz_from_radiusangle(radius, angle, self.x_range)
+        except ValueError as e:
+            if 'f(a) and f(b) must have different signs' in str(e):
+                raise ElementPlacementError('No intersection with Rowland torus in range {0}'.format(self.x_range))
+            else:
+                # Something else went wrong
+                raise e
+
+    @staticmethod
+    def _compose(pos, rot_mat):
+        '''Stack translations and rotations into affine matrices.
+
+        Parameters
+        ----------
+        pos : np.array of shape (n, 3)
+            Translation vectors
+        rot_mat : np.array of shape (n, 3, 3)
+            Rotation matrices
+
+        Returns
+        -------
+        pos4d : list of arrays
+            List of n affine transformations.
+        '''
+        pos4d = np.zeros((pos.shape[0], 4, 4))
+        pos4d[:, :3, :3] = rot_mat
+        pos4d[:, :3, 3] = pos
+        pos4d[:, 3, 3] = 1.
+        return list(pos4d)
+
     def calculate_elempos(self):
         '''Calculate ideal element positions based on rowland geometry.
 
@@ -450,31 +527,22 @@ class LinearCCDArray(Parallel, OpticalElement):
             on the origin of the coordinate system with the active plane in the
             yz-plane to the required facet position on the Rowland torus.
         '''
-        pos4d = []
         radii = self.distribute_elements_on_radius()
+        facet_pos = self.xyz_from_radiusangle(radii, self.phi)
         # Line along which the detectors are placed
-        try:
-            line = normalized_vector(self.rowland.xyz_from_radiusangle(radii[1], self.phi, self.x_range) - self.rowland.xyz_from_radiusangle(radii[0], self.phi, self.x_range))
-            for r in radii:
-                facet_pos = self.rowland.xyz_from_radiusangle(r, self.phi, self.x_range).flatten()
-                if self.tangent_to_torus:
-                    facet_normal = self.rowland.normal(facet_pos)
-                else:
-                    facet_normal = facet_pos
-                # rotate such that one edge is parallel to the line
-                rot_mat = np.zeros((3,3))
-                rot_mat[0, :] = facet_normal
-                # Get the part of line that's orthogonal to facet_normal
-                rot_mat[1, :] = line - rot_mat[0, :] * np.dot(rot_mat[0, :], line)
-                rot_mat[2, :] = normalized_vector(np.cross(rot_mat[0, :], rot_mat[1, :]))
-                pos4d.append(transforms3d.affines.compose(facet_pos, rot_mat, np.ones(3)))
-        except ValueError as e:
-            if 'f(a) and f(b) must have different signs' in str(e):
-                raise ElementPlacementError('No intersection with Rowland torus in range {0}'.format(self.x_range))
-            else:
-                # Something else went wrong
-                raise e
-        return pos4d
+        line = normalized_vector(facet_pos[1] - facet_pos[0])
+        if self.tangent_to_torus:
+            facet_normal = self.rowland.normal(facet_pos)
+        else:
+            facet_normal = facet_pos
+        # rotate such that one edge is parallel to the line
+        rot_mat = np.empty((len(radii), 3, 3))
+        rot_mat[:, 0, :] = facet_normal
+        # Get the part of line that's orthogonal to facet_normal
+        rot_mat[:, 1, :] = line - facet_normal * np.dot(facet_normal, line)[:, None]
+        cross = np.cross(rot_mat[:, 0, :], rot_mat[:, 1, :])
+        rot_mat[:, 2, :] = cross / np.linalg.norm(cross, axis=1)[:, None]
+        return self._compose(facet_pos, rot_mat)
 
 
 class GratingArrayStructure(LinearCCDArray):
@@ -537,7 +605,7 @@ class GratingArrayStructure(LinearCCDArray):
         '''Position of the center of the GSA, assuming placement on the Rowland circle.'''
         a = (self.phi[0] + anglediff(self.phi) / 2 ) % (2. * np.pi)
         r = sum(self.radius) / 2
-        return self.rowland.xyz_from_radiusangle(r, a, self.x_range).flatten()
+        return self.xyz_from_radiusangle(r, a).flatten()
 
     def max_elements_on_arc(self, radius):
         '''Calculate maximal number of elements that can be placed at a certain radius.
@@ -588,19 +656,17 @@ class GratingArrayStructure(LinearCCDArray):
             on the origin of the coordinate system with the active plane in the
             yz-plane to the required element position on the Rowland torus.
         '''
-        pos4d = []
         radii = self.distribute_elements_on_radius()
-        for r in radii:
-            angles = self.distribute_elements_on_arc(r)
-            for a in angles:
-                element_pos = self.rowland.xyz_from_radiusangle(r, a, self.x_range).flatten()
-                if self.tangent_to_torus:
-                    element_normal = np.array(self.rowland.normal(element_pos))
-                else:
-                    element_normal = element_pos
-                # Find the rotation between [1, 0, 0] and the new normal
-                # Keep grooves (along e_y) parallel to e_y
-                rot_mat = ex2vec_fix(element_normal, np.array([0., 1., 0.]))
-
-                pos4d.append(transforms3d.affines.compose(element_pos, rot_mat, np.ones(3)))
-        return pos4d
+        angles = [self.distribute_elements_on_arc(r) for r in radii]
+        radii = np.repeat(radii, [len(a) for a in angles])
+        if len(radii) == 0:
+            return []
+        element_pos = self.xyz_from_radiusangle(radii, np.concatenate(angles))
+        if self.tangent_to_torus:
+            element_normal = self.rowland.normal(element_pos)
+        else:
+            element_normal = element_pos
+        # Find the rotation between [1, 0, 0] and the new normal
+        # Keep grooves (along e_y) parallel to e_y
+        rot_mat = ex2vec_fix(element_normal, np.array([0., 1., 0.]))
+        return self._compose(element_pos, rot_mat)
@@ -0,0 +1,435 @@
+'''Evaluate many instrument designs on a grid of design parameters.
+
+Trade studies often run hundreds of instrument configurations, e.g. to find
+the best values for the parameters of `~marxs.design.rowland.design_tilted_torus`
+or the radius of a `~marxs.design.GratingArrayStructure`. Most parameters only
+affect a part of the instrument. `DesignSweep` builds the instrument from
+components, where every component declares which parameters and which other
+components it depends on. Components and the photon lists that were traced
+through them are cached and only regenerated when one of their inputs changes.
+
+Points of a parameter grid are ordered such that parameters of components
+that come early in the instrument change slowest, so that consecutive points
+share as much of the instrument and the ray-trace as possible. The input
+photon list (usually photons that have been traced up to and through the
+mirror already) is reused for every point.
+'''
+from __future__ import division
+
+from collections import OrderedDict
+import hashlib
+import itertools
+import multiprocessing
+import numbers
+
+import numpy as np
+from astropy.table import Table, MaskedColumn
+from astropy.stats import sigma_clipped_stats
+
+from ..simulator.runner import _worker, _parallel_map, _seed_state
+
+
+def _run_points(points):
+    return _worker['sweep']._evaluate_points(points)
+
+
+def _freeze(value):
+    '''Turn a parameter value into a hashable object that can be compared.
+
+    Numbers are converted to Python floats, so that e.g. ``0.03`` and
+    ``np.float64(0.03)`` give the same key (and the same ``repr``, which is
+    used to derive random seeds).
+    '''
+    if isinstance(value, np.ndarray):
+        return ('ndarray', value.shape, tuple(_freeze(v) for v in value.ravel().tolist()))
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def effective_area_factory(area=1., order=None, order_col='order', hit_col=None):
+    '''Make a metric that calculates the effective area.
+
+    Photons that are lost in the instrument are usually not removed from the
+    photon list, but have their ``probability`` set to 0. Thus, the effective
+    area is the sum of all probabilities divided by the number of photons,
+    times the geometric area that the input photons represent.
+
+    Parameters
+    ----------
+    area : float
+        Geometric area (e.g. of the aperture) that the photons in the input
+        photon list represent. With the default of 1 the metric is the fraction
+        of photons that are detected.
+    order : int or ``None``
+        If not ``None``, count only photons diffracted into this order.
+    order_col : string
+        Column that holds the diffraction order.
+    hit_col : string or ``None``
+        If not ``None``, count only photons where this column is finite, e.g.
+        ``'detpix_x'`` to count only photons that hit a detector.
+
+    Returns
+    -------
+    func : callable
+        Function that accepts a photon list and returns the effective area.
+    '''
+    def effective_area(photons):
+        if (order is not None) and (order_col not in photons.colnames):
+            # no photon has been diffracted
+            return 0.
+        ind = np.ones(len(photons), dtype=bool)
+        if order is not None:
+            ind &= photons[order_col] == order
+        if hit_col is not None:
+            ind &= np.isfinite(photons[hit_col])
+        return area * photons['probability'][ind].sum() / len(photons)
+
+    return effective_area
+
+
+def resolvingpower_factory(order, col='detpix_x', order_col='order'):
+    '''Make a metric that calculates the spectral resolving power in one order.
+
+    The resolving power is calculated as the distance between the mean
+    positions of the photons in ``order`` and in the zeroth order, divided by
+    the FWHM of the photons in ``order``, similar to
+    `marxs.analysis.resolvingpower_per_order`. Mean and width are estimated
+    with sigma clipping to reduce the influence of stray photons.
+
+    Parameters
+    ----------
+    order : int
+        Diffraction order.
+    col : string
+        Column that holds the position on the detector in dispersion direction.
+    order_col : string
+        Column that holds the diffraction order.
+
+    Returns
+    -------
+    func : callable
+        Function that accepts a photon list and returns the resolving power.
+        If there are not at least two photons in ``order`` and in the zeroth
+        order, the function returns ``np.nan``.
+    '''
+    def resolvingpower(photons):
+        if (order_col not in photons.colnames) or (col not in photons.colnames):
+            return np.nan
+        pos = np.asarray(photons[col])
+        ind = (photons[order_col] == order) & np.isfinite(pos) & (photons['probability'] > 0)
+        ind0 = (photons[order_col] == 0) & np.isfinite(pos) & (photons['probability'] > 0)
+        if (ind.sum() < 2) or (ind0.sum() < 2):
+            return np.nan
+        mean, median, std = sigma_clipped_stats(pos[ind])
+        mean0, median0, std0 = sigma_clipped_stats(pos[ind0])
+        return np.abs(mean - mean0) / (2.3548 * std)
+
+    return resolvingpower
+
+
+class DesignSweep(object):
+    '''Evaluate an instrument design for many sets of design parameters.
+
+    The instrument is made up of components that are added with
+    `add_component`. Each component is built by a factory function from some
+    of the design parameters and from other components. Components with
+    ``trace=True`` are optical elements (or any other callable that accepts
+    and returns a photon list) and photons are processed by them in the order
+    in which they were added. Metrics (see `add_metric`) are calculated from
+    the photon list after the last component.
+
+    Components and photon lists are cached. When a point of the parameter grid
+    is evaluated, a component is only rebuilt if it is not in the cache with
+    the same parameters and the same required components, and photons are
+    only re-traced from the first component that changed. Each worker process
+    has its own cache.
+
+    Parameters
+    ----------
+    photons : `astropy.table.Table`
+        Input photon list, e.g. photons that have passed the aperture and the
+        mirror already. The same photons are used for every point.
+    n_workers : int or ``None``
+        Number of worker processes. ``None`` uses the number of CPU cores.
+        For ``n_workers=1`` the sweep runs in the current process. As in
+        `~marxs.simulator.ParallelRunner`, the sweep is handed to the workers
+        with the "fork" start method, so factories and metrics do not need to be
+        picklable. Without "fork" (e.g. on Windows) the sweep runs in the
+        current process.
+    seed : int or ``None``
+        Seed for the random number generator. If set, the random number
+        generator is seeded before photons are traced through a component
+        based on ``seed`` and the parameters of this and all upstream
+        components. The result is then reproducible and independent of the
+        number of workers.
+    cache_size : int
+        Number of versions of each component (and of the photon list after
+        each component) that are kept in the cache. The least recently used
+        version is discarded first. Photon lists can be large, so this number
+        should be small, but it should be at least the number of values of
+        the parameter that changes fastest in the grid.
+
+    Examples
+    --------
+    Scan the blaze angle of a set of CAT gratings and the position of a
+    detector. The lens is only run once, the gratings are rebuilt when
+    the blaze changes, and the detector is rebuilt for every point.
+
+    >>> import numpy as np
+    >>> from transforms3d.axangles import axangle2mat
+    >>> from marxs import optics
+    >>> from marxs.utils import generate_test_photons
+    >>> from marxs.design import RowlandTorus, GratingArrayStructure
+    >>> from marxs.design.sweep import DesignSweep, effective_area_factory
+    >>> lens = optics.PerfectLens(focallength=1000., position=[1000., 0, 0], zoom=100)
+    >>> photons = generate_test_photons(100)
+    >>> photons['pos'][:, 1] = np.linspace(30., 60., 100)
+    >>> photons['pos'][:, 0] = 1100.
+    >>> photons = lens(photons)
+    >>> def make_gas(blaze):
+    ...     return GratingArrayStructure(RowlandTorus(500., 500.), d_element=30.,
+    ...                                  x_range=[800., 1100.], radius=[30, 60],
+    ...                                  elem_class=optics.CATGrating,
+    ...                                  elem_args={'d': 2e-4, 'zoom': [1., 15., 15.],
+    ...                                             'orientation': axangle2mat([0, 0, 1], blaze),
+    ...                                             'order_selector': optics.constant_order_factory(1)})
+    >>> def make_det(x):
+    ...     return optics.FlatDetector(position=[x, 0, 0], zoom=[1, 100, 100])
+    >>> sweep = DesignSweep(photons)
+    >>> sweep.add_component('gas', make_gas, params=['blaze'])
+    >>> sweep.add_component('det', make_det, params=['x'])
+    >>> sweep.add_metric('aeff', effective_area_factory(hit_col='det_x'))
+    >>> results = sweep.run({'blaze': [0., 0.03], 'x': [-5., 0., 5.]})
+    >>> len(results)
+    6
+    '''
+    def __init__(self, photons, n_workers=1, seed=None, cache_size=4):
+        self.photons = photons
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.seed = seed
+        self.cache_size = cache_size
+        self.components = []
+        self.metrics = OrderedDict()
+        self.clear_cache()
+
+    def clear_cache(self):
+        '''Remove all cached components and photon lists.'''
+        self._built = dict((c[0], OrderedDict()) for c in self.components)
+        self._traced = dict((c[0], OrderedDict()) for c in self.components)
+
+    def _from_cache(self, cache, key):
+        '''Look up ``key`` in ``cache`` and mark it as most recently used.'''
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+
+    def _to_cache(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def add_component(self, name, factory, params=[], requires=[], trace=True):
+        '''Add a component to the instrument.
+
+        Parameters
+        ----------
+        name : string
+            Name of the component.
+        factory : callable
+            Function that builds the component. It is called with keyword
+            arguments: one for each parameter in ``params`` that is set for a
+            point of the grid and one for each component in ``requires``.
+        params : list of strings
+            Names of the design parameters that the component depends on.
+        requires : list of strings
+            Names of components that the component depends on, e.g. a
+            `~marxs.design.RowlandTorus` that is used to place gratings.
+            Those components must have been added before.
+        trace : bool
+            If ``True``, the component is called with the photon list and
+            returns the processed photon list. Set to ``False`` for
+            components that are not optical elements such as a
+            `~marxs.design.RowlandTorus`.
+        '''
+        names = [c[0] for c in self.components]
+        if name in names:
+            raise ValueError('A component with name {0} exists already.'.format(name))
+        for r in requires:
+            if r not in names:
+                raise ValueError('Component {0} requires {1}, which needs to be added first.'.format(name, r))
+        self.components.append((name, factory, list(params), list(requires), trace))
+        self._built[name] = OrderedDict()
+        self._traced[name] = OrderedDict()
+
+    def add_metric(self, name, func):
+        '''Add a quantity that is calculated for every point of the grid.
+
+        Parameters
+        ----------
+        name : string
+            Name of the column in the output table.
+        func : callable
+            Function that accepts the photon list after the last component and
+            returns a number, see e.g. `effective_area_factory` and
+            `resolvingpower_factory`. The function must not modify the photon
+            list, because it is cached.
+        '''
+        self.metrics[name] = func
+
+    def _build(self, point):
+        '''Build all components for one point of the grid, reusing cached components.'''
+        objs = {}
+        keys = {}
+        for name, factory, params, requires, trace in self.components:
+            kwargs = dict((p, point[p]) for p in params if p in point)
+            keys[name] = (tuple((p, _freeze(kwargs[p])) for p in params if p in kwargs),
+                          tuple(keys[r] for r in requires))
+            objs[name] = self._from_cache(self._built[name], keys[name])
+            if objs[name] is None:
+                for r in requires:
+                    kwargs[r] = objs[r]
+                objs[name] = factory(**kwargs)
+                self._to_cache(self._built[name], keys[name], objs[name])
+        return objs, keys
+
+    def _seed(self, key):
+        if self.seed is not None:
+            digest = hashlib.sha256(repr(key).encode('utf-8')).digest()
+            entropy = [self.seed] + np.frombuffer(digest, dtype=np.uint32).tolist()
+            np.random.seed(_seed_state(entropy))
+
+    def _trace(self, objs, keys):
+        '''Trace photons through all components, reusing cached photon lists.'''
+        if self.seed is None:
+            return self._trace_components(objs, keys)
+        # Seeding changes the global random number generator. Restore it, so
+        # that a serial run leaves the caller's state as a forked worker would.
+        state = np.random.get_state()
+        try:
+            return self._trace_components(objs, keys)
+        finally:
+            np.random.set_state(state)
+
+    def _trace_components(self, objs, keys):
+        photons = self.photons
+        upstream = ()
+        for name, factory, params, requires, trace in self.components:
+            if not trace:
+                continue
+            upstream = upstream + (keys[name], )
+            cached = self._from_cache(self._traced[name], upstream)
+            if cached is None:
+                self._seed(upstream)
+                photons = objs[name](photons.copy())
+                self._to_cache(self._traced[name], upstream, photons)
+            else:
+                photons = cached
+        return photons
+
+    def evaluate(self, point):
+        '''Build the instrument for one set of parameters and calculate all metrics.
+
+        Parameters
+        ----------
+        point : dict
+            Values of the design parameters.
+
+        Returns
+        -------
+        values : list
+            One value for each metric.
+        '''
+        objs, keys = self._build(point)
+        photons = self._trace(objs, keys)
+        return [func(photons) for func in self.metrics.values()]
+
+    def _evaluate_points(self, points):
+        return [self.evaluate(p) for p in points]
+
+    def _param_names(self, params):
+        '''Sort parameter names by the component that uses them first.'''
+        order = []
+        for c in self.components:
+            for p in c[2]:
+                if (p in params) and (p not in order):
+                    order.append(p)
+        return order + sorted(p for p in params if p not in order)
+
+    def points(self, grid):
+        '''List all points of a parameter grid.
+
+        Parameters
+        ----------
+        grid : dict or list of dicts
+            If ``grid`` is a dict, keys are parameter names and values are
+            lists of parameter values; every combination of values is a point
+            of the grid. The points are ordered such that parameters of
+            components that were added first change slowest.
+            If ``grid`` is a list, every entry is a dict that specifies one
+            point and the list is returned unchanged.
+
+        Returns
+        -------
+        points : list of dicts
+        '''
+        if not isinstance(grid, dict):
+            return list(grid)
+        order = []
+        for c in self.components:
+            for p in c[2]:
+                if (p in grid) and (p not in order):
+                    order.append(p)
+        for p in grid:
+            if p not in order:
+                raise ValueError('Parameter {0} is not used by any component.'.format(p))
+        return [dict(zip(order, v)) for v in itertools.product(*[grid[p] for p in order])]
+
+    def run(self, grid):
+        '''Evaluate all points of a parameter grid.
+
+        The points are split into one contiguous block per worker process, so
+        that each worker can reuse its cache for consecutive points.
+
+        Parameters
+        ----------
+        grid : dict or list of dicts
+            Parameter grid, see `points`.
+
+        Returns
+        -------
+        results : `astropy.table.Table`
+            Table with one row per point. There is one column for each
+            parameter and one for each metric. Parameter columns are ordered
+            by the component that uses them first. If ``grid`` is a list of
+            points that do not all set the same parameters, missing values are
+            masked.
+        '''
+        points = self.points(grid)
+        n_chunks = max(min(self.n_workers, len(points)), 1)
+        bounds = np.linspace(0, len(points), n_chunks + 1).astype(int)
+        chunks = [points[bounds[i]: bounds[i + 1]] for i in range(n_chunks)]
+        results = _parallel_map(_run_points, self.n_workers, {'sweep': self}, chunks)
+        values = list(itertools.chain(*results))
+        names = self._param_names(set(itertools.chain(*points)))
+        cols = []
+        for n in names:
+            # In a list of points, not every point needs to set every parameter.
+            present = [n in p for p in points]
+            fill = points[present.index(True)][n]
+            col = [p.get(n, fill) for p in points]
+            if all(present):
+                cols.append(col)
+            else:
+                mask = np.zeros(np.shape(col), dtype=bool)
+                mask[np.logical_not(present)] = True
+                cols.append(MaskedColumn(col, mask=mask))
+        cols += [[v[i] for v in values] for i in range(len(self.metrics))]
+        return Table(cols, names=names + list(self.metrics.keys()))
@@ -98,6 +98,33 @@ def test_torus_solve_quartic():
         out = mytorus.solve_quartic(x=1, y=None, z=None)
     assert 'Exactly one of the input numbers' in str(e.value)
 
+def test_torus_solve_quartic_vectorized():
+    '''Solving for many points at once gives the same result as one by one.'''
+    R, r, pos4d = design_tilted_torus(10, np.deg2rad(3), np.deg2rad(6))
+    mytorus = RowlandTorus(R, r, pos4d=pos4d)
+    y = np.linspace(-1., 1., 7)
+    z = np.linspace(0, 2., 5)[:, None]
+    x = mytorus.solve_quartic(y=y, z=z, interval=[9., 11.])
+    assert x.shape == (5, 7)
+    assert np.isclose(x[2, 3], mytorus.solve_quartic(y=y[3], z=z[2, 0], interval=[9., 11.]))
+    xyz = np.dstack(np.broadcast_arrays(x, y, z))
+    assert np.allclose(mytorus.quartic(xyz) / R**4, 0.)
+
+    with pytest.raises(ValueError) as e:
+        mytorus.solve_quartic(y=y, z=z, interval=[0., 1.])
+    assert 'different signs' in str(e.value)
+
+def test_xyz_from_radiusangle():
+    '''Vectorized input gives same result as scalar input.'''
+    mytorus = RowlandTorus(9e3/2, 9e3/2)
+    radius = np.array([300., 450., 600.])
+    angle = np.array([0.1, 2., 4.])
+    xyz = mytorus.xyz_from_radiusangle(radius, angle, [5e3, 1e4])
+    assert xyz.shape == (3, 3)
+    for i in range(3):
+        assert np.allclose(xyz[i, :], mytorus.xyz_from_radiusangle(radius[i], angle[i], [5e3, 1e4]))
+    assert np.allclose(np.sqrt(xyz[:, 1]**2 + xyz[:, 2]**2), radius)
+
 def test_rotated_torus():
     '''Test the torus equation for a set of points.
 
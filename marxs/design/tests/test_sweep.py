@@ -0,0 +1,152 @@
+import numpy as np
+import transforms3d
+import pytest
+from astropy.table import Table
+
+from ..sweep import DesignSweep, effective_area_factory, resolvingpower_factory
+from ..rowland import RowlandTorus, GratingArrayStructure, design_tilted_torus
+from ...optics import (CATGrating, PerfectLens, RadialMirrorScatter,
+                       CircularDetector, uniform_efficiency_factory)
+from ...utils import generate_test_photons
+
+
+@pytest.fixture
+def sweep():
+    '''A Rowland torus, a GAS, and a detector. All factories count how often they are called.'''
+    photons = generate_test_photons(200)
+    photons['pos'][:, 0] = 12100.
+    r = np.random.uniform(50., 100., 200)
+    phi = np.random.uniform(0, 2 * np.pi, 200)
+    photons['pos'][:, 1] = r * np.cos(phi)
+    photons['pos'][:, 2] = r * np.sin(phi)
+    photons = PerfectLens(focallength=12000., position=[12000., 0, 0], zoom=200)(photons)
+    # Blaze ensures that positive and negative orders are defined the same way for all gratings.
+    blazemat = transforms3d.axangles.axangle2mat(np.array([0, 0, 1]), np.deg2rad(1.91))
+    calls = {'rowland': 0, 'scatter': 0, 'gas': 0, 'det': 0}
+
+    def make_rowland(alpha):
+        calls['rowland'] += 1
+        R, r, pos4d = design_tilted_torus(12000., alpha, 2 * alpha)
+        return RowlandTorus(R, r, pos4d=pos4d)
+
+    def make_scatter(inplanescatter=1e-5):
+        calls['scatter'] += 1
+        return RadialMirrorScatter(inplanescatter=inplanescatter, perpplanescatter=1e-5,
+                                   position=[12000., 0, 0])
+
+    def make_gas(rowland, radius):
+        calls['gas'] += 1
+        return GratingArrayStructure(rowland, d_element=30., x_range=[1e4, 1.4e4],
+                                     radius=radius, elem_class=CATGrating,
+                                     elem_args={'d': 1e-4, 'zoom': [1., 14., 14.],
+                                                'orientation': blazemat,
+                                                'order_selector': uniform_efficiency_factory(2)})
+
+    def make_det(rowland):
+        calls['det'] += 1
+        return CircularDetector.from_rowland(rowland, width=50)
+
+    s = DesignSweep(photons, seed=4)
+    s.add_component('rowland', make_rowland, params=['alpha'], trace=False)
+    s.add_component('scatter', make_scatter, params=['inplanescatter'])
+    s.add_component('gas', make_gas, params=['radius'], requires=['rowland'])
+    s.add_component('det', make_det, requires=['rowland'])
+    s.add_metric('aeff', effective_area_factory(order=-1, hit_col='detpix_x'))
+    s.add_metric('R', resolvingpower_factory(-1))
+    s.calls = calls
+    return s
+
+grid = {'inplanescatter': [1e-5, 1e-4], 'radius': [[50., 100.], [50., 80.]],
+        'alpha': [0., 0.02]}
+
+
+def test_sweep_reuse(sweep):
+    '''Components are only rebuilt if their input changes.'''
+    points = sweep.points(grid)
+    assert len(points) == 8
+    # parameters of components that come first in the instrument change slowest
+    assert [p['alpha'] for p in points] == [0.] * 4 + [0.02] * 4
+    assert [p['inplanescatter'] for p in points] == [1e-5, 1e-5, 1e-4, 1e-4] * 2
+
+    results = sweep.run(grid)
+    assert len(results) == 8
+    assert results.colnames == ['alpha', 'inplanescatter', 'radius', 'aeff', 'R']
+    assert sweep.calls == {'rowland': 2, 'scatter': 2, 'gas': 4, 'det': 2}
+    assert np.all(results['aeff'] > 0.02)
+    # More scatter means less resolving power
+    assert np.all(results['R'][[0, 1, 4, 5]] > results['R'][[2, 3, 6, 7]])
+    # Points in the cache are not built again
+    sweep.evaluate(points[-2])
+    assert sweep.calls == {'rowland': 2, 'scatter': 2, 'gas': 4, 'det': 2}
+    sweep.cache_size = 1
+    sweep.clear_cache()
+    sweep.run(grid)
+    assert sweep.calls == {'rowland': 4, 'scatter': 6, 'gas': 12, 'det': 4}
+
+
+def test_sweep_cache_matches_fresh(sweep):
+    '''Cached components and photons give the same result as building from scratch.'''
+    results = sweep.run(grid)
+    points = sweep.points(grid)
+    for i in [0, 3, 5]:
+        sweep.clear_cache()
+        assert np.allclose(sweep.evaluate(points[i]), list(results[i][['aeff', 'R']]),
+                           equal_nan=True)
+
+
+def test_sweep_seed(sweep):
+    '''Seeds do not depend on the type of numbers and do not change the global state.'''
+    point = {'alpha': 0., 'inplanescatter': 1e-4, 'radius': [50., 100.]}
+    np.random.seed(0)
+    r1 = sweep.evaluate(point)
+    assert np.random.rand() == np.random.RandomState(0).rand()
+    sweep.clear_cache()
+    r2 = sweep.evaluate({'alpha': np.float64(0.), 'inplanescatter': np.float64(1e-4),
+                         'radius': [np.float64(50.), 100]})
+    assert np.allclose(r1, r2, equal_nan=True)
+
+
+def test_sweep_parallel(sweep):
+    '''With a seed, results do not depend on the number of workers.'''
+    results = sweep.run(grid)
+    sweep.clear_cache()
+    sweep.n_workers = 3
+    results2 = sweep.run(grid)
+    for col in results.colnames:
+        assert np.all(results[col] == results2[col])
+
+
+def test_sweep_list_of_points(sweep):
+    '''Points in a list can set different parameters.'''
+    points = [{'radius': [50., 100.], 'alpha': 0.},
+              {'alpha': 0.02, 'inplanescatter': 1e-4, 'radius': [50., 80.]}]
+    results = sweep.run(points)
+    assert results.colnames == ['alpha', 'inplanescatter', 'radius', 'aeff', 'R']
+    assert list(results['inplanescatter'].mask) == [True, False]
+    assert results['inplanescatter'][1] == 1e-4
+    assert np.all(results['alpha'] == [0., 0.02])
+
+
+def test_sweep_invalid_setup(sweep):
+    with pytest.raises(ValueError) as e:
+        sweep.run({'alpha': [0.], 'f': [1., 2.]})
+    assert 'not used by any component' in str(e.value)
+    with pytest.raises(ValueError) as e:
+        sweep.add_component('lens', PerfectLens, requires=['mirror'])
+    assert 'needs to be added first' in str(e.value)
+    with pytest.raises(ValueError) as e:
+        sweep.add_component('gas', PerfectLens)
+    assert 'exists already' in str(e.value)
+
+
+def test_metrics():
+    photons = Table({'probability': [1., 0.5, 0., 1., 1., 1., 1.],
+                     'order': [0, 0, 0, 1, 1, 1, -1],
+                     'detpix_x': [0., 0.1, np.nan, 10., 10.1, 9.9, np.nan]})
+    assert effective_area_factory()(photons) == 5.5 / 7
+    assert effective_area_factory(area=7., order=1)(photons) == 3.
+    assert effective_area_factory(area=7., hit_col='detpix_x')(photons) == 4.5
+    r = resolvingpower_factory(1)(photons)
+    assert np.isclose(r, 9.95 / (2.3548 * np.std([10., 10.1, 9.9])))
+    assert np.isnan(resolvingpower_factory(-1)(photons))
+    assert np.isnan(resolvingpower_factory(1, order_col='o')(photons))
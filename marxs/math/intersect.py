@@ -0,0 +1,173 @@
+'''Fused kernels for ray intersections.
+
+The functions in `marxs.math.pluecker` are general, but chaining them for a
+simple ray-plane intersection creates several temporary arrays for every call.
+Intersecting rays with the active plane of a flat optical element is the
+innermost loop of almost every simulation, so this module provides a
+kernel that computes the intersection point, the local coordinates in the
+plane, and the in-bounds mask in a single pass.
+
+If `numba <http://numba.pydata.org>`_ is installed, the kernel is compiled;
+otherwise a numpy implementation with the same interface is used.
+'''
+import numpy as np
+
+from .utils import quartic_real_roots
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+__all__ = ['HAS_NUMBA', 'intersect_ray_rectangle', 'intersect_line_torus']
+
+
+def _intersect_ray_rectangle_numpy(dir, pos, plane, center, e_y, e_z,
+                                   size_y, size_z, intersect, interpos, intercoos):
+    e_pos = interpos[:, :3]
+    np.divide(pos[:, :3], pos[:, 3:4], out=e_pos)
+    # distance along the ray to the plane
+    t = np.dot(e_pos, plane[:3])
+    t += plane[3]
+    t /= - np.dot(dir[:, :3], plane[:3])
+    e_pos += dir[:, :3] * t[:, None]
+    e_pos -= center
+    intercoos[:, 0] = np.dot(e_pos, e_y)
+    intercoos[:, 1] = np.dot(e_pos, e_z)
+    e_pos += center
+    np.less_equal(np.abs(intercoos[:, 0]), size_y, out=intersect)
+    intersect &= np.abs(intercoos[:, 1]) <= size_z
+    e_pos[~intersect] = np.nan
+    interpos[:, 3] = 1.
+
+
+if HAS_NUMBA:
+    @numba.njit(cache=True, nogil=True, error_model='numpy')
+    def _intersect_ray_rectangle_numba(dir, pos, plane, center, e_y, e_z,
+                                       size_y, size_z, intersect, interpos, intercoos):
+        for i in range(dir.shape[0]):
+            px = pos[i, 0] / pos[i, 3]
+            py = pos[i, 1] / pos[i, 3]
+            pz = pos[i, 2] / pos[i, 3]
+            t = - ((px * plane[0] + py * plane[1] + pz * plane[2] + plane[3]) /
+                   (dir[i, 0] * plane[0] + dir[i, 1] * plane[1] + dir[i, 2] * plane[2]))
+            px += t * dir[i, 0]
+            py += t * dir[i, 1]
+            pz += t * dir[i, 2]
+            y = ((px - center[0]) * e_y[0] + (py - center[1]) * e_y[1] +
+                 (pz - center[2]) * e_y[2])
+            z = ((px - center[0]) * e_z[0] + (py - center[1]) * e_z[1] +
+                 (pz - center[2]) * e_z[2])
+            intercoos[i, 0] = y
+            intercoos[i, 1] = z
+            if (abs(y) <= size_y) and (abs(z) <= size_z):
+                intersect[i] = True
+                interpos[i, 0] = px
+                interpos[i, 1] = py
+                interpos[i, 2] = pz
+            else:
+                intersect[i] = False
+                interpos[i, 0] = np.nan
+                interpos[i, 1] = np.nan
+                interpos[i, 2] = np.nan
+            interpos[i, 3] = 1.
+
+
+def intersect_ray_rectangle(dir, pos, plane, center, e_y, e_z, size_y, size_z,
+                            out=None):
+    '''Intersect rays with a plane and check if they hit a rectangle in that plane.
+
+    Rays are treated as lines, i.e. intersection points "behind" the
+    starting point of the ray are returned, too.
+
+    Parameters
+    ----------
+    dir : `numpy.ndarray` of shape (N, 4)
+        Homogeneous coordinates of the direction of the rays.
+    pos : `numpy.ndarray` of shape (N, 4)
+        Homogeneous coordinates of a point on each ray.
+    plane : `numpy.ndarray` of shape (4, )
+        Homogeneous coordinates of the plane.
+    center : `numpy.ndarray` of shape (3, )
+        Euclidean coordinates of the center of the rectangle.
+    e_y, e_z : `numpy.ndarray` of shape (3, )
+        Unit vectors in the plane that define the local coordinate system.
+    size_y, size_z : float
+        Half-length of the rectangle along ``e_y`` and ``e_z``.
+    out : tuple of three arrays or ``None``
+        Arrays to store the result in. They need to be C-contiguous and have
+        the shapes and types described below.
+
+    Returns
+    -------
+    intersect :  boolean array of length N
+        ``True`` if the ray intersects the plane within the rectangle.
+    interpos : `numpy.ndarray` of shape (N, 4)
+        Homogeneous coordinates (normalized to ``w=1``) of the intersection
+        point. Values are set to ``np.nan`` if the ray misses the rectangle.
+    intercoos : `numpy.ndarray` of shape (N, 2)
+        y and z coordinates of the intersection point in the local coordinate
+        system of the rectangle. These are set for all rays that are not
+        parallel to the plane, even if the rectangle is missed.
+    '''
+    n = dir.shape[0]
+    if out is None:
+        out = (np.empty(n, dtype=bool), np.empty((n, 4)), np.empty((n, 2)))
+    intersect, interpos, intercoos = out
+    if HAS_NUMBA:
+        _intersect_ray_rectangle_numba(np.ascontiguousarray(dir, dtype=float),
+                                       np.ascontiguousarray(pos, dtype=float),
+                                       plane, center, e_y, e_z,
+                                       float(size_y), float(size_z),
+                                       intersect, interpos, intercoos)
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _intersect_ray_rectangle_numpy(dir, pos, plane, center, e_y, e_z,
+                                           size_y, size_z,
+                                           intersect, interpos, intercoos)
+    return intersect, interpos, intercoos
+
+
+def intersect_line_torus(dir, pos, R, r):
+    '''Intersect lines with a torus.
+
+    The torus has the y axis as symmetry axis and is centered on the origin,
+    i.e. it is the surface where the quartic equation
+    :math:`(x^2 + y^2 + z^2 + R^2 - r^2)^2 - 4 R^2 (x^2 + z^2) = 0` holds
+    (see `marxs.design.RowlandTorus`). Transform ``dir`` and ``pos`` into
+    this coordinate system before calling this function.
+
+    Parameters
+    ----------
+    dir : `numpy.ndarray` of shape (N, 4)
+        Homogeneous coordinates of the direction of the lines.
+    pos : `numpy.ndarray` of shape (N, 4)
+        Homogeneous coordinates of a point on each line.
+    R : float
+        Radius of the torus.
+    r : float
+        Radius of the tube.
+
+    Returns
+    -------
+    t : `numpy.ndarray` of shape (N, 4)
+        The intersection points are ``pos + t * dir``. A line can intersect a
+        torus in up to four points; values are sorted in ascending order and
+        are ``np.nan`` if there are less than four intersection points.
+    '''
+    # Scale the problem to a torus of size 1 to keep the coefficients
+    # of the quartic of a similar order of magnitude.
+    scale = float(R + r)
+    o = pos[:, :3] / pos[:, 3:] / scale
+    d = dir[:, :3]
+    Rs = R / scale
+    c0 = np.einsum('ij,ij->i', o, o) + Rs**2 - (r / scale)**2
+    a = np.einsum('ij,ij->i', d, d)
+    b = 2. * np.einsum('ij,ij->i', o, d)
+    A2 = d[:, 0]**2 + d[:, 2]**2
+    A1 = 2. * (o[:, 0] * d[:, 0] + o[:, 2] * d[:, 2])
+    A0 = o[:, 0]**2 + o[:, 2]**2
+    coeffs = np.vstack([a**2, 2. * a * b, b**2 + 2. * a * c0 - 4. * Rs**2 * A2,
+                        2. * b * c0 - 4. * Rs**2 * A1, c0**2 - 4. * Rs**2 * A0]).T
+    return quartic_real_roots(coeffs) * scale
@@ -1,5 +1,13 @@
 import numpy as np
 
+CHECK_KIND = False
+'''Default for the ``check`` argument of `h2e`.
+
+Set ``marxs.math.pluecker.CHECK_KIND = True`` to check the ``w`` values in
+every call of `h2e` with an explicit ``kind``, e.g. to debug a new optical
+element in a full simulation.
+'''
+
 # tests for e2h and h2e
 
 
@@ -31,18 +39,41 @@ def e2h(e, w):
     return h
 
 
-def h2e(h):
+def _check_w(h, kind):
+    w = h[..., 3]
+    if (kind == 'dir') and not np.all(w == 0):
+        raise ValueError('Directions must have w=0.')
+    if (kind == 'pos') and not np.all(w != 0):
+        raise ValueError('Positions must have w!=0.')
+
+
+def h2e(h, kind=None, check=None):
     '''Convert homogeneous coordinates to Euclidean coordinates
 
     This functions works for points at infinity and for points in real
     euclidean space, but it expects that each time it is called ``h`` contains
     only the one or the other but not a mixture of both.
 
+    Without ``kind``, the whole array is scanned to find out which kind of
+    coordinates it contains. In performance critical code, where the caller
+    knows if ``h`` holds directions or positions, ``kind`` should be set to
+    skip that scan.
+
     Parameters
     ----------
     h : np.array
         Input homogeneous coordinates. This can be multidimensional, but the
         last dimension must be of size 4.
+    kind : ``None``, ``'dir'``, or ``'pos'``
+        ``'dir'`` for directions (points at infinity); the result is a view
+        of ``h``. ``'pos'`` for positions; the Euclidean coordinates are
+        calculated by dividing by ``w`` without checking if ``w`` is 1
+        already. ``None`` determines the kind from the values in ``h``.
+    check : bool or ``None``
+        If ``True``, check that all values of ``w`` match ``kind``. This
+        is meant for debugging. ``None`` uses the value of the module-level
+        switch `CHECK_KIND` (*default*: ``False``), which turns the check on
+        or off for all calls, including those in optical elements.
 
     Returns
     -------
@@ -50,6 +81,18 @@ def h2e(h):
         Euclidean coordinates. Same shape as ``e`` except that the last
         last dimension is now has 3 elements.
     '''
+    if check is None:
+        check = CHECK_KIND
+    if kind == 'dir':
+        if check:
+            _check_w(h, kind)
+        return h[..., :3]
+    elif kind == 'pos':
+        if check:
+            _check_w(h, kind)
+        return h[..., :3] / h[..., 3:]
+    elif kind is not None:
+        raise ValueError("kind must be None, 'dir', or 'pos'.")
     if np.all(h[..., 3] == 0) or np.allclose(h[..., 3], 1):
         return h[..., :3]
     elif np.all(h[..., 3] != 0):
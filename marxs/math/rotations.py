@@ -22,24 +22,27 @@ def ex2vec_fix(e1, efix):
 
     Parameters
     ----------
-    e1 : np.array of shape (3, )
+    e1 : np.array of shape (3, ) or (N, 3)
         new normal of plane
     efix : np.array of shape (3, )
         Vector to break rotational ambiguity.
 
     Returns
     -------
-    rot : np.array of shape (3, 3)
+    rot : np.array of shape (3, 3) or (N, 3, 3)
         Rotation matrix
     '''
-    e1 = normalized_vector(e1)
+    e1 = np.asanyarray(e1, dtype=float)
+    e1 = e1 / np.linalg.norm(e1, axis=-1)[..., None]
     efix = normalized_vector(efix)
-    if np.allclose(e1, efix) or np.allclose(e1, -efix):
+    if np.any(np.all(np.isclose(e1, efix), axis=-1) |
+              np.all(np.isclose(e1, -efix), axis=-1)):
         raise ValueError('Input vectors are parallel - Rotation matrix is ambiguous.')
-    rot = np.empty((3, 3))
-    rot[:, 0] = e1
-    rot[:, 1] = normalized_vector(efix - np.dot(efix, e1) * e1)
-    rot[:, 2] = np.cross(rot[:, 0], rot[:, 1])
+    rot = np.empty(e1.shape + (3, ))
+    rot[..., 0] = e1
+    e2 = efix - np.dot(e1, efix)[..., None] * e1
+    rot[..., 1] = e2 / np.linalg.norm(e2, axis=-1)[..., None]
+    rot[..., 2] = np.cross(rot[..., 0], rot[..., 1])
     return rot
 
 
@@ -81,3 +84,76 @@ def axangle2mat(axes, angles, is_normalized=False):
             [ x*xC+c,   xyC-zs,   zxC+ys ],
             [ xyC+zs,   y*yC+c,   yzC-xs ],
             [ zxC-ys,   yzC+xs,   z*zC+c ]]).swapaxes(0,2).swapaxes(1,2)
+
+
+def euler2mat(ai, aj, ak, axes='rzyx'):
+    '''Rotation matrices from Euler angles.
+
+    This is a vectorized version of the routine of the same name in
+    ``transforms3d``. Currently, only the ``'rzyx'`` convention (the one
+    used for pointing directions in marxs) is implemented.
+
+    Parameters
+    ----------
+    ai, aj, ak : np.array of shape (N, )
+        First, second and third Euler angle in radians.
+    axes : string
+        Axis sequence and frame (see ``transforms3d.euler``).
+
+    Returns
+    -------
+    mat : array shape (N, 3, 3)
+        rotation matrices
+    '''
+    if axes != 'rzyx':
+        raise ValueError('Only the "rzyx" convention is implemented.')
+    ci = np.cos(ai); si = np.sin(ai)
+    cj = np.cos(aj); sj = np.sin(aj)
+    ck = np.cos(ak); sk = np.sin(ak)
+    return np.array([
+            [ ci*cj,   ci*sj*sk - si*ck,   ci*sj*ck + si*sk ],
+            [ si*cj,   si*sj*sk + ci*ck,   si*sj*ck - ci*sk ],
+            [ -sj,     cj*sk,              cj*ck ]]).swapaxes(0,2).swapaxes(1,2)
+
+
+def mat2quat(mats):
+    '''Calculate quaternions from rotation matrices.
+
+    This is a vectorized version of the routine of the same name in
+    ``transforms3d``, which uses the method from Bar-Itzhack (2000) to find
+    the quaternion that fits best even if the matrices are not exactly
+    orthonormal. As in ``transforms3d``, the quaternions are returned as
+    (w, x, y, z) with ``w >= 0``.
+
+    Parameters
+    ----------
+    mats : array shape (N, 3, 3)
+        rotation matrices
+
+    Returns
+    -------
+    q : array shape (N, 4)
+        quaternions
+    '''
+    # Same (transposed) naming as in transforms3d
+    Qxx = mats[:, 0, 0]; Qyx = mats[:, 0, 1]; Qzx = mats[:, 0, 2]
+    Qxy = mats[:, 1, 0]; Qyy = mats[:, 1, 1]; Qzy = mats[:, 1, 2]
+    Qxz = mats[:, 2, 0]; Qyz = mats[:, 2, 1]; Qzz = mats[:, 2, 2]
+    # Only the lower triangle is used by eigh.
+    K = np.zeros((mats.shape[0], 4, 4))
+    K[:, 0, 0] = Qxx - Qyy - Qzz
+    K[:, 1, 0] = Qyx + Qxy
+    K[:, 1, 1] = Qyy - Qxx - Qzz
+    K[:, 2, 0] = Qzx + Qxz
+    K[:, 2, 1] = Qzy + Qyz
+    K[:, 2, 2] = Qzz - Qxx - Qyy
+    K[:, 3, 0] = Qyz - Qzy
+    K[:, 3, 1] = Qzx - Qxz
+    K[:, 3, 2] = Qxy - Qyx
+    K[:, 3, 3] = Qxx + Qyy + Qzz
+    K /= 3.
+    vals, vecs = np.linalg.eigh(K)
+    # eigenvalues are sorted in ascending order, so the last one is the largest
+    q = vecs[:, [3, 0, 1, 2], -1]
+    q[q[:, 0] < 0] *= -1
+    return q
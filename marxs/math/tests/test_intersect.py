@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from .. import intersect
+from ..intersect import intersect_ray_rectangle
+from ..pluecker import dir_point2line, intersect_line_plane, h2e, e2h
+
+
+def pluecker_intersect(dir, pos, plane, center, e_y, e_z, size_y, size_z):
+    '''Reference implementation as a chain of the general Pluecker functions.'''
+    interpos = intersect_line_plane(dir_point2line(h2e(dir), h2e(pos)), plane)
+    interpos = interpos / interpos[:, 3][:, None]
+    ey = np.dot(interpos[:, :3] - center, e_y)
+    ez = np.dot(interpos[:, :3] - center, e_z)
+    hit = (np.abs(ey) <= size_y) & (np.abs(ez) <= size_z)
+    interpos[~hit, :3] = np.nan
+    return hit, interpos, np.vstack([ey, ez]).T
+
+
+@pytest.fixture(params=[False, True])
+def backend(request, monkeypatch):
+    '''Run with the numpy fallback and (if available) with the numba kernel.'''
+    if request.param:
+        if not intersect.HAS_NUMBA:
+            pytest.skip('numba not installed')
+    else:
+        monkeypatch.setattr(intersect, 'HAS_NUMBA', False)
+
+
+def test_intersect_ray_rectangle(backend):
+    n = 1000
+    center = np.array([1., 2., -3.])
+    e_y = np.array([0, 1., 1.]) / np.sqrt(2)
+    e_z = np.array([0, -1., 1.]) / np.sqrt(2)
+    normal = np.cross(e_y, e_z)
+    plane = np.hstack([normal, -np.dot(normal, center)])
+    dir = e2h(np.random.normal(size=(n, 3)), 0)
+    pos = e2h(np.random.normal(size=(n, 3)) * 3, 1)
+    # Positions do not need to be normalized
+    pos[::2] *= 2.
+    expected = pluecker_intersect(dir, pos, plane, center, e_y, e_z, 1., 2.)
+    out = intersect_ray_rectangle(dir, pos, plane, center, e_y, e_z, 1., 2.)
+    assert np.all(out[0] == expected[0])
+    assert 0 < out[0].sum() < n
+    assert np.allclose(out[1], expected[1], equal_nan=True)
+    assert np.allclose(out[2], expected[2])
+
+
+def test_intersect_ray_rectangle_out(backend):
+    dir = np.array([[-1., 0, 0, 0], [-1., 0, 0, 0], [0., 1., 0, 0]])
+    pos = np.array([[5., 0.5, 0.2, 1], [10., 4., 0., 2.], [0, 0, 0, 1]])
+    out = (np.empty(3, dtype=bool), np.empty((3, 4)), np.empty((3, 2)))
+    res = intersect_ray_rectangle(dir, pos, np.array([1., 0, 0, 0]), np.zeros(3),
+                                  np.array([0, 1., 0]), np.array([0, 0, 1.]),
+                                  1., 1., out=out)
+    for a, b in zip(res, out):
+        assert a is b
+    # last ray is parallel to the plane and never hits
+    assert np.all(out[0] == [True, False, False])
+    assert np.allclose(out[1][0], [0, 0.5, 0.2, 1])
+    assert np.all(np.isnan(out[1][1:, :3]))
+    assert np.allclose(out[2][:2], [[0.5, 0.2], [2., 0.]])
+
+
+def test_intersect_line_torus():
+    '''Intersection points are on the torus; the number depends on the line.'''
+    R, r = 5e3, 2e3
+    dir = np.array([[1., 0, 0, 0], [1., 0, 0, 0], [1., 0, 0, 0], [0.3, -0.1, 1., 0]])
+    pos = np.array([[0., 0, 0, 1], [0., 1.9e3, 0, 1], [0., 2.1e3, 0, 1], [1e3, 500., 2e3, 2.]])
+    t = intersect.intersect_line_torus(dir, pos, R, r)
+    assert np.allclose(t[0], [-7e3, -3e3, 3e3, 7e3])
+    assert np.sum(np.isfinite(t[1])) == 4
+    assert np.all(np.isnan(t[2]))
+    for i in [1, 3]:
+        for ti in t[i][np.isfinite(t[i])]:
+            xyz = h2e(pos[i]) + ti * dir[i, :3]
+            q = ((xyz**2).sum() + R**2 - r**2)**2 - 4 * R**2 * (xyz[0]**2 + xyz[2]**2)
+            assert np.abs(q) / R**4 < 1e-10
@@ -2,6 +2,9 @@ import numpy as np
 import pytest
 
 from ..pluecker import *
+from .. import pluecker
+from ...optics import PerfectLens
+from ...utils import generate_test_photons
 
 pos1d100 = np.array([1.,0,0,1])
 pos1d100_a = np.array([-3., 0, 0, -3])
@@ -59,3 +62,38 @@ def test_intersect_line_plane():
     lines = e_pointpoint2line(p, q)
     plane = np.array([0, -1., 0, 5])
     assert np.allclose(h2e(intersect_line_plane(lines, plane)), p)
+
+
+def test_h2e_kind():
+    '''Explicit kinds give the same result as the automatic detection.'''
+    dirs = np.array([[1., 2., 3., 0.], [-1., 0, 0, 0]])
+    pos = np.array([[1., 2., 3., 1.], [2., 4., 6., 2.]])
+    assert np.all(h2e(dirs, 'dir') == h2e(dirs))
+    assert np.may_share_memory(h2e(dirs, 'dir'), dirs)
+    assert np.allclose(h2e(pos, 'pos'), h2e(pos))
+    assert np.allclose(h2e(pos[0], 'pos'), [1., 2., 3.])
+    # Mismatches are only detected if requested
+    h2e(pos, 'dir')
+    with pytest.raises(ValueError) as e:
+        h2e(pos, 'dir', check=True)
+    assert 'w=0' in str(e.value)
+    with pytest.raises(ValueError) as e:
+        h2e(dirs, 'pos', check=True)
+    assert 'w!=0' in str(e.value)
+    with pytest.raises(ValueError) as e:
+        h2e(dirs, 'direction')
+    assert 'kind must be' in str(e.value)
+
+
+def test_h2e_check_switch(monkeypatch):
+    '''The module-level switch turns on checks in optical elements.'''
+    photons = generate_test_photons(2)
+    photons['dir'][:, 3] = 1.
+    lens = PerfectLens(focallength=10., zoom=20)
+    lens(photons.copy())
+    monkeypatch.setattr(pluecker, 'CHECK_KIND', True)
+    with pytest.raises(ValueError) as e:
+        lens(photons.copy())
+    assert 'w=0' in str(e.value)
+    # An explicit argument overrides the switch.
+    h2e(photons['pos'], 'dir', check=False)
@@ -1,8 +1,8 @@
 import numpy as np
 import pytest
-from transforms3d import axangles
+from transforms3d import axangles, euler, quaternions
 
-from ..rotations import ex2vec_fix, axangle2mat
+from ..rotations import ex2vec_fix, axangle2mat, euler2mat, mat2quat
 
 def is_orthogonal(a):
     '''Return True is a matrix is orthonormal'''
@@ -27,6 +27,18 @@ def test_ex2vec_fix():
         rot = ex2vec_fix(t, np.array([0., 1. ,0.]))
         assert is_specialorthogonal(rot)
 
+def test_ex2vec_fix_vectorized():
+    '''Many vectors at once give the same result as one by one.'''
+    e1 = np.random.rand(5, 3)
+    efix = np.array([0., 1., 0.])
+    rot = ex2vec_fix(e1, efix)
+    assert rot.shape == (5, 3, 3)
+    for i in range(5):
+        assert np.allclose(rot[i, :, :], ex2vec_fix(e1[i, :], efix))
+    with pytest.raises(ValueError) as e:
+        ex2vec_fix(np.vstack([e1, efix]), efix)
+    assert 'are parallel' in str(e.value)
+
 def test_ex2vec_fix_invalid_input():
     '''Rotation is not well defined, if both input vectors are parallel.'''
     with pytest.raises(ValueError) as e:
@@ -44,3 +56,24 @@ def test_axangle2mat():
     for i in range(3):
         out1 = axangles.axangle2mat(axis[i + 1, :], angles[i + 1])
         assert np.allclose(out[i + 1, :, :], out1)
+
+
+def test_euler2mat():
+    '''Compare vectorized version to transforms3d.'''
+    angles = np.random.uniform(-np.pi, np.pi, size=(3, 10))
+    mats = euler2mat(*angles)
+    for i in range(10):
+        assert np.allclose(mats[i, :, :], euler.euler2mat(*angles[:, i], axes='rzyx'))
+    with pytest.raises(ValueError) as e:
+        euler2mat(*angles, axes='sxyz')
+    assert 'rzyx' in str(e.value)
+
+
+def test_mat2quat():
+    '''Compare vectorized version to transforms3d.'''
+    angles = np.random.uniform(-np.pi, np.pi, size=(3, 10))
+    mats = euler2mat(*angles)
+    q = mat2quat(mats)
+    for i in range(10):
+        assert np.allclose(q[i, :], quaternions.mat2quat(mats[i, :, :]))
+    assert np.all(q[:, 0] >= 0)
@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 
 from ..import utils
 from transforms3d.affines import compose
@@ -41,3 +42,38 @@ def test_anglediff():
     assert np.isclose(utils.anglediff([0, 3.]), 3.)
     assert np.isclose(utils.anglediff([-1, 1]), 2.)
     assert np.isclose(utils.anglediff([1., -1.]), 2 * np.pi - 2.)
+
+
+def test_affine_inverse():
+    '''Compare closed form inverse to general matrix inversion.'''
+    for i in range(10):
+        rot = np.linalg.qr(np.random.normal(size=(3, 3)))[0]
+        aff = compose(np.random.normal(size=3) * 10, rot,
+                      np.random.uniform(0.1, 10, size=3), np.random.normal(size=3) * .1)
+        assert np.allclose(utils.affine_inverse(aff), np.linalg.inv(aff))
+
+
+def test_affine_inverse_errors():
+    with pytest.raises(ValueError):
+        utils.affine_inverse(np.ones((4, 4)))
+    m = np.eye(4)
+    m[1, 1] = 0
+    with pytest.raises(ValueError):
+        utils.affine_inverse(m)
+
+
+def test_quartic_real_roots():
+    roots = np.array([[-3., -1., 2., 5.], [1., 1., 2., 2.]])
+    coeffs = np.array([np.poly(r) for r in roots])
+    # scale does not matter
+    coeffs[0] *= -4.
+    assert np.allclose(utils.quartic_real_roots(coeffs), roots)
+    # x^4 + 1 has no real roots, (x^2 + 1) (x - 1) (x + 2) has two
+    out = utils.quartic_real_roots([[1, 0, 0, 0, 1], np.poly([1j, -1j, 1, -2]).real])
+    assert np.all(np.isnan(out[0]))
+    assert np.allclose(out[1, :2], [-2., 1.])
+    assert np.all(np.isnan(out[1, 2:]))
+    # Rows that are not finite give no roots, but do not fail the others.
+    out = utils.quartic_real_roots([[1, np.nan, 0, 0, 1], np.poly([1, 2, 3, 4]), [np.inf, 1, 1, 1, 1]])
+    assert np.all(np.isnan(out[[0, 2]]))
+    assert np.allclose(out[1], [1, 2, 3, 4])
@@ -59,6 +59,40 @@ def mat2aff(mat):
     m[:3, :3] = mat
     return m
 
+def affine_inverse(aff):
+    '''Invert an affine 4*4 matrix.
+
+    An affine matrix consists of a 3*3 matrix :math:`A` (rotation, zoom,
+    and shear) and a translation vector :math:`t`. Its inverse is made
+    up of :math:`A^{-1}` and :math:`-A^{-1} t`. The 3*3 inverse is calculated
+    in closed form from the cross products of the columns of :math:`A`,
+    which is faster and more accurate than a general matrix inversion.
+
+    Parameters
+    ----------
+    aff : (4, 4) array
+        affine transformation matrix
+
+    Returns
+    -------
+    inv : (4, 4) array
+        inverse of ``aff``
+    '''
+    aff = np.asanyarray(aff)
+    if (aff.shape != (4, 4)) or not np.all(aff[3, :] == [0, 0, 0, 1]):
+        raise ValueError('Input must be an affine 4*4 matrix.')
+    a, b, c = aff[:3, 0], aff[:3, 1], aff[:3, 2]
+    # Rows of the inverse are the cross products of the columns,
+    # divided by the determinant.
+    rows = np.array([np.cross(b, c), np.cross(c, a), np.cross(a, b)])
+    det = np.dot(a, rows[0])
+    if det == 0:
+        raise ValueError('Matrix is singular.')
+    inv = np.eye(4)
+    inv[:3, :3] = rows / det
+    inv[:3, 3] = - np.dot(inv[:3, :3], aff[:3, 3])
+    return inv
+
 def norm_vector(vec):
     '''Normalize euklidean vectors.
 
@@ -88,3 +122,58 @@ def anglediff(phi):
         # If anglediff == 2 pi exactly, presumably the user want to cover the full circle.
         anglediff = anglediff % (2. * np.pi)
     return anglediff
+
+def quartic_real_roots(coeffs, tol=1e-6):
+    '''Real roots of many quartic polynomials at once.
+
+    The roots are calculated as eigenvalues of the companion matrix of
+    each polynomial (like `numpy.roots`, but vectorized over many polynomials)
+    and the real roots are refined with up to two Newton steps.
+
+    Parameters
+    ----------
+    coeffs : np.array of shape (N, 5)
+        Polynomial coefficients, highest power first. The coefficient of
+        the highest power must not be zero.
+    tol : float
+        Roots with an imaginary part smaller than ``tol`` times
+        ``max(1, abs(root))`` are considered real. Double roots (e.g. a ray that
+        touches a surface) usually come out with a small imaginary part.
+
+    Returns
+    -------
+    roots : np.array of shape (N, 4)
+        Real roots, sorted in ascending order. If there are less than four
+        real roots, the remaining entries are ``np.nan``. All four entries are
+        ``np.nan`` for polynomials with coefficients that are not finite.
+    '''
+    coeffs = np.atleast_2d(coeffs)
+    if coeffs.shape[-1] != 5:
+        raise ValueError('Quartic polynomials need 5 coefficients.')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = coeffs[:, 1:] / coeffs[:, :1]
+    # eigvals fails for the whole array if any matrix is not finite.
+    finite = np.all(np.isfinite(coeffs), axis=1) & np.all(np.isfinite(c), axis=1)
+    companion = np.zeros((finite.sum(), 4, 4))
+    companion[:, [1, 2, 3], [0, 1, 2]] = 1.
+    companion[:, :, 3] = - c[finite, ::-1]
+    roots = np.empty((c.shape[0], 4), dtype=complex)
+    roots[~finite] = np.nan
+    roots[finite] = np.linalg.eigvals(companion)
+    isreal = np.abs(roots.imag) <= tol * np.maximum(1., np.abs(roots.real))
+    roots = roots.real
+    # polish with Newton's method on the normalized polynomial
+    c3, c2, c1, c0 = [c[:, i][:, None] for i in range(4)]
+
+    def poly(x):
+        return (((x + c3) * x + c2) * x + c1) * x + c0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(2):
+            dp = ((4 * roots + 3 * c3) * roots + 2 * c2) * roots + c1
+            new = roots - poly(roots) / dp
+            # Close to double roots dp is almost 0 and a step can go wrong.
+            better = np.abs(poly(new)) < np.abs(poly(roots))
+            roots = np.where(better, new, roots)
+    roots[~isreal] = np.nan
+    return np.sort(roots, axis=1)
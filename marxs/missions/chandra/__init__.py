@@ -24,8 +24,6 @@ import numpy as np
 
 from astropy.table import Table
 from transforms3d.utils import normalized_vector as norm_vec
-from transforms3d.euler import euler2mat
-from transforms3d.quaternions import mat2quat
 from transforms3d.axangles import axangle2mat
 
 from ...optics import MarxMirror as HDMA
@@ -33,6 +31,8 @@ from ...optics import FlatDetector, FlatGrating, uniform_efficiency_factory
 from ...source import FixedPointing
 from ...simulator import Sequence, Parallel
 from ...math.pluecker import h2e
+from ...math.rotations import euler2mat, mat2quat
+from ...math.rotations import axangle2mat as axangle2mat_vec
 from .fitsheaders import complete_header
 from .data import (NOMINAL_FOCALLENGTH, AIMPOINTS, TDET, ODET, PIXSIZE,
     PIX_CORNER_LSI_PAR)
@@ -215,11 +215,21 @@ class LissajousDither(FixedPointing):
         (pitch, yaw, roll) dither Period in sec
     DitherPhase : np.array
         (pitch, yaw, roll) dither phase at ``time = 0``
+    pointing_timestep : float or ``None``
+        If set, the pointing used to calculate photon directions is evaluated
+        on a grid of times with this spacing (in sec) and interpolated for
+        each photon. For large photon numbers this is much faster than
+        evaluating the pointing at the time of each photon. The dither
+        motion is slow (periods of several hundred seconds), so a timestep
+        of a few tenths of a second is still very accurate.
+        The grid is cached (see `aspect_solution`); set this to the same value
+        as the ``timestep`` in `write_asol` to compute the pointing only once.
     '''
     def __init__(self, **kwargs):
         self.DitherAmp = kwargs.pop('DitherAmp', np.array([8., 8., 0.]))
         self.DitherPeriod = kwargs.pop('DitherPeriod', np.array([1000., 707., 1e5]))
         self.DitherPhase = kwargs.pop('DitherPhase', np.zeros(3))
+        self.pointing_timestep = kwargs.pop('pointing_timestep', None)
         super(LissajousDither, self).__init__(**kwargs)
 
     def dither(self, time):
@@ -274,17 +284,14 @@ class LissajousDither(FixedPointing):
         e_dither = np.vstack([np.sin(phi) * np.sin(theta),
                               np.cos(phi) * np.sin(theta),
                               np.cos(theta)]).T
-        pointing_dir = np.zeros_like(dither)
-
         # common case for Chandra
         if np.allclose(roll, roll[0]):
             mat = axangle2mat(e_nominal, -roll[0], is_normalized=True)
-            constant_roll = True
-
-        for i in range(len(time)):
-            if not constant_roll:
-                mat = axangle2mat(e_nominal, -roll[i], is_normalized=True)
-            pointing_dir[i, :] = np.dot(mat, e_dither[i, :])
+            pointing_dir = np.dot(e_dither, mat.T)
+        else:
+            mat = axangle2mat_vec(np.tile(e_nominal, (len(time), 1)), -roll,
+                                  is_normalized=True)
+            pointing_dir = np.einsum('nij,nj->ni', mat, e_dither)
 
         # convert x,y,z pointing back to ra, dec, roll
         pointing = np.vstack([np.arctan2(pointing_dir[:, 0], pointing_dir[:, 1]) % (2.*np.pi),
@@ -309,45 +316,129 @@ class LissajousDither(FixedPointing):
         photons_dir : np.array of shape (n, 4)
             Homogeneous direction vector for each photon
         '''
+        if self.pointing_timestep is None:
+            pointing = self.pointing(time)
+        else:
+            pointing = self.interpolated_pointing(time, self.pointing_timestep)
         # Minus sign here because photons start at +inf and move towards origin
-        pointing = self.pointing(time)
         photons_dir = np.zeros((len(ra), 4))
         photons_dir[:, 0] = - np.cos(dec) * np.cos(ra)
         photons_dir[:, 1] = - np.cos(dec) * np.sin(ra)
         photons_dir[:, 2] = - np.sin(dec)
-        for i in range(len(ra)):
-            mat3d = euler2mat(pointing[i, 0],
-                              - pointing[i, 1],
-                              - pointing[i, 2], 'rzyx')
+        mat3d = euler2mat(pointing[:, 0], - pointing[:, 1], - pointing[:, 2])
+        # apply the transpose of each matrix
+        photons_dir[:, :3] = np.einsum('nji,nj->ni', mat3d, photons_dir[:, :3])
+        return photons_dir
 
-            photons_dir[i, :3] = np.dot(mat3d.T, photons_dir[i, :3])
+    def interpolated_pointing(self, time, timestep):
+        '''Interpolate the pointing direction from a regular grid of times.
 
-        return photons_dir
+        Parameters
+        ----------
+        time : np.array
+            Array of times
+        timestep : float
+            Spacing of the grid in sec.
+
+        Results
+        -------
+        pointing : (n, 3) np.array
+            Ra, Dec, roll values in radian for the pointing direction at time t.
+        '''
+        time = np.asarray(time)
+        if len(time) == 0:
+            return np.zeros((0, 3))
+        grid = self._aspect_grid(time.min(), time.max(), timestep)
+        # Interpolate the ra continuously across 0 / 2 pi.
+        ra = np.unwrap(grid['pointing'][:, 0])
+        pointing = np.vstack([np.interp(time, grid['time'], ra)] +
+                             [np.interp(time, grid['time'], grid['pointing'][:, i])
+                              for i in [1, 2]]).T
+        pointing[:, 0] %= 2. * np.pi
+        return pointing
 
+    _aspect_cache = (None, None, None)
+    _derived_attributes = ('_aspect_cache', )
 
-    def write_asol(self, photons, asolfile, timestep=0.256):
-        time = np.arange(0, photons.meta['EXPOSURE'][0], timestep)
-        pointing = np.rad2deg(self.pointing(time))
-        asol = Table([time, pointing[:, 0], pointing[:, 1], pointing[:, 2]],
-                     names=['time', 'ra', 'dec', 'roll'],
-                     )
+    def _pointing_key(self, timestep):
+        return (self.ra, self.dec, self.roll, timestep,
+                tuple(np.asarray(self.DitherAmp, dtype=float)),
+                tuple(np.asarray(self.DitherPeriod, dtype=float)),
+                tuple(np.asarray(self.DitherPhase, dtype=float)))
+
+    def _aspect_grid(self, tstart, tstop, timestep):
+        '''Return a view of the cached aspect solution from ``tstart`` to ``tstop``.
+
+        The grid points are at integer multiples of ``timestep``. If the
+        requested time range is not in the cache, the pointing is calculated
+        for the union of the cached and the requested range.
+        '''
+        istart = int(np.floor(tstart / timestep))
+        istop = int(np.ceil(tstop / timestep))
+        key, i0, grid = self._aspect_cache
+        newkey = self._pointing_key(timestep)
+        if (key != newkey) or (istart < i0) or (istop >= i0 + len(grid['time'])):
+            if key == newkey:
+                istart = min(istart, i0)
+                istop = max(istop, i0 + len(grid['time']) - 1)
+            time = timestep * np.arange(istart, istop + 1)
+            pointing = self.pointing(time)
+            mats = euler2mat(pointing[:, 0], - pointing[:, 1], - pointing[:, 2])
+            grid = {'time': time, 'pointing': pointing, 'q_att': mat2quat(mats)}
+            self._aspect_cache = (newkey, istart, grid)
+            i0 = istart
+        ind = slice(istart - i0, istop - i0 + 1)
+        return dict((k, v[ind]) for k, v in grid.items())
+
+    def aspect_solution(self, tstart, tstop, timestep=0.256):
+        '''Pointing direction and attitude quaternions on a regular grid of times.
+
+        The aspect solution is cached, so that photon directions
+        (see ``pointing_timestep``), `write_asol`, and later analysis
+        can use the same values without recomputing them. The cache is
+        refreshed automatically if any of the pointing or dither parameters
+        change.
+
+        Parameters
+        ----------
+        tstart, tstop : float
+            Time range in sec. The grid points are integer multiples of
+            ``timestep`` and cover at least this range.
+        timestep : float
+            Spacing of the grid in sec.
+
+        Returns
+        -------
+        asol : `astropy.table.Table`
+            Table with columns ``time``, ``ra``, ``dec``, ``roll``
+            (in deg) and the quaternion ``q_att``.
+        '''
+        grid = self._aspect_grid(tstart, tstop, timestep)
+        pointing = np.rad2deg(grid['pointing'])
+        asol = Table([grid['time'], pointing[:, 0], pointing[:, 1], pointing[:, 2],
+                      grid['q_att']],
+                     names=['time', 'ra', 'dec', 'roll', 'q_att'])
         asol['time'].unit = 's'
+        for col in ['ra', 'dec', 'roll']:
+            asol[col].unit = 'deg'
+        return asol
+
+    def write_asol(self, photons, asolfile, timestep=0.256):
+        exposure = photons.meta['EXPOSURE'][0]
+        asol = self.aspect_solution(0, exposure, timestep)
+        asol = asol[asol['time'] < exposure]
         # The following columns represent measured offsets in Chandra
         # They are not part of this simulation. Simply set them to 0
         for col in [ 'ra_err', 'dec_err', 'roll_err',
                      'dy', 'dz', 'dtheta', 'dy_err', 'dz_err', 'dtheta_err',
                       'roll_bias', 'pitch_bias', 'yaw_bias', 'roll_bias_err', 'pitch_bias_err', 'yaw_bias_err']:
-            asol[col] = np.zeros_like(time)
+            asol[col] = np.zeros_like(asol['time'])
             if 'bias' in col:
                 asol[col].unit = 'deg / s'
             elif ('dy' in col) or ('dz' in col):
                 asol[col].unit = 'mm'
             else:
                 asol[col].unit = 'deg'
-        asol['q_att'] = [mat2quat(euler2mat(np.deg2rad(p[0]),
-                                   np.deg2rad(-p[1]),
-                                   np.deg2rad(-p[2]), 'rzyx'))
-                         for p in pointing]
         # Copy info like the exposure time from the photons list meta to asol,
         # but not column specific keywords like TTYPEn, TCTYPn, MTYPEn, MFORMn, etc:
         for k in photons.meta:
@@ -74,3 +74,4 @@ class HETG(Parallel):
             # They are already in the input table.
             self.elements[i].geometry['e_groove'][:3] = ul[:, i]
             self.elements[i].geometry['e_perp_groove'][:3] = ud[:, i]
+            self.elements[i].reset_derived_geometry()
@@ -98,3 +98,80 @@ def test_ACIS_pixel_number():
     acis = chandra.ACIS(chips=[4, 5, 6, 7, 8, 9], aimpoint=chandra.AIMPOINTS['ACIS-I'])
     for i in range(5):
         assert acis.elements[i].npix == [1024, 1024]
+
+
+def test_photons_dir_vectorized():
+    '''Compare with rotating each photon with the matrix from transforms3d.
+
+    Use a dither in roll, so that the rotation is different for every photon.
+    '''
+    from transforms3d.euler import euler2mat
+    mypointing = chandra.LissajousDither(coords=(212.5, -33.), roll=15.,
+                                         DitherAmp=np.array([8., 8., 1000.]),
+                                         DitherPeriod=np.array([1000., 707., 50.]))
+    time = np.linspace(0, 100, 20)
+    ra = np.deg2rad(212.5 + np.random.normal(scale=0.01, size=20))
+    dec = np.deg2rad(-33. + np.random.normal(scale=0.01, size=20))
+    pointing = mypointing.pointing(time)
+    assert np.ptp(pointing[:, 2]) > 0
+    photons_dir = mypointing.photons_dir(ra, dec, time)
+    for i in range(len(time)):
+        mat3d = euler2mat(pointing[i, 0], - pointing[i, 1], - pointing[i, 2], 'rzyx')
+        vec = - np.array([np.cos(dec[i]) * np.cos(ra[i]),
+                          np.cos(dec[i]) * np.sin(ra[i]),
+                          np.sin(dec[i])])
+        assert np.allclose(photons_dir[i, :3], np.dot(mat3d.T, vec))
+
+
+def test_interpolated_pointing():
+    '''Interpolated pointing is close to the exact pointing, also across ra=0.'''
+    mypointing = chandra.LissajousDither(coords=(0., 20.), pointing_timestep=0.5)
+    time = np.sort(np.random.uniform(0, 2000, size=1000))
+    exact = mypointing.pointing(time)
+    interp = mypointing.interpolated_pointing(time, 0.5)
+    diff = exact - interp
+    diff[:, 0] = (diff[:, 0] + np.pi) % (2 * np.pi) - np.pi
+    assert np.all(np.abs(diff) < 1e-9)
+    # pointing_timestep switches photons_dir to the interpolation.
+    ra = np.zeros_like(time)
+    dec = np.deg2rad(20. * np.ones_like(time))
+    exactpointing = chandra.LissajousDither(coords=(0., 20.))
+    assert np.allclose(mypointing.photons_dir(ra, dec, time),
+                       exactpointing.photons_dir(ra, dec, time))
+
+
+def test_aspect_solution_cache():
+    '''The aspect solution is computed once and reused for overlapping ranges.'''
+    from transforms3d.euler import euler2mat
+    from transforms3d.quaternions import mat2quat
+    mypointing = chandra.LissajousDither(coords=(212.5, -33.), roll=15.)
+    asol = mypointing.aspect_solution(0, 100., 0.5)
+    assert np.allclose(asol['time'], np.arange(201) * 0.5)
+    assert np.allclose(asol['ra'], np.rad2deg(mypointing.pointing(asol['time']))[:, 0])
+    p = np.deg2rad([asol['ra'][7], asol['dec'][7], asol['roll'][7]])
+    assert np.allclose(asol['q_att'][7], mat2quat(euler2mat(p[0], -p[1], -p[2], 'rzyx')))
+    cached = mypointing._aspect_cache[2]
+    sub = mypointing.aspect_solution(10, 20., 0.5)
+    assert mypointing._aspect_cache[2] is cached
+    assert np.all(sub['ra'] == asol['ra'][20:41])
+    # Extending the range recalculates the grid for the union of the cached
+    # and the requested range, so the earlier range is still covered.
+    mypointing.aspect_solution(-10, 50., 0.5)
+    assert mypointing._aspect_cache[1] == -20
+    assert len(mypointing._aspect_cache[2]['time']) == 221
+    # Changing a parameter refreshes the cache
+    mypointing.DitherAmp = np.array([16., 16., 0.])
+    asol2 = mypointing.aspect_solution(0, 100., 0.5)
+    assert not np.allclose(asol2['ra'], asol['ra'], rtol=0, atol=1e-6)
+
+
+def test_write_asol(tmpdir):
+    mysource = PointSource((30., 30.), energy=1., flux=1.)
+    mypointing = chandra.LissajousDither(coords=(30., 30.), roll=15.)
+    photons = mypointing(mysource.generate_photons(10))
+    photons.meta['EXPOSURE'] = (10., 'exposure time')
+    asolfile = str(tmpdir.join('asol.fits'))
+    mypointing.write_asol(photons, asolfile)
+    asol = Table.read(asolfile)
+    assert len(asol) == len(np.arange(0, 10., 0.256))
+    assert asol['q_att'].shape == (len(asol), 4)
@@ -1,7 +1,7 @@
 from .aperture import RectangleAperture, CircleAperture
-from .detector import FlatDetector, CircularDetector
+from .detector import FlatDetector, CircularDetector, TorusDetector
 from .marx import MarxMirror
-from .grating import FlatGrating, CATGrating, uniform_efficiency_factory, constant_order_factory, EfficiencyFile
+from .grating import FlatGrating, CATGrating, uniform_efficiency_factory, constant_order_factory, EfficiencyFile, EfficiencyTable
 from .mirror import ThinLens, PerfectLens
 from .baffle import Baffle
 from .scatter import RadialMirrorScatter
@@ -21,7 +21,7 @@ class Baffle(FlatOpticalElement):
 
 
     def process_photons(self, photons):
-        intersect, h_intersect, det_coords = self.intersect(photons['dir'].data, photons['pos'].data)
+        intersect, h_intersect, det_coords = self.intersect(np.asarray(photons['dir']), np.asarray(photons['pos']))
         photons['pos'][intersect] = h_intersect[intersect]
         photons['probability'][~intersect] = 0
         return photons
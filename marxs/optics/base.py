@@ -3,11 +3,11 @@ from copy import copy
 
 import numpy as np
 from astropy.table import Table, Row
-from transforms3d.affines import decompose44
 
 from marxs.math.pluecker import h2e
 
 from ..math.pluecker import *
+from ..math.intersect import intersect_ray_rectangle
 from ..base import SimulationSequenceElement, _parse_position_keywords
 from ..visualization.utils import get_color
 
@@ -24,6 +24,17 @@ class OpticalElement(SimulationSequenceElement):
     If no vectorized implementation is available, it is sufficient to overwrite `process_photon`.
     Marxs will call `process_photons`, which (if not overwritten) contains a simple for-loop to
     loop over all photons in the array and call `process_photon` on each of them.
+    If `process_photon` only uses numpy operations that work on whole arrays as well as on a
+    single photon, set `process_photon_vectorized` to ``True`` and `process_photons` will call
+    `process_photon` once with all photons instead of looping.
+    '''
+
+    process_photon_vectorized = False
+    '''If ``True``, `process_photon` works on arrays of photons.
+
+    In that case, ``dir`` and ``pos`` are passed as arrays of shape (N, 4) and ``energy`` and
+    ``polarization`` as arrays of shape (N, ) and `process_photon` must return arrays (or
+    scalars, which apply to all photons) in the same format.
     '''
 
     geometry = {}
@@ -111,17 +122,41 @@ class OpticalElement(SimulationSequenceElement):
         if isinstance(photons, Row):
             photons = Table(photons)
         outcols = ['dir', 'pos', 'energy', 'polarization', 'probability'] + self.output_columns
-        for i, photon in enumerate(photons):
-            outs = self.process_photon(photon['dir'], photon['pos'],
-                                       photon['energy'],
-                                       photon['polarization'])
-            for a, b in zip(outcols, outs):
-                if a == 'probability':
-                    photons['probability'][i] *= b
-                else:
-                    photons[a][i] = b
+        incols = [np.asarray(photons[c]) for c in ['dir', 'pos', 'energy', 'polarization']]
+        if self.process_photon_vectorized:
+            outs = self.process_photon(*incols)
+        else:
+            outs = self._process_photon_loop(*incols)
+        # Write results column by column
+        for a, b in zip(outcols, outs):
+            if a == 'probability':
+                photons['probability'] *= b
+            elif a in photons.colnames:
+                photons[a][:] = b
+            else:
+                photons[a] = b
         return photons
 
+    def _process_photon_loop(self, *incols):
+        '''Call `process_photon` for each photon and collect the results in arrays.'''
+        n = len(incols[0])
+        outs = None
+        for i in range(n):
+            out = self.process_photon(*[c[i] for c in incols])
+            if outs is None:
+                # Preallocate arrays based on the shape and type of the first result.
+                # Integer numbers (e.g. a probability of 1) are stored as float.
+                outs = []
+                for o in out:
+                    o = np.asarray(o)
+                    dtype = float if o.dtype.kind in 'biu' else o.dtype
+                    outs.append(np.empty((n, ) + o.shape, dtype=dtype))
+            for a, b in zip(outs, out):
+                a[i] = b
+        if outs is None:
+            outs = []
+        return outs
+
 
 
 class FlatOpticalElement(OpticalElement):
@@ -191,6 +226,48 @@ class FlatOpticalElement(OpticalElement):
         self.geometry['plane'] = point_dir2plane(self.geometry['center'],
                                                  normal)
 
+    _derived_geometry = None
+    _derived_attributes = ('_derived_geometry', )
+
+    @OpticalElement.pos4d.setter
+    def pos4d(self, value):
+        OpticalElement.pos4d.fset(self, value)
+        self._derived_geometry = None
+
+    def reset_derived_geometry(self):
+        '''Reset the cached `derived_geometry`.
+
+        Call this after changing entries of `geometry` (or their values in place).
+        '''
+        self._derived_geometry = None
+
+    @property
+    def derived_geometry(self):
+        '''Quantities derived from `geometry` and ``pos4d``.
+
+        Many calculations need the Euclidean form of the vectors in `geometry`
+        and other derived values. Computing them again on every call adds up
+        when e.g. hundreds of grating facets each process a small number of
+        photons, so they are cached. As for `invpos4d`, assigning a new matrix
+        to ``pos4d`` resets the cache. After changing `geometry`, call
+        `reset_derived_geometry`.
+
+        The dictionary contains the Euclidean coordinates of every 4-d vector
+        in `geometry` (except ``plane``) under the same key, ``normal`` (the
+        normal of the active plane), and ``size_y`` and ``size_z`` (the norms of
+        ``v_y`` and ``v_z``).
+        '''
+        if self._derived_geometry is None:
+            derived = {}
+            for k, v in self.geometry.items():
+                if isinstance(v, np.ndarray) and (v.shape == (4, )) and (k != 'plane'):
+                    derived[k] = h2e(v)
+            derived['normal'] = self.geometry['plane'][:3]
+            derived['size_y'] = np.linalg.norm(self.geometry['v_y'])
+            derived['size_z'] = np.linalg.norm(self.geometry['v_z'])
+            self._derived_geometry = derived
+        return self._derived_geometry
+
     def intersect(self, dir, pos):
         '''Calculate the intersection point between a ray and the element
 
@@ -211,19 +288,14 @@ class FlatOpticalElement(OpticalElement):
         interpos_local : `numpy.ndarray` of shape (N, 2)
             y and z coordinates in the coordiante system of the active plane.
         '''
-        plucker = dir_point2line(h2e(dir), h2e(pos))
-        interpos =  intersect_line_plane(plucker, self.geometry['plane'])
-        vec_center_inter = - h2e(self.geometry['center']) + h2e(interpos)
-        ey = np.dot(vec_center_inter, h2e(self.geometry['e_y']))
-        ez = np.dot(vec_center_inter, h2e(self.geometry['e_z']))
-        intersect = ((np.abs(ey) <= np.linalg.norm(self.geometry['v_y'])) &
-                     (np.abs(ez) <= np.linalg.norm(self.geometry['v_z'])))
-        if dir.ndim == 2:
-            interpos[~intersect, :3] = np.nan
+        g = self.derived_geometry
+        intersect, interpos, intercoos = intersect_ray_rectangle(
+            np.atleast_2d(dir), np.atleast_2d(pos), self.geometry['plane'],
+            g['center'], g['e_y'], g['e_z'], g['size_y'], g['size_z'])
         # input of single photon.
-        elif (dir.ndim == 1) and not intersect:
-            interpos[:3] = np.nan
-        return intersect, interpos, np.vstack([ey, ez]).T
+        if dir.ndim == 1:
+            return intersect[0], interpos[0], intercoos
+        return intersect, interpos, intercoos
 
     def process_photons(self, photons, intersect=None, interpos=None, intercoos=None):
         '''
@@ -241,7 +313,7 @@ class FlatOpticalElement(OpticalElement):
         '''
         if hasattr(self, 'specific_process_photons'):
             if (interpos is None) or (intercoos is None) or (intersect is None):
-                intersect, interpos, intercoos = self.intersect(photons['dir'].data, photons['pos'].data)
+                intersect, interpos, intercoos = self.intersect(np.asarray(photons['dir']), np.asarray(photons['pos']))
             if intersect.sum() > 0:
                 outcols = self.specific_process_photons(photons, intersect, interpos, intercoos)
                 self.add_output_cols(photons, self.loc_coos_name + list(outcols.keys()))
@@ -265,7 +337,7 @@ class FlatOpticalElement(OpticalElement):
     def _plot_mayavi(self, viewer=None):
         from tvtk.tools import visual
         visual.set_viewer(viewer)
-        trans, rot, zoom, shear = decompose44(self.pos4d)
+        trans, rot, zoom, shear = self.pos4d_decomposed
         # turn into valid color tuple
         self.display['color'] = get_color(self.display)
         # setting color here is more global than in the next line
@@ -335,7 +407,7 @@ class FlatStack(FlatOpticalElement):
             calculated here. No checks are done on passed-in values.
         '''
         if (interpos is None) or (intercoos is None) or (intersect is None):
-            intersect, interpos, intercoos = self.intersect(photons['dir'].data, photons['pos'].data)
+            intersect, interpos, intercoos = self.intersect(np.asarray(photons['dir']), np.asarray(photons['pos']))
         if intersect.sum() > 0:
             # This line calls FlatOpticalElement.process_photons to add ID cols and local coos
             # if requested (this could also be done by any of the contained sequence elements,
@@ -370,9 +442,8 @@ def photonlocalcoords(f, colnames=['pos', 'dir']):
     @wraps(f)
     def wrapper(self, photons, *args, **kwargs):
         # transform to coordsys if single instrument
-        invpos4d = np.linalg.inv(self.pos4d)
         for n in colnames:
-            photons[n] = np.einsum('...ij,...j', invpos4d, photons[n])
+            photons[n] = np.einsum('...ij,...j', self.invpos4d, photons[n])
         photons = f(self, photons, *args, **kwargs)
         # transform back into coordsys of satellite
         for n in colnames:
@@ -2,10 +2,12 @@ from __future__ import division
 import warnings
 
 import numpy as np
-from transforms3d.affines import decompose44, compose
+from transforms3d.affines import compose
 
 from .base import FlatOpticalElement, OpticalElement
 from ..math.pluecker import h2e
+from ..math.intersect import intersect_line_torus
+from ..math.utils import anglediff
 from ..visualization.utils import get_color
 
 class PixelSizeWarning(Warning):
@@ -48,7 +50,7 @@ class FlatDetector(FlatOpticalElement):
     def __init__(self, pixsize=1, **kwargs):
         self.pixsize = pixsize
         super(FlatDetector, self).__init__(**kwargs)
-        t, r, zoom, s = decompose44(self.pos4d)
+        t, r, zoom, s = self.pos4d_decomposed
         self.npix = [0, 0]
         self.centerpix = [0, 0]
         for i in (0, 1):
@@ -157,11 +159,10 @@ class CircularDetector(OpticalElement):
             raise ValueError('First input must be direction vectors.')
         # Could test pos, too...
         if transform:
-            invpos4d = np.linalg.inv(self.pos4d)
-            dir = np.dot(invpos4d, dir.T).T
-            pos = np.dot(invpos4d, pos.T).T
+            dir = np.dot(self.invpos4d, dir.T).T
+            pos = np.dot(self.invpos4d, pos.T).T
 
-        xyz = h2e(pos)
+        xyz = h2e(pos, 'pos')
 
         # Solve quadratic equation in steps. a12 = (-xr +- sqrt(xr - r**2(x**2 - R**2)))
         xy = xyz[:, :2]
@@ -194,7 +195,7 @@ class CircularDetector(OpticalElement):
             interpos[i, 2] = interpos_local[i, 1]
             interpos[i, 3] = 1
             # set those elements on intersect that miss in z to False
-            trans, rot, zoom, shear = decompose44(self.pos4d)
+            trans, rot, zoom, shear = self.pos4d_decomposed
             z_p = interpos[i, 2]
             intersect[i.nonzero()[0][np.abs(z_p) > 1]] = False
             # Now reset everything to nan that does not intersect
@@ -221,7 +222,7 @@ class CircularDetector(OpticalElement):
         photons['pos'][intersect] = interpos[intersect]
         photons[self.loc_coos_name[0]][intersect] = inter_local[intersect, 0]
         photons[self.loc_coos_name[1]][intersect] = inter_local[intersect, 1]
-        trans, rot, zoom, shear = decompose44(self.pos4d)
+        trans, rot, zoom, shear = self.pos4d_decomposed
         if np.isclose(zoom[0], zoom[1]):
             photons[self.detpix_name[0]][intersect] = inter_local[intersect, 0] * zoom[0] / self.pixsize
         else:
@@ -273,3 +274,156 @@ class CircularDetector(OpticalElement):
             if n in self.display:
                 setattr(prop, n, self.display[n])
         return m
+
+
+class TorusDetector(OpticalElement):
+    r'''A detector shaped like a torus, e.g. following a Rowland torus exactly.
+
+    The torus has the local y axis as symmetry axis, see
+    `~marxs.design.RowlandTorus` for the definition of ``R`` and ``r`` and
+    of the angles ``theta`` and ``phi`` on the torus surface. Compared to
+    `CircularDetector.from_rowland`, which approximates the torus with a tube,
+    this detector has the exact shape of the torus.
+
+    Rays are traced forward only, i.e. the intersection point is the first
+    intersection of the ray with the detector after the current position
+    of the photon. Processing photons adds the following columns:
+
+    - ``det_theta``, ``det_phi``: Event position on the torus in radian
+    - ``detpix_x``, ``detpix_y``: Event position in pixels, measured along
+      the arc of the Rowland circle and perpendicular to it. Both are 0 at
+      the center of the ``theta`` and ``phi`` range.
+
+    Parameters
+    ----------
+    R : float
+        Radius of the torus.
+    r : float
+        Radius of the tube (the Rowland circle).
+    theta, phi : list of two floats
+        Range of the detector in theta and phi (in radian). Ranges can cross
+        the discontinuity at :math:`\pm\pi`, e.g. ``[3., -3.]`` is a small
+        detector around ``theta = pi``. The default is the full torus.
+    pixsize : float
+        size of pixels in mm
+    inside : bool
+        If ``True`` (the default), the detector is hit by photons coming from
+        inside the tube; those are photons that cross the Rowland circle.
+        If ``False``, only photons coming from outside the tube are detected.
+    position, orientation, zoom, pos4d : see description of `pos4d`
+        ``zoom`` should be 1; the size is set by ``R`` and ``r``.
+    '''
+    loc_coos_name = ['det_theta', 'det_phi']
+
+    detpix_name = ['detpix_x', 'detpix_y']
+    '''name for output columns that contain this pixel number.'''
+
+    display = {'color': (1.0, 1.0, 0.),
+               'opacity': 0.7}
+
+    def __init__(self, R, r, pixsize=1, **kwargs):
+        self.R = R
+        self.r = r
+        self.pixsize = pixsize
+        self.theta = kwargs.pop('theta', [-np.pi, np.pi])
+        self.phi = kwargs.pop('phi', [-np.pi, np.pi])
+        self.inwards = kwargs.pop('inside', True)
+        super(TorusDetector, self).__init__(**kwargs)
+
+    @classmethod
+    def from_rowland(cls, rowland, **kwargs):
+        '''Generate a `TorusDetector` with the shape of a `RowlandTorus`.
+
+        Parameters
+        ----------
+        rowland : `~marxs.design.RowlandTorus`
+            The detector is constructed to follow this torus.
+        kwargs :
+            All other parameters are passed to `TorusDetector`.
+        '''
+        return cls(rowland.R, rowland.r, pos4d=rowland.pos4d, **kwargs)
+
+    @staticmethod
+    def _in_range(angle, anglerange):
+        return ((angle - anglerange[0]) % (2. * np.pi)) <= anglediff(anglerange)
+
+    def _center(self, anglerange):
+        return anglerange[0] + anglediff(anglerange) / 2.
+
+    def intersect(self, dir, pos):
+        '''Calculate the intersection point between a ray and the element
+
+        Parameters
+        ----------
+        dir : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of the direction of the ray
+        pos : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of a point on the ray
+
+        Returns
+        -------
+        intersect :  boolean array of length N
+            ``True`` if an intersection point is found.
+        interpos : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of the intersection point. Values are set
+            to ``np.nan`` is no intersecton point is found.
+        interpos_local : `numpy.ndarray` of shape (N, 2)
+            theta, phi coordiantes (in the local frame) of the intersection
+            point.
+        '''
+        dir = np.dot(self.invpos4d, dir.T).T
+        pos = np.dot(self.invpos4d, pos.T).T
+        t = intersect_line_torus(dir, pos, self.R, self.r)
+        # All candidate points, shape (N, 4, 3)
+        xyz = h2e(pos, 'pos')[:, None, :] + t[:, :, None] * dir[:, None, :3]
+        # gradient points outwards of the tube
+        factor = 4. * ((xyz**2).sum(axis=-1) + self.R**2 - self.r**2)
+        gradient = factor[:, :, None] * xyz
+        gradient[:, :, [0, 2]] -= 8. * self.R**2 * xyz[:, :, [0, 2]]
+        outwards = np.einsum('ijk,ik->ij', gradient, dir[:, :3])
+        phi = np.arctan2(xyz[:, :, 2], xyz[:, :, 0])
+        theta = np.arctan2(xyz[:, :, 1], np.sqrt(xyz[:, :, 0]**2 + xyz[:, :, 2]**2) - self.R)
+        with np.errstate(invalid='ignore'):
+            valid = ((t >= 0) & (self._inwardsoutwards * outwards >= 0) &
+                     self._in_range(theta, self.theta) & self._in_range(phi, self.phi))
+        intersect = valid.any(axis=1)
+        # t is sorted, so the first valid entry is the first intersection
+        ind = np.argmax(valid, axis=1)
+        rows = np.arange(len(ind))
+        interpos = np.empty_like(pos)
+        interpos[:] = np.nan
+        interpos[intersect, :3] = xyz[rows, ind][intersect]
+        interpos[intersect, 3] = 1
+        interpos = np.dot(self.pos4d, interpos.T).T
+        interpos_local = np.empty((pos.shape[0], 2))
+        interpos_local[:] = np.nan
+        interpos_local[intersect, 0] = theta[rows, ind][intersect]
+        interpos_local[intersect, 1] = phi[rows, ind][intersect]
+        return intersect, interpos, interpos_local
+
+    @property
+    def _inwardsoutwards(self):
+        'Transform the self.inwards bool into [-1, +1]'
+        if self.inwards:
+            return 1.
+        else:
+            return -1.
+
+    def process_photons(self, photons):
+        intersect, interpos, inter_local = self.intersect(np.asarray(photons['dir']),
+                                                          np.asarray(photons['pos']))
+        self.add_output_cols(photons, self.loc_coos_name + self.detpix_name)
+        # Add ID number to ID col, if requested
+        if self.id_col is not None:
+            photons[self.id_col][intersect] = self.id_num
+        # Set position in different coordinate systems
+        photons['pos'][intersect] = interpos[intersect]
+        theta = inter_local[intersect, 0]
+        phi = inter_local[intersect, 1]
+        photons[self.loc_coos_name[0]][intersect] = theta
+        photons[self.loc_coos_name[1]][intersect] = phi
+        dtheta = (theta - self._center(self.theta) + np.pi) % (2 * np.pi) - np.pi
+        dphi = (phi - self._center(self.phi) + np.pi) % (2 * np.pi) - np.pi
+        photons[self.detpix_name[0]][intersect] = dtheta * self.r / self.pixsize
+        photons[self.detpix_name[1]][intersect] = dphi * (self.R + self.r * np.cos(theta)) / self.pixsize
+        return photons
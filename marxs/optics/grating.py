@@ -1,7 +1,12 @@
 '''Gratings and efficiency files'''
+import hashlib
+import os
+import warnings
 
 import numpy as np
 from transforms3d import axangles
+from astropy.config.paths import get_cache_dir
+from astropy.extern import six
 
 from ..math.pluecker import *
 from ..math.utils import norm_vector
@@ -59,6 +64,71 @@ def constant_order_factory(order = 1):
     return select_constant_order
 
 
+def _grid_index(grid, x, interpolate=False):
+    '''Locate values on a sorted grid.
+
+    Parameters
+    ----------
+    grid : np.array
+        Sorted grid points.
+    x : np.array
+        Values to locate.
+    interpolate : bool
+        If ``False``, return the index of the nearest grid point. If ``True``,
+        return the index of the grid point below ``x`` and the weight of the
+        grid point above for linear interpolation. Values outside of the grid
+        are assigned to the first or last grid point.
+
+    Returns
+    -------
+    ind : np.array of int
+        Index into ``grid``.
+    weight : np.array
+        Weight of ``ind + 1`` for linear interpolation (only returned
+        for ``interpolate=True``).
+    '''
+    x = np.asanyarray(x, dtype=float)
+    if len(grid) == 1:
+        ind = np.zeros(x.shape, dtype=int)
+        return (ind, np.zeros(x.shape)) if interpolate else ind
+    # ind is the index of the grid point above x, i.e. grid[ind - 1] <= x < grid[ind]
+    ind = np.clip(np.searchsorted(grid, x, side='right'), 1, len(grid) - 1)
+    low = grid[ind - 1]
+    high = grid[ind]
+    if interpolate:
+        weight = np.clip((x - low) / (high - low), 0., 1.)
+        return ind - 1, weight
+    else:
+        # Pick the lower value on ties, just like np.argmin(np.abs(grid - x)).
+        return np.where(np.abs(x - low) <= np.abs(high - x), ind - 1, ind)
+
+
+def _sample_orders(prob):
+    '''Draw one order per photon from a table of order probabilities.
+
+    Parameters
+    ----------
+    prob : np.array of shape (N, M)
+        Probability for each of N photons to be diffracted into each of M orders.
+        The probabilities do not have to be normalized.
+
+    Returns
+    -------
+    orderind : np.array of shape (N, )
+        Index of the selected order.
+    totalprob : np.array of shape (N, )
+        Probability to be diffracted into any order.
+    '''
+    totalprob = np.sum(prob, axis=1)
+    cumprob = np.cumsum(prob, axis=1)
+    rand = np.random.rand(prob.shape[0]) * totalprob
+    # Inverse CDF: The selected order is the first one with cumprob > rand.
+    orderind = np.sum(cumprob <= rand[:, None], axis=1)
+    # Rounding could give an index beyond the last order for rand close to 1.
+    orderind = np.clip(orderind, 0, prob.shape[1] - 1)
+    return orderind, totalprob
+
+
 class EfficiencyFile(object):
     '''Select grating order from a probability distribution in a data file.
 
@@ -73,27 +143,242 @@ class EfficiencyFile(object):
         Path to the efficiency file.
     orders : list
         List of orders in the file. Must match the number of columns with probabilities.
+    interpolate : bool
+        If ``False`` (the default) the probabilities in the row with the nearest energy
+        are used for each photon. If ``True``, the probabilities are interpolated linearly
+        between the two neighboring energies in the file.
     '''
-    def __init__(self, filename, orders):
-        dat = np.loadtxt(filename)
-        self.energy = dat[:, 0]
+    def __init__(self, filename, orders, interpolate=False):
+        dat = np.loadtxt(filename, ndmin=2)
         if len(orders) != (dat.shape[1] - 1):
             raise ValueError('orders has len={0}, but data files has {1} order columns.'.format(len(orders), dat.shape[1] - 1))
+        dat = dat[np.argsort(dat[:, 0]), :]
+        self.energy = dat[:, 0]
         self.orders = np.array(orders)
         self.prob = dat[:, 1:]
+        self.interpolate = interpolate
         # Probability to end up in any order
         self.totalprob = np.sum(self.prob, axis=1)
         # Cumulative probability for orders, normalized to 1.
         self.cumprob = np.cumsum(self.prob, axis=1) / self.totalprob[:, None]
 
+    def probabilities(self, energies):
+        '''Probability for photons to be diffracted into each order.
+
+        Parameters
+        ----------
+        energies : np.array
+            Photon energies in keV.
+
+        Returns
+        -------
+        prob : np.array of shape (N, M)
+            Probability for each of N photons to end up in each of the M `orders`.
+        '''
+        if self.interpolate:
+            ind, weight = _grid_index(self.energy, energies, interpolate=True)
+            upper = np.clip(ind + 1, 0, len(self.energy) - 1)
+            return ((1. - weight)[:, None] * self.prob[ind, :] +
+                    weight[:, None] * self.prob[upper, :])
+        else:
+            return self.prob[_grid_index(self.energy, energies), :]
+
     def __call__(self, energies, *args):
-        orderind = np.empty(len(energies), dtype=int)
-        ind = np.empty(len(energies), dtype=int)
-        for i, e in enumerate(energies):
-            ind[i] = np.argmin(np.abs(self.energy - e))
-            orderind[i] = np.min(np.nonzero(self.cumprob[ind[i]] > np.random.rand()))
-        return self.orders[orderind], self.totalprob[ind]
+        orderind, totalprob = _sample_orders(self.probabilities(np.atleast_1d(energies)))
+        return self.orders[orderind], totalprob
+
+
+class EfficiencyTable(object):
+    '''Select grating order from a table of probabilities on an energy and blaze angle grid.
 
+    The grating efficiency of e.g. CAT gratings depends strongly on the angle of
+    incidence (the blaze angle) as well as on the photon energy. This class holds a
+    table of the probabilities for each grating order on a grid of energies and blaze
+    angles. For each photon, the probabilities are interpolated bilinearly between
+    the four neighboring grid points and the order is drawn from the interpolated
+    probabilities. Photons outside of the grid are assigned the values from the edge
+    of the grid.
+
+    Parameters
+    ----------
+    energy : np.array of shape (E, )
+        Energy grid in keV.
+    blaze : np.array of shape (B, )
+        Grid of blaze angles in radian.
+    orders : np.array of shape (M, )
+        List of grating orders.
+    prob : np.array of shape (E, B, M)
+        Probability that a photon with a given energy and blaze angle is diffracted
+        into each of the orders. The probabilites do not have to add up to 1.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from marxs.optics import EfficiencyTable
+    >>> prob = np.zeros((2, 3, 2))
+    >>> prob[:, :, 0] = [[.1, .2, .3], [.2, .3, .4]]
+    >>> prob[:, :, 1] = .5
+    >>> eff = EfficiencyTable([.5, 1.], np.deg2rad([0., 1., 2.]), [0, -1], prob)
+    >>> order, p = eff(np.array([.75]), np.zeros(1), np.deg2rad([1.5]))
+    >>> print(p)
+    [0.8]
+    '''
+    def __init__(self, energy, blaze, orders, prob):
+        energy = np.asanyarray(energy, dtype=float)
+        blaze = np.asanyarray(blaze, dtype=float)
+        self.orders = np.asanyarray(orders)
+        prob = np.asanyarray(prob, dtype=float)
+        if prob.shape != (len(energy), len(blaze), len(self.orders)):
+            raise ValueError('prob must have shape (len(energy), len(blaze), len(orders)).')
+        ie = np.argsort(energy)
+        ib = np.argsort(blaze)
+        self.energy = energy[ie]
+        self.blaze = blaze[ib]
+        self.prob = prob[ie, :, :][:, ib, :]
+
+    @classmethod
+    def from_txt(cls, filename, orders):
+        '''Read a table from a text file.
+
+        The first column in the file contains energy values in keV, the second column
+        the blaze angle in radian, and all remaining columns the probability that a
+        photon with this energy and blaze angle is diffracted into the respective
+        order. There must be exactly one row for every combination of energy and blaze
+        angle on the grid.
+
+        Parameters
+        ----------
+        filename : string
+            Path to the efficiency file.
+        orders : list
+            List of orders in the file. Must match the number of columns with
+            probabilities.
+        '''
+        dat = np.loadtxt(filename, ndmin=2)
+        if len(orders) != (dat.shape[1] - 2):
+            raise ValueError('orders has len={0}, but data files has {1} order columns.'.format(len(orders), dat.shape[1] - 2))
+        energy, ie = np.unique(dat[:, 0], return_inverse=True)
+        blaze, ib = np.unique(dat[:, 1], return_inverse=True)
+        if len(dat) != len(energy) * len(blaze):
+            raise ValueError('Data file does not contain a regular energy x blaze angle grid.')
+        prob = np.empty((len(energy), len(blaze), len(orders)))
+        prob[:] = np.nan
+        prob[ie, ib, :] = dat[:, 2:]
+        if np.isnan(prob).any():
+            raise ValueError('Data file does not contain a regular energy x blaze angle grid.')
+        return cls(energy, blaze, orders, prob)
+
+    @classmethod
+    def read(cls, filename):
+        '''Read a table that was written with `write`.
+
+        Parameters
+        ----------
+        filename : string
+            Path to a ``.npz`` file.
+        '''
+        with np.load(filename) as dat:
+            return cls(dat['energy'], dat['blaze'], dat['orders'], dat['prob'])
+
+    def write(self, filename):
+        '''Save the table in the binary numpy ``.npz`` format.
+
+        Reading this file with `read` is much faster than parsing a large text file.
+
+        Parameters
+        ----------
+        filename : string
+            Path to the output file.
+        '''
+        np.savez(filename, energy=self.energy, blaze=self.blaze, orders=self.orders,
+                 prob=self.prob)
+
+    @classmethod
+    def from_file(cls, filename, orders, cache=True):
+        '''Read a text file with `from_txt` and cache the result.
+
+        When a text file is read for the first time, the table is saved in a
+        cache file. By default, the cache file has the same name as the text file
+        with the extension ``.npz`` added. If that location is not writable
+        (e.g. for shared or read-only data directories), the cache file is put
+        into the marxs directory in the astropy cache directory (see
+        `astropy.config.paths.get_cache_dir`). Later calls read the cache
+        file instead of the text file, unless the text file has been modified since the
+        cache file was written.
+
+        Parameters
+        ----------
+        filename : string
+            Path to the efficiency file.
+        orders : list
+            List of orders in the file.
+        cache : bool or string
+            Set to ``False`` to always read the text file. If ``cache`` is a
+            string, it is the directory used for the cache file.
+        '''
+        cachefiles = cls._cachefiles(filename, cache) if cache else []
+        for cachefile in cachefiles:
+            if (os.path.isfile(cachefile) and
+                (os.path.getmtime(cachefile) >= os.path.getmtime(filename))):
+                table = cls.read(cachefile)
+                if np.array_equal(table.orders, orders):
+                    return table
+        table = cls.from_txt(filename, orders)
+        for cachefile in cachefiles:
+            try:
+                dirname = os.path.dirname(cachefile)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                table.write(cachefile)
+                break
+            except (IOError, OSError):
+                pass
+        else:
+            if cache:
+                warnings.warn('Could not write cache file for {0}.'.format(filename))
+        return table
+
+    @staticmethod
+    def _cachefiles(filename, cache):
+        '''Possible locations of the cache file for ``filename``, in order.'''
+        filename = os.path.abspath(filename)
+        # Cache files in a shared directory need unique names.
+        name = '{0}.{1}.npz'.format(os.path.basename(filename),
+                                    hashlib.sha1(filename.encode('utf-8')).hexdigest()[:12])
+        if isinstance(cache, six.string_types):
+            return [os.path.join(cache, name)]
+        return [filename + '.npz', os.path.join(get_cache_dir(), 'marxs', name)]
+
+    def probabilities(self, energies, blaze):
+        '''Probability for photons to be diffracted into each order.
+
+        Parameters
+        ----------
+        energies : np.array
+            Photon energies in keV.
+        blaze : np.array
+            Blaze angle in radian.
+
+        Returns
+        -------
+        prob : np.array of shape (N, M)
+            Probability for each of N photons to end up in each of the M `orders`.
+        '''
+        ie, we = _grid_index(self.energy, energies, interpolate=True)
+        ib, wb = _grid_index(self.blaze, blaze, interpolate=True)
+        ie1 = np.clip(ie + 1, 0, len(self.energy) - 1)
+        ib1 = np.clip(ib + 1, 0, len(self.blaze) - 1)
+        we = we[:, None]
+        wb = wb[:, None]
+        return ((1. - we) * (1. - wb) * self.prob[ie, ib, :] +
+                (1. - we) * wb * self.prob[ie, ib1, :] +
+                we * (1. - wb) * self.prob[ie1, ib, :] +
+                we * wb * self.prob[ie1, ib1, :])
+
+    def __call__(self, energies, polarization, blaze):
+        orderind, totalprob = _sample_orders(self.probabilities(np.atleast_1d(energies),
+                                                                np.atleast_1d(blaze)))
+        return self.orders[orderind], totalprob
 
 
 class FlatGrating(FlatOpticalElement):
@@ -170,6 +455,7 @@ class FlatGrating(FlatOpticalElement):
         self.groove4d = axangles.axangle2aff(self.geometry['e_x'][:3], self.groove_ang)
         self.geometry['e_groove'] = np.dot(self.groove4d, self.geometry['e_z'])
         self.geometry['e_perp_groove'] = np.dot(self.groove4d, self.geometry['e_y'])
+        self.reset_derived_geometry()
 
     def d(self, intercoos):
         '''Method that returns the grating constant at given positions.
@@ -186,21 +472,22 @@ class FlatGrating(FlatOpticalElement):
 
     def diffract_photons(self, photons, intersect, interpos, intercoos):
         '''Vectorized implementation'''
-        p = norm_vector(h2e(photons['dir'].data[intersect]))
-        n = self.geometry['plane'][:3]
-        l = h2e(self.geometry['e_groove'])
+        p = norm_vector(h2e(np.asarray(photons['dir'])[intersect], 'dir'))
+        g = self.derived_geometry
+        n = g['normal']
+        l = g['e_groove']
         # Minus sign here because we want n, l, d to be a right-handed coordinate system
-        d = -h2e(self.geometry['e_perp_groove'])
+        d = -g['e_perp_groove']
 
-        wave = energy2wave / photons['energy'].data[intersect]
+        wave = energy2wave / np.asarray(photons['energy'])[intersect]
         # calculate angle between normal and (ray projected in plane perpendicular to groove)
         # -> this is the blaze angle
         p_perp_to_grooves = norm_vector(p - np.dot(p, l)[:, np.newaxis] * l)
         # Use abs here so that blaze angle is always in 0..pi/2
         # independent of the relative orientation of p and n.
         blazeangle = np.arccos(np.abs(np.dot(p_perp_to_grooves, n)))
-        m, prob = self.order_selector(photons['energy'].data[intersect],
-                                      photons['polarization'].data[intersect],
+        m, prob = self.order_selector(np.asarray(photons['energy'])[intersect],
+                                      np.asarray(photons['polarization'])[intersect],
                                       blazeangle)
 
         # The idea to calculate the components in the (d,l,n) system separately
@@ -240,7 +527,7 @@ class CATGrating(FlatGrating):
         convention is only meaningful if the photons do not arrive perpendicular to the grating.
         '''
         # Minus sign here because we want n, l, d to be a right-handed coordinate system
-        d = -h2e(self.geometry['e_perp_groove'])
+        d = -self.derived_geometry['e_perp_groove']
         dotproduct = np.dot(p, d)
         sign = np.sign(dotproduct)
         sign[sign == 0] = 1
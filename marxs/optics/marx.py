@@ -10,7 +10,7 @@
 '''
 import os
 import numpy as np
-from astropy.table import Table, Column, join
+from astropy.table import Table, Column
 from astropy.extern import six
 
 from ..math.pluecker import h2e, e2h
@@ -30,6 +30,52 @@ class MarxError(Exception):
     pass
 
 
+def photon_attr_dtype(ffi):
+    '''numpy dtype that matches the memory layout of ``Marx_Photon_Attr_Type``.
+
+    Only those fields of the C struct that are used by marxs are part of the
+    dtype, but the offsets and the itemsize are taken from the compiled
+    struct, so an array of this dtype can be used as a view into an array of
+    C structs.
+
+    Parameters
+    ----------
+    ffi : ``cffi.FFI`` instance
+        FFI object that knows the definition of ``Marx_Photon_Attr_Type``.
+    '''
+    fields = [('energy', np.float64, ()),
+              ('x', np.float64, (3, )),
+              ('p', np.float64, (3, )),
+              ('arrival_time', np.float64, ()),
+              ('flags', np.uintc, ()),
+              ('mirror_shell', np.uintc, ()),
+              ('tag', np.uintc, ())]
+    structname = 'Marx_Photon_Attr_Type'
+    return np.dtype({'names': [f[0] for f in fields],
+                     'formats': [(f[1], f[2]) for f in fields],
+                     'offsets': [ffi.offsetof(structname, f[0]) for f in fields],
+                     'itemsize': ffi.sizeof(structname)})
+
+
+def photon_attr_array(ffi, cp, n):
+    '''View an array of ``Marx_Photon_Attr_Type`` as numpy structured array.
+
+    Values can be read and written for all photons at once without a loop in
+    Python. The returned array does not keep ``cp`` alive.
+
+    Parameters
+    ----------
+    ffi : ``cffi.FFI`` instance
+        FFI object that knows the definition of ``Marx_Photon_Attr_Type``.
+    cp : cdata ``Marx_Photon_Attr_Type[]`` or ``Marx_Photon_Attr_Type *``
+        Array of C structs.
+    n : int
+        Number of elements.
+    '''
+    dtype = photon_attr_dtype(ffi)
+    return np.frombuffer(ffi.buffer(cp, n * dtype.itemsize), dtype=dtype, count=n)
+
+
 class MarxMirror(OpticalElement, BaseAperture):
     '''Interface to MARX mirror module
 
@@ -62,9 +108,15 @@ class MarxMirror(OpticalElement, BaseAperture):
     parfile : string
         Path and filename of a MARX parameter file that sets all MARX
         parameters for the mirror model.
+    keep_beforemirror : bool
+        If ``True``, the values of ``pos``, ``dir``, ``energy``, and ``time``
+        before the mirror are kept in the photon list in columns with the
+        suffix ``_beforemirror``. Set to ``False`` to save memory if those
+        values are not needed.
     '''
 
     def __init__(self, parfile, **kwargs):
+        self.keep_beforemirror = kwargs.pop('keep_beforemirror', True)
         # If the state shared between different object that use the s
         # same C module? In that case I need to add a lock so that only
         # one object of this class can exist at any one time.
@@ -89,28 +141,21 @@ class MarxMirror(OpticalElement, BaseAperture):
         # Arrays assigned here in python need to keep a reference
         # somewhere, otherwise they would be garbage collected
         # and the pointer would suddenly be invalid.
-        # To do so, this function adds them to the photons table header.
-        # If this turns out to be too slow, then I have to move it to
-        # Cython that can access the native numpy array memory.
+        # To do so, this function returns them in a dictionary.
         n = len(photons)
         cp = ffi.new('Marx_Photon_Attr_Type[]', n)
         keep_cffi_pointers = {}
         keep_cffi_pointers['cp'] = cp
-        for i in range(n):
-            cp[i].energy = photons['energy'][i]
-            pos = h2e(photons['pos'][i])
-            cp[i].x.x = pos[0]
-            cp[i].x.y = pos[1]
-            cp[i].x.z = pos[2]
-            dir = h2e(photons['dir'][i])
-            cp[i].p.x = dir[0]
-            cp[i].p.y = dir[1]
-            cp[i].p.z = dir[2]
-            cp[i].arrival_time = photons['time'][i]
         if 'tag' not in photons.colnames:
             photons.add_column(Column(name='tag', data=np.arange(n)))
-        for i, t in zip(range(n), photons['tag']):
-            cp[i].tag = t
+        attr = photon_attr_array(ffi, cp, n)
+        attr['energy'] = photons['energy']
+        attr['x'] = h2e(np.asarray(photons['pos']), 'pos')
+        attr['p'] = h2e(np.asarray(photons['dir']), 'dir')
+        attr['arrival_time'] = photons['time']
+        # Use the tag in C to identify the row, so that the results can be
+        # matched to the input photons by index.
+        attr['tag'] = np.arange(n)
 
         c_photon_list = ffi.new('Marx_Photon_Type *')
         c_photon_list.attributes = cp
@@ -119,13 +164,13 @@ class MarxMirror(OpticalElement, BaseAperture):
         c_photon_list.total_time = np.max(photons['time'])
         c_photon_list.start_time = np.min(photons['time'])
 
-        sorted_index = np.argsort(photons['energy'].data)
+        sorted_index = np.argsort(np.asarray(photons['energy']))
         sorted_index = np.ascontiguousarray(sorted_index, dtype=np.uintc)
         keep_cffi_pointers['sorted_index'] = sorted_index  # keep alive
         c_photon_list.sorted_index = ffi.cast('unsigned int*', sorted_index.ctypes.data)
 
-        sorted_energies = np.sort(photons['energy'].data)
-        sorted_energies = np.ascontiguousarray(sorted_energies, dtype=np.float)
+        sorted_energies = np.sort(np.asarray(photons['energy']))
+        sorted_energies = np.ascontiguousarray(sorted_energies, dtype=float)
         keep_cffi_pointers['sorted_energies'] = sorted_energies  # keep alive
         c_photon_list.sorted_energies = ffi.cast('double*', sorted_energies.ctypes.data)
 
@@ -137,46 +182,20 @@ class MarxMirror(OpticalElement, BaseAperture):
 
     @staticmethod
     def _c2table(c_photon_list):
-        '''
-
-        We'll first collect all the data in numpy arrays and make
-        a new table. Might not be the most efficient solution,
-        but should work for now.
-        Make work first, improve later.
+        '''Copy the photons that are still valid into a new table.
 
         To-Do: keep absorbed?
         '''
         n_valid = c_photon_list.num_sorted
-        cp = c_photon_list.attributes
-
-        energy = np.empty(n_valid)
-        time = np.empty(n_valid)
-        tag = np.empty(n_valid, dtype=int)
-        pos = np.empty((n_valid, 3))
-        dir = np.empty((n_valid, 3))
-        unreflected = np.empty(n_valid, dtype=bool)
-        vblocked = np.empty(n_valid, dtype=bool)
-        shell = np.empty(n_valid, dtype=int)
-
-        for i in range(n_valid):
-            energy[i] = cp[i].energy
-            pos[i, 0] = cp[i].x.x
-            pos[i, 1] = cp[i].x.y
-            pos[i, 2] = cp[i].x.z
-            dir[i, 0] = cp[i].p.x
-            dir[i, 1] = cp[i].p.y
-            dir[i, 2] = cp[i].p.z
-            time[i] = cp[i].arrival_time
-            tag[i] = cp[i].tag
-            unreflected[i] = cp[i].flags & marx.PHOTON_UNREFLECTED
-            vblocked[i] = cp[i].flags & marx.PHOTON_MIRROR_VBLOCKED
-            shell[i] = cp[i].mirror_shell
-
-        pos = e2h(pos, 1)
-        dir = e2h(dir, 0)
-        photons = Table([pos, dir, energy, time, tag,
-                         unreflected, vblocked, shell],
-                        names=['pos', 'dir', 'energy', 'time', 'tag',
+        attr = photon_attr_array(ffi, c_photon_list.attributes, n_valid)
+        flags = attr['flags']
+        photons = Table([e2h(attr['x'], 1), e2h(attr['p'], 0),
+                         attr['energy'].copy(), attr['arrival_time'].copy(),
+                         attr['tag'].astype(int),
+                         (flags & marx.PHOTON_UNREFLECTED) != 0,
+                         (flags & marx.PHOTON_MIRROR_VBLOCKED) != 0,
+                         attr['mirror_shell'].astype(int)],
+                        names=['pos', 'dir', 'energy', 'time', 'row',
                                'unreflected', 'mirror_vblocked', 'mirror_shell'])
         return photons
 
@@ -192,9 +211,26 @@ class MarxMirror(OpticalElement, BaseAperture):
     def process_photons(self, photons, verbose=0):
         self.add_colpos(photons)
         new_photons = self._process_photons_in_c(photons, verbose)
-        photons = join(new_photons, photons, keys='tag',
-                       uniq_col_name='{col_name}{table_name}',
-                       table_names=['', '_beforemirror'])
+        # Photons might be removed in the C code, so we need to match the
+        # output to the input rows. The C code does not add photons, so
+        # the new values can be scattered into columns of the input length.
+        rows = np.asarray(new_photons['row'])
+        valid = np.zeros(len(photons), dtype=bool)
+        valid[rows] = True
+        for n in new_photons.colnames:
+            if n == 'row':
+                continue
+            if n in photons.colnames:
+                if self.keep_beforemirror:
+                    photons.rename_column(n, n + '_beforemirror')
+                else:
+                    photons.remove_column(n)
+            col = np.zeros((len(photons), ) + new_photons[n].shape[1:],
+                           dtype=new_photons[n].dtype)
+            col[rows] = new_photons[n]
+            photons[n] = col
+        if not valid.all():
+            photons = photons[valid]
         photons['probability'][photons['unreflected'] | photons['mirror_vblocked']] = 0
         return photons
 
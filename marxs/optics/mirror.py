@@ -1,10 +1,9 @@
 import numpy as np
 
-from transforms3d.axangles import axangle2mat
-
 from .base import FlatOpticalElement
 from ..math.pluecker import *
 from ..math.utils import norm_vector
+from ..math.rotations import axangle2mat
 
 class PerfectLens(FlatOpticalElement):
     '''This describes an infinitely large lens that focusses all rays exactly.
@@ -28,8 +27,8 @@ class PerfectLens(FlatOpticalElement):
     def process_photons(self, photons):
         # A ray through the center is not broken.
         # So, find out where a central ray would go.
-        focuspoints = h2e(self.geometry['center']) + self.focallength * norm_vector(h2e(photons['dir']))
-        photons['dir'] = e2h(focuspoints - h2e(photons['pos']), 0)
+        focuspoints = h2e(self.geometry['center']) + self.focallength * norm_vector(h2e(np.asarray(photons['dir']), 'dir'))
+        photons['dir'] = e2h(focuspoints - h2e(np.asarray(photons['pos']), 'pos'), 0)
         return photons
 
 class ThinLens(FlatOpticalElement):
@@ -75,20 +74,43 @@ class ThinLens(FlatOpticalElement):
         self.focallength = kwargs.pop('focallength')
         super(ThinLens, self).__init__(**kwargs)
 
-    def process_photon(self, dir, pos, energy, polerization):
+    def _focus(self, dir, pos):
+        '''Intersect rays with the lens and change their direction.
+
+        Parameters
+        ----------
+        dir : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of the direction of the ray
+        pos : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of a point on the ray
+
+        Returns
+        -------
+        dir : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of the new direction of the ray
+        interpos : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of the intersection point.
+        '''
         intersect, h_intersect, loc_inter = self.intersect(dir, pos)
-        distance = distance_point_point(h_intersect,
-                                        self.geometry['center'][np.newaxis, :])
-        if distance == 0.:
-            # No change of direction for rays through the origin.
-            # Need to special case this, because rotation axis is not defined
-            # in this case.
-            new_ray_dir = h2e(dir)
-        else:
-            delta_angle = distance / self.focallength
-            e_rotation_axis = np.cross(dir[:3], (h_intersect - self.geometry['center'])[:3])
-            # This is the first step that cannot be done on a stack of photons
-            # Could have a for "i in photons", but might come up with better way
-            rot = axangle2mat(e_rotation_axis, delta_angle)
-            new_ray_dir = np.dot(rot, dir[:3])
-        return e2h(new_ray_dir, 0), h_intersect, energy, polerization, 1.
+        vec_center_inter = h2e(h_intersect, 'pos') - self.derived_geometry['center']
+        distance = np.linalg.norm(vec_center_inter, axis=1)
+        new_ray_dir = dir[:, :3].copy()
+        # No change of direction for rays through the origin.
+        # Need to special case this, because rotation axis is not defined
+        # in this case. (nan != 0, so rays that miss the lens end up with
+        # nan directions as before.)
+        rotate = distance != 0.
+        # Rotation axis is chosen such that rays are always bend towards the center.
+        e_rotation_axis = np.cross(vec_center_inter[rotate], dir[rotate, :3])
+        rot = axangle2mat(e_rotation_axis, distance[rotate] / self.focallength)
+        new_ray_dir[rotate] = np.einsum('...ij,...j', rot, dir[rotate, :3])
+        return e2h(new_ray_dir, 0), h_intersect
+
+    def process_photon(self, dir, pos, energy, polerization):
+        new_dir, h_intersect = self._focus(dir[np.newaxis, :], pos[np.newaxis, :])
+        return new_dir[0], h_intersect[0], energy, polerization, 1.
+
+    def process_photons(self, photons):
+        photons['dir'], photons['pos'] = self._focus(np.asarray(photons['dir']),
+                                                     np.asarray(photons['pos']))
+        return photons
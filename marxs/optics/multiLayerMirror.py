@@ -15,6 +15,11 @@ class MultiLayerMirror(FlatOpticalElement):
     of incidence.
     There is a default size of 49mm by 24mm, but this can be overridden by
     entering a different value for zoom.
+    Photons that miss the mirror are absorbed (their probability is set to 0).
+    As for other flat optical elements, the intersection point in the local
+    coordinate system of the mirror (in mm) is written to the output columns
+    ``y`` and ``z`` (see ``loc_coos_name``); those columns are ``np.nan`` for
+    photons that miss the mirror.
 
     Provide reflectivity data in a file with columns:
 
@@ -37,6 +42,16 @@ class MultiLayerMirror(FlatOpticalElement):
         path, filename, and .txt to a text file containing a table with photon energy
         and fraction polarization for the light used to test the mirrors and create the
         reflectivity file
+    refl_grid : tuple ``(n_y, energy)`` or ``None``
+        Both data files are read once when the mirror is initialized. By default,
+        the reflectivity for each photon is interpolated from the values in the
+        files. Alternatively, the reflectivity can be precomputed on a regular
+        grid of ``n_y`` points along the local y axis and the energies in
+        ``energy`` (which must be evenly spaced, in keV). Both need at least two
+        points. Photons outside of the
+        grid use the values at the edge of the grid. Looking up the values
+        on a regular grid is faster for large photon numbers, but the
+        grid has to be fine enough to resolve the reflectivity peak.
     '''
 
     display = {'color': (0., 1., 0.),
@@ -46,80 +61,134 @@ class MultiLayerMirror(FlatOpticalElement):
     def __init__(self, reflFile, testedPolarization, **kwargs):
         self.fileName = reflFile
         self.polFile = testedPolarization
+        self.refl_grid = kwargs.pop('refl_grid', None)
+        if self.refl_grid is not None:
+            n_y, egrid = self.refl_grid
+            if (n_y < 2) or (len(egrid) < 2):
+                raise ValueError('refl_grid needs at least 2 grid points in y and in energy.')
         if ('zoom' not in kwargs) and ('pos4d' not in kwargs):
             kwargs['zoom'] = np.array([1, 24.5, 12])   # in mm
         super(MultiLayerMirror, self).__init__(**kwargs)
 
-    def process_photons(self, photons):
-        # NOTE: This function could be split up into smaller, more readable functions, but I
-        # have done my best to clearly label the specific calculations in the comments.
+        reflectFile = ascii.read(self.fileName)
+        ind = np.argsort(reflectFile['X(mm)'])
+        self._refl = dict((col, np.asarray(reflectFile[col], dtype=float)[ind])
+                          for col in ['X(mm)', 'Peak lambda', 'Peak', 'FWHM(nm)'])
+        polarizedFile = ascii.read(self.polFile)
+        ind = np.argsort(polarizedFile['Photon energy'])
+        self._pol_energy = np.asarray(polarizedFile['Photon energy'], dtype=float)[ind] / 1000
+        self._pol_fraction = np.asarray(polarizedFile['Polarization'], dtype=float)[ind]
+
+    _refl_grid_cache = (None, None)
+    _derived_attributes = ('_refl_grid_cache', )
+
+    def _interp_reflectivity(self, y, energy):
+        # put the position values from the reflection file into local coordinates
+        local_coords_in_file = self._refl['X(mm)'] / self.derived_geometry['size_y'] - 1
+        # find reflectivity adjustment due to polarization of light in reflectivity testing
+        tested_polarized_fraction = np.interp(energy, self._pol_energy, self._pol_fraction)
+        # interpolate 'Peak lambda', 'Peak' [reflectivity], and 'FWHM(nm)' to the actual photon positions
+        peak_wavelength = np.interp(y, local_coords_in_file, self._refl['Peak lambda'])
+        max_refl = np.interp(y, local_coords_in_file, self._refl['Peak']) / tested_polarized_fraction
+        spread_refl = np.interp(y, local_coords_in_file, self._refl['FWHM(nm)'])
 
-        # for photons that do not reach the mirror, set probability to zero
-        doesIntersect, intersection, local = self.intersect(photons['dir'], photons['pos'])
-        photons['probability'] *= doesIntersect
+        wavelength = 1.23984282 / energy   # wavelength is in nm assuming energy is in keV
+        c_squared = (spread_refl ** 2) / (8. * np.log(2))   # the standard deviation squared of the Gaussian reflectivity functions of each photon's wavelength
+        c_is_zero = (c_squared == 0)   # skip the case when there is no Gaussian (this is assumed to just be the zero function)
 
+        refl_prob = np.zeros(len(wavelength))
+        refl_prob[~c_is_zero] = max_refl[~c_is_zero] * np.exp(-((wavelength[~c_is_zero] - peak_wavelength[~c_is_zero]) ** 2) / (2 * c_squared[~c_is_zero]))
+        return refl_prob
+
+    def _grid_reflectivity(self, y, energy):
+        n_y, egrid = self.refl_grid
+        egrid = np.asarray(egrid, dtype=float)
+        key = (self.derived_geometry['size_y'], n_y, egrid.tobytes())
+        if self._refl_grid_cache[0] != key:
+            ygrid = np.linspace(-1, 1, n_y)
+            yy, ee = np.meshgrid(ygrid, egrid, indexing='ij')
+            grid = self._interp_reflectivity(yy.flatten(), ee.flatten()).reshape(yy.shape)
+            self._refl_grid_cache = (key, grid)
+        grid = self._refl_grid_cache[1]
+        # fractional index into the regular grid
+        iy = np.clip((y + 1.) / 2. * (n_y - 1), 0, n_y - 1)
+        ie = np.clip((energy - egrid[0]) / (egrid[-1] - egrid[0]) * (len(egrid) - 1),
+                     0, len(egrid) - 1)
+        iy0 = np.minimum(iy.astype(int), n_y - 2)
+        ie0 = np.minimum(ie.astype(int), len(egrid) - 2)
+        wy = iy - iy0
+        we = ie - ie0
+        return ((1 - wy) * (1 - we) * grid[iy0, ie0] + wy * (1 - we) * grid[iy0 + 1, ie0] +
+                (1 - wy) * we * grid[iy0, ie0 + 1] + wy * we * grid[iy0 + 1, ie0 + 1])
+
+    def reflectivity(self, y, energy):
+        '''Reflectivity for the better reflecting (s) polarization direction.
+
+        Parameters
+        ----------
+        y : np.array
+            Position along the local y axis in the coordinate system of the
+            mirror (the mirror extends from -1 to 1).
+        energy : np.array
+            Photon energy in keV.
+
+        Returns
+        -------
+        refl : np.array
+            Reflectivity in percent, corrected for the polarization of the
+            light used in the reflectivity testing.
+        '''
+        y = np.asarray(y, dtype=float)
+        energy = np.asarray(energy, dtype=float)
+        if self.refl_grid is None:
+            return self._interp_reflectivity(y, energy)
+        else:
+            return self._grid_reflectivity(y, energy)
+
+    def specific_process_photons(self, photons, intersect, interpos, intercoos):
         # save the direction of the incoming photons as beam_dir
-        beam_dir = (photons['dir'][:,0:3]).copy()
-        beam_dir /= np.linalg.norm(beam_dir, axis=1)[:, np.newaxis]
+        dir = np.asarray(photons['dir'])[intersect]
+        beam_dir = h2e(dir, 'dir') / np.linalg.norm(dir[:, :3], axis=1)[:, np.newaxis]
 
         # reflect the photons (change direction) by transforming to local coordinates
-        directions = photons['dir']
-        pos4d_inv = np.linalg.inv(self.pos4d)
-        directions = directions.T
-        directions = np.dot(pos4d_inv, directions)
-        directions[0,:] *= -1
-        directions = np.dot(self.pos4d, directions)
-        photons['dir'] = directions.T
+        directions = np.dot(self.invpos4d, dir.T)
+        directions[0, :] *= -1
+        directions = np.dot(self.pos4d, directions).T
 
         # split polarization into s and p components
         # v_1 is s polarization (perpendicular to plane of incidence), v_2 is p polarization (in the plane of incidence)
-        v_1 = np.cross(beam_dir, self.geometry['e_x'][0:3])
+        v_1 = np.cross(beam_dir, self.derived_geometry['e_x'])
         v_1 /= np.linalg.norm(v_1, axis=1)[:, np.newaxis]
         v_2 = np.cross(beam_dir, v_1)
         # find polarization component in each direction, v1 and v2
-        polarization = (photons['polarization'][:,0:3]).copy()
+        polarization = np.array(photons['polarization'])[intersect]
         # find the dot product of v1 and v2 for each photon with each photon's polarization vector
-        p_v_1 = np.einsum('ij,ij->i', polarization, v_1)   # the cosines between the pairs of vectors (these are unit vectors)
-        p_v_2 = np.einsum('ij,ij->i', polarization, v_2)
+        p_v_1 = np.einsum('ij,ij->i', polarization[:, :3], v_1)   # the cosines between the pairs of vectors (these are unit vectors)
+        p_v_2 = np.einsum('ij,ij->i', polarization[:, :3], v_2)
 
         # adjust polarization vectors after reflection
         # find new v_2
-        new_beam_dir = (photons['dir'][:,0:3]).copy()
-        new_beam_dir /= np.linalg.norm(new_beam_dir, axis=1)[:, np.newaxis]
+        new_beam_dir = directions[:, :3] / np.linalg.norm(directions[:, :3], axis=1)[:, np.newaxis]
         new_v_2 = np.cross(new_beam_dir, v_1)
-        photons['polarization'][:,0:3] = -p_v_1[:, np.newaxis] * v_1 + p_v_2[:, np.newaxis] * new_v_2
-
-        # set position to intersection point
-        photons['pos'] = intersection
-
-        # read in correct reflecting probability file, now in table format
-        reflectFile = ascii.read(self.fileName)
-
-        # find reflectivity adjustment due to polarization of light in reflectivity testing
-        polarizedFile = ascii.read(self.polFile)
-        tested_polarized_fraction = np.interp(photons['energy'], polarizedFile['Photon energy'] / 1000, polarizedFile['Polarization'])
-
-        # find probability of being reflected due to position
-        # put the photon positions and the position values from the reflection file into local coordinates
-        local_intersection = h2e((np.dot(pos4d_inv, intersection.T)).T)
-        local_coords_in_file = reflectFile['X(mm)'] / np.linalg.norm(self.geometry['v_y']) - 1
-        # interpolate 'Peak lambda', 'Peak' [reflectivity], and 'FWHM(nm)' to the actual photon positions
-        peak_wavelength = np.interp(local_intersection[:,1], local_coords_in_file, reflectFile['Peak lambda'])
-        max_refl = np.interp(local_intersection[:,1], local_coords_in_file, reflectFile['Peak']) / tested_polarized_fraction
-        spread_refl = np.interp(local_intersection[:,1], local_coords_in_file, reflectFile['FWHM(nm)'])
+        polarization[:, :3] = -p_v_1[:, np.newaxis] * v_1 + p_v_2[:, np.newaxis] * new_v_2
 
-        wavelength = 1.23984282 / photons['energy']   # wavelength is in nm assuming energy is in keV
-        c_squared = (spread_refl ** 2) / (8. * np.log(2))   # the standard deviation squared of the Gaussian reflectivity functions of each photon's wavelength
-        c_is_zero = (c_squared == 0)   # skip the case when there is no Gaussian (this is assumed to just be the zero function)
-
-        refl_prob = np.zeros(len(wavelength))
-        refl_prob[~c_is_zero] = max_refl[~c_is_zero] * np.exp(-((wavelength[~c_is_zero] - peak_wavelength[~c_is_zero]) ** 2) / (2 * c_squared[~c_is_zero]))
+        # find probability of being reflected due to position and energy
+        # intercoos is in mm, the reflectivity uses coordinates where the mirror goes from -1 to 1.
+        local_y = intercoos[intersect, 0] / self.derived_geometry['size_y']
+        refl_prob = self.reflectivity(local_y, np.asarray(photons['energy'])[intersect])
 
         # find probability of being reflected due to polarization
         # v_1 is s polarization (perpendicular to plane of incidence), the better reflecting polarization
-        refl_prob[~c_is_zero] *= np.einsum('ij,ij->i', polarization[~c_is_zero], v_1[~c_is_zero]) ** 2   # dot products of unit vectors
+        refl_prob *= p_v_1 ** 2   # dot products of unit vectors
         refl_prob[np.isnan(refl_prob)] = 0
-        # multiply probability by probability of reflection
-        photons['probability'] *= refl_prob / 100
 
+        return {'dir': directions, 'polarization': polarization,
+                'probability': refl_prob / 100}
+
+    def process_photons(self, photons, intersect=None, interpos=None, intercoos=None):
+        if (interpos is None) or (intercoos is None) or (intersect is None):
+            intersect, interpos, intercoos = self.intersect(np.asarray(photons['dir']), np.asarray(photons['pos']))
+        photons = super(MultiLayerMirror, self).process_photons(photons, intersect, interpos, intercoos)
+        # photons that do not reach the mirror are lost
+        photons['probability'][~intersect] = 0
         return photons
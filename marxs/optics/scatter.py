@@ -41,16 +41,16 @@ class RadialMirrorScatter(OpticalElement):
         # change this line, if you want to process only some photons (intersect et al.)
         n = len(photons)
         center = self.pos4d[:-1, -1]
-        radial = h2e(photons['pos'].data) - center
-        perpplane = np.cross(h2e(photons['dir'].data), radial)
+        radial = h2e(np.asarray(photons['pos']), 'pos') - center
+        perpplane = np.cross(h2e(np.asarray(photons['dir']), 'dir'), radial)
         inplaneangle = np.random.normal(loc=0., scale=self.inplanescatter, size=n)
 
         rot = axangle2mat(perpplane, inplaneangle)
-        photons['dir'] = e2h(np.einsum('...ij,...i->...j', rot, h2e(photons['dir'])), 0)
+        photons['dir'] = e2h(np.einsum('...ij,...i->...j', rot, h2e(np.asarray(photons['dir']), 'dir')), 0)
 
         if self.perpplanescatter !=0: # Works for 0 too, but waste of time to run
             perpangle = np.random.normal(loc=0., scale=self.perpplanescatter, size=n)
             rot = axangle2mat(radial, perpangle)
-            photons['dir'] = e2h(np.einsum('...ij,...i->...j', rot, h2e(photons['dir'])), 0)
+            photons['dir'] = e2h(np.einsum('...ij,...i->...j', rot, h2e(np.asarray(photons['dir']), 'dir')), 0)
 
         return photons
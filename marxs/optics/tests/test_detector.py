@@ -2,7 +2,7 @@ import numpy as np
 from astropy.table import Table
 import transforms3d
 
-from ..detector import FlatDetector, CircularDetector
+from ..detector import FlatDetector, CircularDetector, TorusDetector
 from ...tests import closeornan
 from ...math.pluecker import h2e
 from ...design import RowlandTorus
@@ -153,3 +153,50 @@ def test_CircularDetector_from_Rowland():
     points = detcirc.parametric(phi)
     # Quartic < 1e5 is very close for these large values of r and R.
     assert np.max(np.abs(rowland.quartic(h2e(points)))) < 1e5
+
+def test_TorusDetector_from_Rowland():
+    '''Rays from the center of the Rowland circle hit the torus where expected.'''
+    rowland = RowlandTorus(R=6e4, r=5e4, position=[123., 345., -678.],
+                           orientation=transforms3d.euler.euler2mat(1, 2, 3, 'syxz'))
+    det = TorusDetector.from_rowland(rowland)
+    theta = np.array([0., 0.5, -2., 3.])
+    phi = np.array([0.1, -0.2, 0., 1.])
+    points = rowland.parametric(theta, phi)
+    centers = np.einsum('...ij,...j', rowland.pos4d,
+                        np.array([6e4 * np.cos(phi), np.zeros(4), 6e4 * np.sin(phi), np.ones(4)]).T)
+    dir = points - centers
+    intersect, interpos, inter_local = det.intersect(dir, centers)
+    assert np.all(intersect)
+    assert np.allclose(h2e(interpos), h2e(points))
+    assert np.allclose(inter_local, np.vstack([theta, phi]).T)
+    # Coming from outside, the same rays hit the other side of the tube first.
+    det = TorusDetector.from_rowland(rowland, inside=False)
+    intersect, interpos, inter_local = det.intersect(dir, centers - 3 * dir)
+    assert np.all(intersect)
+    assert np.allclose(inter_local[:, 1], phi)
+    assert np.allclose((inter_local[:, 0] - theta) % (2 * np.pi), np.pi)
+    # A photon with an invalid position is a miss and does not affect the others.
+    centers[1, :] = np.nan
+    intersect, interpos, inter_local = det.intersect(dir, centers - 3 * dir)
+    assert list(intersect) == [True, False, True, True]
+    assert np.all(np.isnan(interpos[1]))
+
+def test_TorusDetector_range():
+    '''Only hits within the detector range count.'''
+    det = TorusDetector(R=2., r=1., theta=[3., -3.], phi=[-0.1, 0.1], pixsize=0.01)
+    photons = Table({'pos': [[1.5, 0, 0, 1], [1.5, 0., 0., 1.], [2.5, 0., 0., 1.]],
+                     'dir': [[-1., 0, 0, 0], [0., 0, 1., 0], [1., 0., 0., 0.]],
+                     'energy': [1., 1., 1.], 'polarization': np.ones((3, 4)),
+                     'probability': [1., 1., 1.]})
+    start = np.array(photons['pos'])
+    photons = det(photons)
+    # first photon leaves the tube on the inner side
+    assert np.allclose(photons['pos'][0], [1., 0, 0, 1])
+    assert np.isclose(np.abs(photons['det_theta'][0]), np.pi)
+    assert np.isclose(photons['det_phi'][0], 0)
+    assert np.isclose(photons['detpix_x'][0], 0)
+    # second photon leaves the tube outside the phi range,
+    # third photon outside the theta range.
+    for i in [1, 2]:
+        assert np.all(photons['pos'][i] == start[i])
+        assert np.isnan(photons['det_theta'][i])
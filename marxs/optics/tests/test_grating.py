@@ -1,11 +1,14 @@
 from io import StringIO
+import os
 import numpy as np
+import pytest
 from numpy.random import random
 from astropy.table import Table
 from transforms3d import axangles
 
 from ..grating import (FlatGrating, CATGrating,
-                       constant_order_factory, uniform_efficiency_factory, EfficiencyFile)
+                       constant_order_factory, uniform_efficiency_factory, EfficiencyFile,
+                       EfficiencyTable)
 from ...math.pluecker import h2e
 from ... import energy2wave
 from ...utils import generate_test_photons
@@ -273,3 +276,92 @@ def test_grating_d_callable():
     p = grat(photons)
     # negative one has half the grating constant and thus twice the angle
     assert np.abs(p['dir'][1, 1] / p['dir'][0, 1] - 2 ) < 0.00001
+
+
+def test_EfficiencyFile_vs_loop():
+    '''Compare the vectorized sampling to a simple loop over photons.'''
+    data = StringIO(u"1. .1 .1 .1 .5\n.5 .1 .1 .1 .4\n1.5 0. .1 .0 .5")
+    eff = EfficiencyFile(data, [1, 0, -1, -2])
+    # unsorted input is sorted
+    assert np.all(eff.energy == [.5, 1., 1.5])
+    energies = np.array([0.1, .5, .74, .75, .76, 1.2, 1.25, 1.6, 3.])
+    np.random.seed(0)
+    orders, prob = eff(energies)
+    np.random.seed(0)
+    rand = np.random.rand(len(energies))
+    for i, e in enumerate(energies):
+        ind = np.argmin(np.abs(eff.energy - e))
+        assert prob[i] == eff.totalprob[ind]
+        assert orders[i] == eff.orders[np.min(np.nonzero(eff.cumprob[ind] > rand[i]))]
+
+
+def test_EfficiencyFile_interpolate():
+    data = StringIO(u".5 .1 .1 .1 .4\n1. .1 .1 .1 .5\n1.5 0. .1 .0 .5")
+    eff = EfficiencyFile(data, [1, 0, -1, -2], interpolate=True)
+    testout = eff(np.array([.2, .75, 1.25, 2.]))
+    assert np.allclose(testout[1], [.7, .75, .7, .6])
+    prob = eff.probabilities(np.array([1.25]))
+    assert np.allclose(prob, [[.05, .1, .05, .5]])
+
+    testout = eff(1.25 * np.ones(10000))
+    n = np.array([(testout[0] == o).sum() for o in [1, 0, -1, -2]])
+    assert np.allclose(n / 1e4, np.array([.05, .1, .05, .5]) / .7, atol=0.02)
+
+
+def test_EfficiencyTable():
+    '''Bilinear interpolation and sampling in energy and blaze angle.'''
+    prob = np.zeros((2, 3, 2))
+    prob[:, :, 0] = [[.1, .2, .3], [.2, .3, .4]]
+    prob[:, :, 1] = .5
+    # input grid does not need to be sorted
+    eff = EfficiencyTable([1., .5], [0., .2, .1], [0, -1], prob[::-1, [0, 2, 1], :])
+    assert np.allclose(eff.prob, prob)
+    p = eff.probabilities(np.array([.5, .75, 1., 2., .75]), np.array([0., .15, .1, .3, -1.]))
+    assert np.allclose(p[:, 0], [.1, .3, .3, .4, .15])
+    assert np.allclose(p[:, 1], .5)
+
+    np.random.seed(0)
+    order, totp = eff(.75 * np.ones(10000), np.zeros(10000), .15 * np.ones(10000))
+    assert np.allclose(totp, .8)
+    assert np.isclose((order == 0).mean(), .3 / .8, atol=0.02)
+    assert set(order) == set([0, -1])
+
+    with pytest.raises(ValueError) as e:
+        EfficiencyTable([1.], [0., 1.], [0, -1], prob)
+    assert 'prob must have shape' in str(e.value)
+
+
+def test_EfficiencyTable_files(tmpdir):
+    '''Read text file, write a cache, and read the cache again.'''
+    txt = str(tmpdir.join('eff.dat'))
+    with open(txt, 'w') as f:
+        f.write('1. 0. .2 .5\n.5 0.1 .2 .5\n.5 0. .1 .5\n1. 0.1 .3 .5\n')
+    eff = EfficiencyTable.from_file(txt, [0, -1])
+    assert np.all(eff.energy == [.5, 1.])
+    assert np.all(eff.blaze == [0., .1])
+    assert np.allclose(eff.prob[:, :, 0], [[.1, .2], [.2, .3]])
+    assert tmpdir.join('eff.dat.npz').check()
+    # Make sure cache is used and not the text file
+    with open(txt, 'w') as f:
+        f.write('garbage')
+    os.utime(txt, (0, 0))
+    eff2 = EfficiencyTable.from_file(txt, [0, -1])
+    assert np.all(eff2.prob == eff.prob)
+    # Cache in a directory of the user's choice
+    with open(txt, 'w') as f:
+        f.write('1. 0. .2 .5\n.5 0.1 .2 .5\n.5 0. .1 .5\n1. 0.1 .3 .5\n')
+    cachedir = str(tmpdir.join('cache'))
+    os.mkdir(cachedir)
+    eff3 = EfficiencyTable.from_file(txt, [0, -1], cache=cachedir)
+    assert np.all(eff3.prob == eff.prob)
+    assert len(os.listdir(cachedir)) == 1
+    # A cache with a different number of orders is not used, so the text file
+    # is read (and does not match).
+    os.utime(txt, (0, 0))
+    with pytest.raises(ValueError) as e:
+        EfficiencyTable.from_file(txt, [1], cache=cachedir)
+    assert 'orders has len=1' in str(e.value)
+
+    with pytest.raises(ValueError) as e:
+        EfficiencyTable.from_txt(StringIO(u'1. 0. .2 .5\n.5 0.1 .2 .5\n.5 0. .1 .5\n'), [0, -1])
+    assert 'regular energy x blaze' in str(e.value)
@@ -28,3 +28,31 @@ def test_noexplicettimedependence():
     photons = marxm.process_photons(photons)
     ks, p_value = ks_2samp(photons['mirror_shell'][:400], photons['mirror_shell'][600:])
     assert p_value > 1e-5
+
+
+def test_photon_attr_array():
+    '''The structured array is a view into the C structs.
+
+    This only needs the struct definitions, not the compiled MARX code.
+    '''
+    import os
+    import pytest
+    cffi = pytest.importorskip('cffi')
+    with open(os.path.join(os.path.dirname(marxs.optics.marx.__file__), 'cdef.txt')) as f:
+        cdeftxt = f.read()
+    ffi = cffi.FFI()
+    ffi.cdef(cdeftxt)
+    cp = ffi.new('Marx_Photon_Attr_Type[]', 3)
+    attr = marxs.optics.marx.photon_attr_array(ffi, cp, 3)
+    attr['x'] = np.arange(9).reshape((3, 3))
+    attr['tag'] = [5, 6, 7]
+    assert cp[1].x.y == 4.
+    assert cp[2].tag == 7
+    cp[0].energy = 1.5
+    cp[2].flags = 0x12
+    cp[2].mirror_shell = 3
+    cp[1].p.z = -1
+    assert attr['energy'][0] == 1.5
+    assert attr['flags'][2] == 0x12
+    assert attr['mirror_shell'][2] == 3
+    assert attr['p'][1, 2] == -1
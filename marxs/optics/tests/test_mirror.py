@@ -1,6 +1,7 @@
 import numpy as np
 import pytest
 from ... import source, optics
+from ...utils import generate_test_photons
 
 
 @pytest.mark.parametrize("ra", [(0.,), (30.,), (-60.,)])
@@ -29,3 +30,36 @@ def test_PerfectLens(ra):
     photons = mdet.process_photons(photons)
     assert np.std(photons['det_x']) > 1e-4
     assert np.std(photons['det_y']) > 1e-4
+
+
+@pytest.mark.parametrize("direction", [-1., 1.])
+def test_ThinLens_focus(direction):
+    '''Rays parallel to the optical axis are focussed close to the focal point.
+
+    This holds for rays in either direction and a lens that is not at the origin.
+    '''
+    f = 100.
+    lens = optics.ThinLens(focallength=f, position=[10., 2., 0.], zoom=20)
+    photons = generate_test_photons(5)
+    photons['dir'] = [direction, 0, 0, 0]
+    photons['pos'][:, 0] = 10 - 5 * direction
+    photons['pos'][:, 1] = 2 + np.array([0, 0.1, 0.5, -1., -0.3])
+    photons['pos'][:, 2] = np.array([0, 0.1, 0.5, 0.2, 0.])
+    photons = lens(photons)
+    det = optics.FlatDetector(position=[10 + direction * f, 2., 0.], zoom=1e5)
+    photons = det(photons)
+    assert np.all(np.abs(photons['det_x']) < 1e-3)
+    assert np.all(np.abs(photons['det_y']) < 1e-3)
+
+
+def test_ThinLens_one_vs_many():
+    lens = optics.ThinLens(focallength=10., zoom=20)
+    photons = generate_test_photons(3)
+    photons['pos'][:, 1] = [0., 1., 2.]
+    single = lens.process_photon(np.asarray(photons['dir'][2]), np.asarray(photons['pos'][2]),
+                                 1., 0.)
+    photons = lens(photons)
+    assert np.allclose(photons['dir'][2], single[0])
+    assert np.allclose(photons['pos'][2], single[1])
+    # ray through center is not deflected
+    assert np.all(photons['dir'][0] == [-1, 0, 0, 0])
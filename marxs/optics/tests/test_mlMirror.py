@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 from astropy.table import Table
 from astropy.io import ascii
 from ..multiLayerMirror import MultiLayerMirror
@@ -29,7 +30,8 @@ def test_photon_reflection():
 	photons = mirror.process_photons(photons)
 	
 	# confirm reflection angle
-	expected_dir = np.array([[1., -1.5, 0., 0], [1., 1.5, 0., 0], [1., -0.5, 13., 0]])
+	# The third photon misses the mirror (z = 13 mm), so it is not reflected.
+	expected_dir = np.array([[1., -1.5, 0., 0], [1., 1.5, 0., 0], [-1., -0.5, 13., 0]])
 	assert np.allclose(np.array(photons['dir']), expected_dir)
 	
 	# confirm reflection probability
@@ -84,3 +86,33 @@ def test_photon_reflection():
 #	#expected_pol[1,0:3] = np.cross(photons['dir'][1,0:3] / np.linalg.norm(photons['dir'][1,0:3]), expected_pol[0,0:3])
 #	for i in range(0, 2):
 #		assert np.allclose(np.array(photons['polarization'][i]), expected_pol[i]) or np.allclose(np.array(photons['polarization'][i]), -expected_pol[i])
+
+
+def test_reflectivity_grid(monkeypatch):
+	'''Data files are read only once and the grid approximates the exact values.'''
+	mirror = MultiLayerMirror('./marxs/optics/data/testFile_mirror.txt', './marxs/optics/data/ALSpolarization2.txt')
+	gridmirror = MultiLayerMirror('./marxs/optics/data/testFile_mirror.txt', './marxs/optics/data/ALSpolarization2.txt',
+	                              refl_grid=(2001, np.linspace(0.15, 0.45, 301)))
+
+	def fail(*args, **kwargs):
+		raise AssertionError('Data file read again.')
+	monkeypatch.setattr(ascii, 'read', fail)
+
+	# The reflectivity peaks are very narrow, so compare on the grid points and
+	# check that the interpolation is linear in between.
+	energy = np.linspace(0.15, 0.45, 301)
+	y = np.linspace(-1, 1, 2001)[1000:1100]
+	for e in [0.2, 0.3, 0.31]:
+		exact = mirror.reflectivity(y, e * np.ones_like(y))
+		assert np.allclose(gridmirror.reflectivity(y, e * np.ones_like(y)), exact)
+	ymid = 0.5 * (y[1:] + y[:-1])
+	interp = gridmirror.reflectivity(ymid, 0.31 * np.ones_like(ymid))
+	assert np.allclose(interp, 0.5 * (exact[1:] + exact[:-1]))
+	assert np.any(exact > 0)
+
+
+def test_reflectivity_grid_too_small():
+	with pytest.raises(ValueError) as e:
+		MultiLayerMirror('./marxs/optics/data/testFile_mirror.txt', './marxs/optics/data/ALSpolarization2.txt',
+		                 refl_grid=(2001, [0.3]))
+	assert 'at least 2 grid points' in str(e.value)
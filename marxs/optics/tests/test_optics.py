@@ -12,6 +12,7 @@ import marxs.optics.base
 import marxs.optics.aperture
 import marxs.source
 import marxs.source.source
+import marxs.simulator
 from marxs.utils import generate_test_photons
 
 @pytest.fixture(autouse=True)
@@ -135,3 +136,61 @@ def test_FlatStack():
     assert np.allclose(p['probability'], [1, 1, .5, .5, .5])
     assert np.all(np.isnan(p['a'][:2]))
     assert np.allclose(p['a'][2:], [-1.9, -1., 0])
+
+
+class PerPhotonElement(marxs.optics.base.OpticalElement):
+    '''Element that implements only `process_photon`.'''
+    output_columns = ['myout']
+
+    def process_photon(self, dir, pos, energy, polarization):
+        return -dir, pos, 2 * energy, polarization, 0.5 + (energy > 1.5) * 0.1, energy + 1
+
+
+class VectorizedPerPhotonElement(PerPhotonElement):
+    process_photon_vectorized = True
+
+
+@pytest.mark.parametrize('elem', [PerPhotonElement, VectorizedPerPhotonElement])
+def test_process_photon_default(elem):
+    '''Default process_photons loops or calls process_photon once with arrays.'''
+    photons = generate_test_photons(5)
+    photons['energy'] = [1., 2., 1., 2., 1.]
+    dir = photons['dir'].copy()
+    photons = elem()(photons)
+    assert np.all(photons['dir'] == -dir)
+    assert np.all(photons['energy'] == [2., 4., 2., 4., 2.])
+    assert np.allclose(photons['probability'], [.5, .6, .5, .6, .5])
+    assert np.all(photons['myout'] == [2., 3., 2., 3., 2.])
+
+
+def test_derived_geometry_cache():
+    '''Derived geometry is cached and reset when pos4d is set or on request.'''
+    elem = marxs.optics.FlatDetector(position=[1., 2., 3.], zoom=[1., 2., 3.])
+    g = elem.derived_geometry
+    assert g is elem.derived_geometry
+    assert np.allclose(g['center'], [1., 2., 3.])
+    assert np.isclose(g['size_z'], 3.)
+    assert np.allclose(np.dot(elem.invpos4d, elem.pos4d), np.eye(4))
+    # change in place
+    elem.geometry['center'][:3] = [0., 0., 1.]
+    assert elem.derived_geometry is g
+    elem.reset_derived_geometry()
+    assert np.allclose(elem.derived_geometry['center'], [0., 0., 1.])
+    g = elem.derived_geometry
+    elem.pos4d = np.eye(4)
+    assert elem.derived_geometry is not g
+
+
+def test_invpos4d_cache():
+    '''invpos4d and the decomposition are cached and reset when pos4d is set.'''
+    elem = marxs.optics.FlatDetector(position=[1., 2., 3.], zoom=[1., 2., 3.])
+    inv = elem.invpos4d
+    assert inv is elem.invpos4d
+    assert np.allclose(inv, np.linalg.inv(elem.pos4d))
+    assert np.allclose(elem.pos4d_decomposed[0], [1., 2., 3.])
+    assert np.allclose(elem.pos4d_decomposed[2], [1., 2., 3.])
+    elem.pos4d = np.eye(4)
+    assert np.all(elem.invpos4d == np.eye(4))
+    assert np.allclose(elem.pos4d_decomposed[0], 0)
+    # Elements without position have no pos4d
+    assert not hasattr(marxs.simulator.Sequence(elements=[]), 'pos4d')
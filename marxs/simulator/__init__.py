@@ -1,4 +1,5 @@
 from .simulator import (SimulationSetupError,
                         BaseContainer, Sequence, Parallel,
-                        KeepCol,
+                        KeepCol, RussianRoulette,
                         )
+from .runner import ParallelRunner
@@ -0,0 +1,222 @@
+'''Store photon lists on disk between the elements of a `~marxs.simulator.Sequence`.
+
+Checkpoints are content-addressed: The file name is a hash of everything that
+determines the photon list at this point of the simulation, i.e. the input
+photon list, the state of the random number generator at the start of the
+simulation, and the configuration of all elements up to this point (see
+`fingerprint`). If any of these change, the hash changes and the checkpoint is
+not used. Old checkpoints are never deleted automatically.
+'''
+import functools
+import hashlib
+import numbers
+import os
+import re
+import sys
+import tempfile
+import types
+
+import numpy as np
+from astropy.table import Table, Column, MaskedColumn
+from astropy.extern import six
+
+from ..base import PhotonStore
+from ..base.photonstore import _column_attributes
+
+_address = re.compile('0x[0-9a-fA-F]{6,}')
+
+
+def _update(h, obj, memo):
+    '''Add the content of ``obj`` to the hash object ``h``.'''
+    if (obj is None) or isinstance(obj, (bool, numbers.Number, six.string_types, bytes)):
+        h.update(repr((type(obj).__name__, obj)).encode('utf-8'))
+        return
+    if id(obj) in memo:
+        # Object seen before (maybe a reference cycle).
+        h.update('ref{0}'.format(memo[id(obj)][0]).encode('utf-8'))
+        return
+    # Keep a reference, so that the id is not reused for a temporary object.
+    memo[id(obj)] = (len(memo), obj)
+    if isinstance(obj, np.ndarray):
+        h.update(repr(('ndarray', obj.dtype.str, obj.shape)).encode('utf-8'))
+        if obj.dtype.hasobject:
+            _update(h, obj.tolist(), memo)
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        h.update(type(obj).__name__.encode('utf-8'))
+        items = sorted(obj, key=repr) if isinstance(obj, (set, frozenset)) else obj
+        for item in items:
+            _update(h, item, memo)
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for k in sorted(obj, key=repr):
+            _update(h, k, memo)
+            _update(h, obj[k], memo)
+    elif isinstance(obj, (Table, PhotonStore)):
+        h.update(b'photons')
+        for n in obj.colnames:
+            _update(h, n, memo)
+            _update(h, np.asarray(obj[n]), memo)
+        _update(h, dict(obj.meta), memo)
+    elif isinstance(obj, type):
+        h.update('{0}.{1}'.format(obj.__module__, obj.__name__).encode('utf-8'))
+    elif isinstance(obj, types.ModuleType):
+        h.update(obj.__name__.encode('utf-8'))
+    elif isinstance(obj, types.MethodType):
+        _update(h, obj.__func__, memo)
+        _update(h, obj.__self__, memo)
+    elif isinstance(obj, types.FunctionType):
+        h.update('{0}.{1}'.format(obj.__module__, obj.__name__).encode('utf-8'))
+        _update(h, obj.__code__, memo)
+        _update(h, obj.__defaults__, memo)
+        _update(h, [c.cell_contents for c in (obj.__closure__ or [])], memo)
+    elif isinstance(obj, types.CodeType):
+        h.update(obj.co_code)
+        _update(h, obj.co_consts, memo)
+        _update(h, obj.co_names, memo)
+    elif isinstance(obj, functools.partial):
+        _update(h, (obj.func, obj.args, obj.keywords), memo)
+    elif hasattr(obj, '__dict__'):
+        cls = type(obj)
+        h.update('{0}.{1}'.format(cls.__module__, cls.__name__).encode('utf-8'))
+        ignore = set()
+        for c in cls.__mro__:
+            ignore.update(c.__dict__.get('_derived_attributes', ()))
+        _update(h, dict((k, v) for k, v in vars(obj).items() if k not in ignore), memo)
+    else:
+        # e.g. numpy ufuncs. Some objects (e.g. pointers to C structures)
+        # have no representation but their memory address. That changes from
+        # one session to the next, so use only the type of those objects.
+        r = repr(obj)
+        if _address.search(r):
+            r = type(obj).__name__
+        h.update(r.encode('utf-8'))
+
+
+def fingerprint(*objs):
+    '''Calculate a hash of the configuration of objects.
+
+    The hash is calculated recursively from the attributes of an object,
+    the items of lists and dicts, the content of numpy arrays, and the
+    code, default arguments and closure variables of functions. Attributes
+    that only cache values derived from other attributes are listed in the
+    ``_derived_attributes`` class attribute (see e.g.
+    `marxs.base.MarxsElement`) and are ignored.
+
+    This does not capture all state that an object can have. Global
+    variables that a function uses and data held outside of python
+    objects (e.g. C structures of `marxs.optics.MarxMirror` or the content
+    of files that an object reads only when it is called) are not part of the
+    hash.
+
+    Parameters
+    ----------
+    objs : objects
+        Objects that are hashed together.
+
+    Returns
+    -------
+    hash : string
+        Hexadecimal hash.
+    '''
+    h = hashlib.sha256()
+    memo = {}
+    for obj in objs:
+        _update(h, obj, memo)
+    return h.hexdigest()
+
+
+def rng_fingerprint():
+    '''Hash of the current state of the numpy random number generator.'''
+    return fingerprint(list(np.random.get_state()))
+
+
+def _replace(src, dst):
+    '''Rename ``src`` to ``dst``, overwriting ``dst`` if it exists.'''
+    if six.PY2:
+        # os.rename does not overwrite existing files on Windows.
+        if (sys.platform == 'win32') and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+    else:
+        os.replace(src, dst)
+
+
+def save_photons(filename, photons):
+    '''Save a photon list and the state of the random number generator to a file.
+
+    The file is a compressed numpy ``.npz`` file. Column values, masks, units,
+    descriptions, formats, and column meta are stored. It is written to a
+    temporary file first and then renamed, so that an interrupted simulation
+    never leaves an incomplete checkpoint.
+
+    Parameters
+    ----------
+    filename : string
+        Path and filename.
+    photons : `astropy.table.Table` or `marxs.base.PhotonStore`
+        Photon list.
+    '''
+    if isinstance(photons, PhotonStore):
+        # Column attributes are only accessible on the table columns.
+        photons = photons.to_table()
+    attrs = []
+    arrays = {'colnames': np.array(photons.colnames, dtype=object),
+              'meta': np.array([dict(photons.meta)], dtype=object)}
+    for i, n in enumerate(photons.colnames):
+        col = photons[n]
+        arrays['col{0}'.format(i)] = np.asarray(col)
+        if isinstance(col, np.ma.MaskedArray):
+            arrays['mask{0}'.format(i)] = np.ma.getmaskarray(col)
+        attr = dict((a, getattr(col, a, None)) for a in _column_attributes)
+        if attr['unit'] is not None:
+            attr['unit'] = attr['unit'].to_string()
+        if attr['meta'] is not None:
+            attr['meta'] = dict(attr['meta'])
+        attrs.append(attr)
+    arrays['attrs'] = np.array(attrs, dtype=object)
+    state = np.random.get_state()
+    arrays['rng'] = np.array([state[0]] + list(state[2:]), dtype=object)
+    arrays['rng_keys'] = state[1]
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        _replace(tmp, filename)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def load_photons(filename):
+    '''Load a photon list and restore the state of the random number generator.
+
+    Parameters
+    ----------
+    filename : string
+        Path and filename of a file written by `save_photons`.
+
+    Returns
+    -------
+    photons : `astropy.table.Table`
+        Photon list.
+    '''
+    with np.load(filename, allow_pickle=True) as f:
+        colnames = list(f['colnames'])
+        # Checkpoints written by earlier versions do not have column attributes.
+        attrs = f['attrs'] if 'attrs' in f.files else [{}] * len(colnames)
+        cols = []
+        for i, n in enumerate(colnames):
+            mask = 'mask{0}'.format(i)
+            if mask in f.files:
+                col = MaskedColumn(f['col{0}'.format(i)], mask=f[mask], name=n,
+                                   **attrs[i])
+            else:
+                col = Column(f['col{0}'.format(i)], name=n, **attrs[i])
+            cols.append(col)
+        photons = Table(cols, meta=f['meta'][0])
+        rng = list(f['rng'])
+        np.random.set_state((rng[0], f['rng_keys']) + tuple(rng[1:]))
+    return photons
@@ -0,0 +1,288 @@
+'''Spatial indices that route photons to the elements of a `Parallel` container.
+
+A `Parallel` container with many elements (e.g. the hundreds of facets of a
+grating array) would otherwise calculate the intersection of every photon with
+every element. The classes in this module preselect the photons that can
+possibly interact with each element, such that the exact (and more expensive)
+intersection calculation only needs to be done for a few candidates.
+'''
+import numpy as np
+
+from ..math.pluecker import h2e
+
+
+def element_bounding_box(elem):
+    '''Axis-aligned bounding box of an optical element.
+
+    Elements can provide their own bounding box with a method
+    ``bounding_box()`` that returns the box in global coordinates in the same
+    format as this function. Otherwise, a box can only be found for flat
+    elements (with ``geometry['shape'] == 'box'``, e.g.
+    `marxs.optics.FlatOpticalElement`): In their default position, those fit
+    into the cube :math:`[-1, 1]^3`. This cube is transformed with the ``pos4d``
+    matrix of the element, so the bounding box of the eight transformed corners
+    also contains the element after the transformation.
+
+    Parameters
+    ----------
+    elem : `marxs.optics.OpticalElement`
+        Any object.
+
+    Returns
+    -------
+    box : np.array of shape (2, 3) or ``None``
+        Minimum and maximum of the x, y, and z coordinates. ``None`` if the
+        extent of the element is not known (e.g. for a
+        `marxs.optics.CircularDetector`).
+    '''
+    if hasattr(elem, 'bounding_box'):
+        return np.asarray(elem.bounding_box(), dtype=float)
+    if not (hasattr(elem, 'pos4d') and
+            getattr(elem, 'geometry', {}).get('shape', None) == 'box'):
+        return None
+    corners = np.array([[x, y, z, 1.] for x in [-1., 1.] for y in [-1., 1.] for z in [-1., 1.]])
+    corners = h2e(np.einsum('ij,kj->ki', elem.pos4d, corners))
+    box = np.vstack([corners.min(axis=0), corners.max(axis=0)])
+    # Flat elements can have a bounding box of zero thickness.
+    # Pad it a little, so that round-off errors do not make us miss rays.
+    pad = 1e-9 * max(np.max(np.abs(box)), 1.)
+    box[0, :] -= pad
+    box[1, :] += pad
+    return box
+
+
+def line_box_intersect(e_dir, e_pos, box):
+    '''Test if lines pass through axis-aligned boxes.
+
+    This uses the "slab" method. Note that the test is done for the **line**
+    through ``e_pos`` in direction ``e_dir``, not just for the ray in forward
+    direction, matching the convention used in
+    `marxs.optics.FlatOpticalElement.intersect`.
+
+    Parameters
+    ----------
+    e_dir : np.array of shape (N, 3)
+        Euclidean direction of the lines.
+    e_pos : np.array of shape (N, 3)
+        Euclidean position of a point on each line.
+    box : np.array of shape (M, 2, 3) or (2, 3)
+        Minimum and maximum of the x, y, and z coordinates of each box.
+
+    Returns
+    -------
+    hit : boolean np.array of shape (N, M) or (N)
+        ``True`` if a line passes through a box.
+    '''
+    box = np.asanyarray(box)
+    single = box.ndim == 2
+    if single:
+        box = box[None, :, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        invdir = 1. / e_dir
+        t1 = (box[None, :, 0, :] - e_pos[:, None, :]) * invdir[:, None, :]
+        t2 = (box[None, :, 1, :] - e_pos[:, None, :]) * invdir[:, None, :]
+    # nan appears for lines in the plane of a slab (0 * inf).
+    # fmin / fmax ignore those and pick the other (infinite) value.
+    tnear = np.max(np.fmin(t1, t2), axis=2)
+    tfar = np.min(np.fmax(t1, t2), axis=2)
+    hit = tnear <= tfar
+    if single:
+        return hit[:, 0]
+    else:
+        return hit
+
+
+class ElementIndex(object):
+    '''Base class for spatial indices over a list of elements.
+
+    Parameters
+    ----------
+    elements : list
+        Elements of the `Parallel` container.
+    '''
+    def __init__(self, elements):
+        self.elements = list(elements)
+
+    def is_current(self, elements):
+        '''Check if the index was built for exactly this list of elements.
+
+        Parameters
+        ----------
+        elements : list
+            List of elements.
+        '''
+        return ((len(elements) == len(self.elements)) and
+                all(a is b for a, b in zip(elements, self.elements)))
+
+
+class BoundingBoxIndex(ElementIndex):
+    '''Two-level bounding box hierarchy for the elements of a `Parallel` container.
+
+    The elements are sorted along the axis where their centers are spread out the
+    most and then grouped into leaves of ``leafsize`` elements. Each photon is
+    first tested against the bounding box of each leaf and only those photons
+    that pass through a leaf box are tested against the individual element boxes
+    of that leaf. For M elements the number of tests is thus of order
+    :math:`N (M / leafsize + leafsize)` instead of :math:`N M`.
+
+    Only elements with a known bounding box (see `element_bounding_box`, e.g.
+    flat elements) are indexed. For all other elements (e.g. simple functions
+    or a `marxs.optics.CircularDetector`), all photons are candidates.
+
+    Parameters
+    ----------
+    elements : list
+        Elements of the `Parallel` container.
+    leafsize : int or ``None``
+        Number of elements per leaf. If ``None``, it is set to the square root
+        of the number of elements, which minimizes the number of tests.
+    '''
+    def __init__(self, elements, leafsize=None):
+        super(BoundingBoxIndex, self).__init__(elements)
+        boxes = [element_bounding_box(e) for e in self.elements]
+        self.indexed = np.array([b is not None for b in boxes], dtype=bool)
+        ind = self.indexed.nonzero()[0]
+        self.boxes = np.empty((len(self.elements), 2, 3))
+        self.boxes[:] = np.nan
+        for i in ind:
+            self.boxes[i] = boxes[i]
+
+        if leafsize is None:
+            leafsize = max(int(np.sqrt(len(ind))), 1)
+        self.leafsize = leafsize
+        if len(ind) > 0:
+            centers = self.boxes[ind].mean(axis=1)
+            axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+            ind = ind[np.argsort(centers[:, axis])]
+        self.leaves = [ind[i: i + leafsize] for i in range(0, len(ind), leafsize)]
+        self.leafboxes = np.array([[self.boxes[l, 0, :].min(axis=0),
+                                    self.boxes[l, 1, :].max(axis=0)]
+                                   for l in self.leaves]).reshape((-1, 2, 3))
+
+    def candidates(self, dir, pos):
+        '''Find photons that might interact with each element.
+
+        Parameters
+        ----------
+        dir : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of the direction of the ray
+        pos : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of a point on the ray
+
+        Returns
+        -------
+        candidates : list
+            One entry per element. The entry is an array of row indices for those
+            photons that pass through the bounding box of the element or ``None``
+            if the element is not indexed (in that case, every photon is a
+            candidate).
+        '''
+        e_dir = h2e(dir, 'dir')
+        e_pos = h2e(pos, 'pos')
+        out = [None if not i else np.zeros(0, dtype=int) for i in self.indexed]
+        if len(self.leaves) == 0:
+            return out
+        leafhit = line_box_intersect(e_dir, e_pos, self.leafboxes)
+        for leaf, hit in zip(self.leaves, leafhit.T):
+            rows = hit.nonzero()[0]
+            if len(rows) == 0:
+                continue
+            elemhit = line_box_intersect(e_dir[rows], e_pos[rows], self.boxes[leaf])
+            for i, h in zip(leaf, elemhit.T):
+                out[i] = rows[h]
+        return out
+
+
+class FlatElementBank(ElementIndex):
+    '''Vectorized intersection of rays with a bank of flat, rectangular elements.
+
+    The geometry of all elements (plane, center, unit vectors and half-sizes in
+    the local y and z direction) is stacked into arrays, so that the intersection
+    of N rays with all M elements can be calculated with a few numpy operations
+    instead of M calls to `marxs.optics.FlatOpticalElement.intersect`.
+    To limit the memory footprint, the rays are processed in chunks, such that
+    no temporary array has more than about ``chunksize`` elements.
+
+    Parameters
+    ----------
+    elements : list of `marxs.optics.FlatOpticalElement`
+        Elements of the `Parallel` container. All elements must have the default
+        box geometry.
+    chunksize : int
+        Maximum number of ray-element pairs processed in one step.
+    '''
+    def __init__(self, elements, chunksize=1000000):
+        super(FlatElementBank, self).__init__(elements)
+        for e in self.elements:
+            if not (hasattr(e, 'derived_geometry') and (e.geometry.get('shape', None) == 'box')
+                    and ('plane' in e.geometry)):
+                raise ValueError('{0} is not a flat optical element with box geometry.'.format(e))
+        self.chunksize = chunksize
+        derived = [e.derived_geometry for e in self.elements]
+        self.plane = np.array([e.geometry['plane'] for e in self.elements])
+        center = np.array([g['center'] for g in derived])
+        self.e_y = np.array([g['e_y'] for g in derived])
+        self.e_z = np.array([g['e_z'] for g in derived])
+        self.center_y = np.sum(center * self.e_y, axis=1)
+        self.center_z = np.sum(center * self.e_z, axis=1)
+        self.size_y = np.array([g['size_y'] for g in derived])
+        self.size_z = np.array([g['size_z'] for g in derived])
+
+    def intersect(self, dir, pos):
+        '''Find the first element that each ray hits.
+
+        Only intersections in the forward direction of the ray are considered and
+        if a ray passes through several elements, the one that is closest to
+        ``pos`` is chosen.
+
+        Parameters
+        ----------
+        dir : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of the direction of the ray
+        pos : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of a point on the ray
+
+        Returns
+        -------
+        index : integer np.array of length N
+            Index of the element hit by the ray; ``-1`` if the ray does not hit
+            any element.
+        interpos : `numpy.ndarray` of shape (N, 4)
+            homogeneous coordinates of the intersection point. Values are set
+            to ``np.nan`` if no intersection point is found.
+        interpos_local : `numpy.ndarray` of shape (N, 2)
+            y and z coordinates in the coordiante system of the active plane of
+            the element that was hit.
+        '''
+        e_dir = h2e(dir, 'dir')
+        e_pos = h2e(pos, 'pos')
+        n = e_dir.shape[0]
+        index = -np.ones(n, dtype=int)
+        interpos = np.empty((n, 4))
+        interpos[:, :3] = np.nan
+        interpos[:, 3] = 1.
+        intercoos = np.empty((n, 2))
+        intercoos[:] = np.nan
+
+        step = max(self.chunksize // max(len(self.elements), 1), 1)
+        for start in range(0, n, step):
+            d = e_dir[start: start + step]
+            p = e_pos[start: start + step]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = - (np.dot(p, self.plane[:, :3].T) + self.plane[:, 3]) / np.dot(d, self.plane[:, :3].T)
+            y = np.dot(p, self.e_y.T) - self.center_y + t * np.dot(d, self.e_y.T)
+            z = np.dot(p, self.e_z.T) - self.center_z + t * np.dot(d, self.e_z.T)
+            with np.errstate(invalid='ignore'):
+                hit = (np.abs(y) <= self.size_y) & (np.abs(z) <= self.size_z) & (t >= 0)
+            t[~hit] = np.inf
+            first = np.argmin(t, axis=1)
+            rows = np.arange(len(first))
+            found = hit[rows, first]
+            rows = rows[found]
+            first = first[found]
+            ind = start + rows
+            index[ind] = first
+            interpos[ind, :3] = p[rows] + t[rows, first][:, None] * d[rows]
+            intercoos[ind, 0] = y[rows, first]
+            intercoos[ind, 1] = z[rows, first]
+        return index, interpos, intercoos
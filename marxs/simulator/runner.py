@@ -0,0 +1,317 @@
+'''Run simulations on several CPU cores.
+
+Ray-tracing is embarrassingly parallel: Every photon is traced independently of
+all other photons. The `ParallelRunner` splits a photon list (or the exposure
+time of a source) into chunks, processes the chunks in separate processes, and
+merges the results in the original order.
+
+Most objects in marxs cannot be pickled (e.g. efficiency functions are often
+closures), so the `~marxs.simulator.Sequence` and the source are handed to the
+worker processes when the processes are started, which relies on the "fork"
+start method that is the default on Linux. Only photon lists are sent between
+the processes. On systems without "fork" (e.g. Windows) the chunks are
+processed one after the other in the current process.
+'''
+from collections import OrderedDict
+import hashlib
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+from astropy.table import vstack
+from astropy.utils.metadata import merge
+
+from ..base import SharedPhotonStore
+from .simulator import SimulationSetupError
+
+_worker = {}
+'''Simulation setup in worker processes. This is set in `_init_worker`.'''
+
+
+def _init_worker(setup):
+    _worker.update(setup)
+
+
+def _can_fork():
+    '''Check if worker processes can be started with the "fork" start method.'''
+    if hasattr(multiprocessing, 'get_all_start_methods'):
+        return 'fork' in multiprocessing.get_all_start_methods()
+    # Python 2 forks on all platforms except Windows.
+    return sys.platform != 'win32'
+
+
+def _call(args):
+    func, args = args
+    return func(*args)
+
+
+def _parallel_map(func, n_workers, setup, *iterables):
+    '''Call ``func`` for every set of arguments in ``iterables`` on several processes.
+
+    ``setup`` is a dict that is copied into `_worker` in every worker process.
+    It is passed on when the processes are forked, so its values do not need
+    to be picklable. If ``n_workers`` is 1 or if the operating system does not
+    support the "fork" start method (e.g. Windows), all calls are made in the
+    current process instead. In that case, the state of the numpy random
+    number generator and the content of `_worker` are restored afterwards,
+    so that the caller sees the same state as with worker processes.
+
+    Parameters
+    ----------
+    func : callable
+        Module level function (it is pickled by reference).
+    n_workers : int
+        Number of worker processes.
+    setup : dict
+        Objects that ``func`` can look up in `_worker`.
+    iterables :
+        One iterable per positional argument of ``func``.
+
+    Returns
+    -------
+    results : list
+        Return values of ``func`` in the order of the input.
+    '''
+    args = [(func, a) for a in zip(*iterables)]
+    if (n_workers > 1) and _can_fork():
+        if hasattr(multiprocessing, 'get_context'):
+            pool = multiprocessing.get_context('fork').Pool(n_workers, _init_worker, (setup, ))
+        else:
+            pool = multiprocessing.Pool(n_workers, _init_worker, (setup, ))
+        try:
+            return pool.map(_call, args, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+    # Run in this process, but leave the caller's state as it was: A forked
+    # worker has its own random number generator and its own `_worker`, and
+    # calls might be nested (e.g. a serial sweep inside a serial runner).
+    outer = _worker.copy()
+    state = np.random.get_state()
+    _init_worker(setup)
+    try:
+        return [_call(a) for a in args]
+    finally:
+        _worker.clear()
+        _worker.update(outer)
+        np.random.set_state(state)
+
+
+def _seed_state(entropy):
+    '''Turn a list of non-negative integers into a seed for `numpy.random.seed`.'''
+    if hasattr(np.random, 'SeedSequence'):
+        return np.random.SeedSequence(entropy).generate_state(4)
+    # numpy < 1.17
+    digest = hashlib.sha256(','.join(str(int(e)) for e in entropy).encode('ascii')).digest()
+    return np.frombuffer(digest, dtype=np.uint32)
+
+
+def _spawn_seeds(seed, n):
+    '''Make ``n`` independent seeds from one ``seed`` (``None`` draws from the OS).'''
+    if seed is None:
+        entropy = np.frombuffer(os.urandom(16), dtype=np.uint32).tolist()
+    else:
+        entropy = [seed]
+    return [_seed_state(entropy + [i]) for i in range(n)]
+
+
+def _seed(seed):
+    np.random.seed(seed)
+
+
+def _run_photons(photons, seed):
+    _seed(seed)
+    return _worker['sequence'](photons)
+
+
+def _process_shared(store, start, stop):
+    photons = store[start: stop]
+    shared = dict((n, photons[n]) for n in photons.colnames)
+    out = _worker['sequence'](photons)
+    if len(out) != stop - start:
+        raise SimulationSetupError('Simulations in shared memory require that the number of photons does not change.')
+    new = {}
+    for n in out.colnames:
+        if n in shared:
+            if out[n] is not shared[n]:
+                shared[n][:] = out[n]
+        else:
+            new[n] = np.asarray(out[n])
+    return new, out.meta
+
+
+def _run_shared(handle, start, stop, seed):
+    _seed(seed)
+    store = SharedPhotonStore.attach(handle)
+    try:
+        return _process_shared(store, start, stop)
+    finally:
+        store.close()
+
+
+def _run_source(tstart, length, exposuretime, seed):
+    _seed(seed)
+    photons = _worker['source']._generate_photons_window(tstart, length,
+                                                          exposuretime)
+    return _worker['sequence'](photons)
+
+
+class ParallelRunner(object):
+    '''Process photons with a `~marxs.simulator.Sequence` on several processes.
+
+    Every chunk of photons is processed with its own random number stream,
+    derived from ``seed``. For a fixed ``seed`` and a fixed number of chunks
+    the result is therefore bitwise reproducible, independent of the order in
+    which the worker processes finish their chunks and of the number of
+    processes.
+
+    Parameters
+    ----------
+    sequence : callable
+        Usually a `~marxs.simulator.Sequence`, but any callable that accepts
+        a photon list and returns the processed photon list works.
+    n_workers : int or ``None``
+        Number of worker processes. ``None`` uses the number of CPU cores.
+        For ``n_workers=1`` the simulation runs in the current process, which
+        can be useful for debugging. The same happens if worker processes
+        cannot be forked (e.g. on Windows).
+    seed : int or ``None``
+        Seed for the random number generator. If ``None``, fresh entropy is
+        drawn from the operating system and the result is not reproducible.
+
+    Examples
+    --------
+    >>> from marxs import source, optics
+    >>> from marxs.simulator import Sequence, ParallelRunner
+    >>> mysource = source.PointSource(coords=(30., 30.), energy=2., flux=1.)
+    >>> sky2mission = source.FixedPointing(coords=(30., 30.))
+    >>> aper = optics.RectangleAperture(position=[50., 0., 0.])
+    >>> ccd = optics.FlatDetector(pixsize=0.05)
+    >>> instrument = Sequence(elements=[sky2mission, aper, ccd])
+    >>> runner = ParallelRunner(instrument, n_workers=2, seed=42)
+    >>> photons = runner.run_source(mysource, 1000.)
+    >>> len(photons)
+    1000
+    '''
+    def __init__(self, sequence, n_workers=None, seed=None):
+        self.sequence = sequence
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.seed = seed
+
+    def _seeds(self, n):
+        return _spawn_seeds(self.seed, n)
+
+    def _map(self, func, source, *iterables):
+        return _parallel_map(func, self.n_workers,
+                             {'sequence': self.sequence, 'source': source},
+                             *iterables)
+
+    @staticmethod
+    def _merge(results, meta):
+        photons = vstack(results, metadata_conflicts='silent')
+        photons.meta.update(meta)
+        return photons
+
+    def run(self, photons, n_chunks=None):
+        '''Process a photon list.
+
+        Parameters
+        ----------
+        photons : `astropy.table.Table`
+            Input photon list.
+        n_chunks : int or ``None``
+            Number of chunks the photon list is split into. Defaults to the
+            number of workers.
+
+        Returns
+        -------
+        photons : `astropy.table.Table`
+            Processed photon list. The rows are in the same order as in the
+            input (unless the sequence itself drops or reorders photons).
+        '''
+        n_chunks = n_chunks or self.n_workers
+        n_chunks = max(min(n_chunks, len(photons)), 1)
+        bounds = np.linspace(0, len(photons), n_chunks + 1).astype(int)
+        chunks = [photons[bounds[i]: bounds[i + 1]] for i in range(n_chunks)]
+        results = self._map(_run_photons, None, chunks, self._seeds(n_chunks))
+        return self._merge(results, photons.meta)
+
+    def run_shared(self, photons, n_chunks=None, extra_columns={}):
+        '''Process a photon list that is held in shared memory.
+
+        Instead of sending photons to the worker processes and back,
+        the photon list is copied into shared memory once (see
+        `marxs.base.SharedPhotonStore`) and each worker processes a range
+        of rows in place. Only columns that are added by the sequence and not
+        listed in ``extra_columns`` are sent back to the main process.
+
+        The sequence must accept a `marxs.base.PhotonStore` as input and it
+        must not change the number of photons, e.g. this does not work with
+        `marxs.optics.MarxMirror`.
+
+        Parameters
+        ----------
+        photons : `astropy.table.Table` or `marxs.base.PhotonStore`
+            Input photon list.
+        n_chunks : int or ``None``
+            Number of chunks the photon list is split into. Defaults to the
+            number of workers.
+        extra_columns : dict
+            Columns that the sequence will add. Keys are column names and
+            values are the values the columns are initialized with.
+            Setting this avoids sending those columns from the worker processes
+            to the main process. The initial value should be the same that
+            the optical element uses when it adds the column (e.g. ``np.nan``
+            for most output columns and ``-1`` for the ``id_col`` of a
+            `~marxs.simulator.Parallel` element).
+
+        Returns
+        -------
+        photons : `astropy.table.Table`
+            Processed photon list.
+        '''
+        n_chunks = n_chunks or self.n_workers
+        n_chunks = max(min(n_chunks, len(photons)), 1)
+        bounds = np.linspace(0, len(photons), n_chunks + 1).astype(int)
+        with SharedPhotonStore.from_store(photons, extra_columns=extra_columns) as store:
+            results = self._map(_run_shared, None, [store.handle] * n_chunks,
+                                bounds[:-1], bounds[1:], self._seeds(n_chunks))
+            out = store.to_store()
+        for n in results[0][0]:
+            out[n] = np.concatenate([r[0][n] for r in results])
+        # Same as _merge: combine the meta of all chunks, input meta takes precedence.
+        meta = OrderedDict()
+        for r in results:
+            meta = merge(meta, r[1], metadata_conflicts='silent')
+        meta.update(out.meta)
+        out.meta = meta
+        return out.to_table()
+
+    def run_source(self, source, exposuretime, n_chunks=None):
+        '''Generate photons with ``source`` and process them.
+
+        The exposure time is split into ``n_chunks`` windows of equal length
+        and each worker generates and processes the photons for one window,
+        so the full photon list before processing never needs to be held in
+        memory or sent between processes.
+
+        Parameters
+        ----------
+        source : `marxs.source.Source`
+            Source of photons.
+        exposuretime : float
+            Total exposure time in seconds.
+        n_chunks : int or ``None``
+            Number of time windows. Defaults to the number of workers.
+
+        Returns
+        -------
+        photons : `astropy.table.Table`
+            Processed photon list, sorted by the time windows.
+        '''
+        n_chunks = n_chunks or self.n_workers
+        tstart = np.linspace(0, exposuretime, n_chunks + 1)
+        results = self._map(_run_source, source, tstart[:-1], np.diff(tstart),
+                            [exposuretime] * n_chunks, self._seeds(n_chunks))
+        return self._merge(results, {'EXPOSURE': (exposuretime, 'total exposure time [s]')})
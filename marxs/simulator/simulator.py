@@ -1,9 +1,15 @@
+import os
+
 import numpy as np
+from astropy.table import Table
+from astropy.extern import six
 from transforms3d.affines import decompose44
 
 from ..math.utils import translation2aff, zoom2aff, mat2aff
-from ..base import SimulationSequenceElement, _parse_position_keywords
+from ..base import SimulationSequenceElement, PhotonStore, _parse_position_keywords
 from ..math.pluecker import h2e
+from .index import BoundingBoxIndex, FlatElementBank
+from .checkpoint import fingerprint, rng_fingerprint, save_photons, load_photons
 
 
 class SimulationSetupError(Exception):
@@ -60,6 +66,50 @@ class Sequence(BaseContainer):
     postprocess_steps : list
         See ``preprocess_steps`` except that the steps are run *after* each sequence element
          (*default*: ``[]``).
+    photonstore : bool
+        If ``True``, an input `astropy.table.Table` is converted to a
+        `marxs.base.PhotonStore` before it is passed to the first element and
+        converted back to a `~astropy.table.Table` after the last element.
+        This avoids the overhead of the `~astropy.table.Table` class for
+        every element in the sequence, but all elements and
+        ``preprocess_steps`` / ``postprocess_steps`` need to work with the
+        reduced interface of `marxs.base.PhotonStore`
+        (*default*: ``False``).
+    compact : string or float
+        Policy to remove photons with ``probability == 0`` (e.g. photons that
+        hit a `~marxs.optics.Baffle`) after each element, so that later
+        elements do not spend time on them. Options are:
+
+        - ``'never'`` (*default*): Keep all photons.
+        - ``'always'``: Remove absorbed photons after every element.
+        - float between 0 and 1: Remove absorbed photons as soon as their
+          fraction in the photon list is larger than or equal to this number.
+
+        When photons are removed, the column `compact_index_col` is added to the
+        photon list. It holds the row index that each photon had in the input
+        photon list.
+    checkpoint_dir : string or ``None``
+        Directory for checkpoints (*default*: ``None``, which means that no
+        checkpoints are written). After the elements listed in
+        ``checkpoint_after`` the photon list and the state of the numpy random
+        number generator are written to a compressed ``.npz`` file in this
+        directory. The file name is a hash of the input photon list, the state
+        of the random number generator at the start, and the configuration
+        of all elements up to this point, as well as
+        ``preprocess_steps``, ``postprocess_steps`` and ``compact``
+        (see `marxs.simulator.checkpoint.fingerprint`). When the sequence is
+        run, it starts from the last checkpoint that matches and
+        restores the state of the random number generator, so the result is
+        the same as that of a run without checkpoints. Checkpoints are most
+        useful after expensive elements such as a `~marxs.optics.MarxMirror`
+        when only elements further down in the sequence change.
+        Changes that are not part of the hash (e.g. a new version of marxs or
+        a changed input file of an element) are not detected; in this case,
+        delete the checkpoint files.
+    checkpoint_after : list of int or ``None``
+        Indices (in ``elements``) of the elements after which a checkpoint
+        is written. ``None`` means after every element
+        (*default*: ``None``).
 
 
     Examples
@@ -95,10 +145,144 @@ class Sequence(BaseContainer):
     40 * 40 pixel detector).
     '''
 
+    compact_index_col = 'photon_index'
+    '''Name of the column that maps photons to rows in the input photon list.'''
+
     def __init__(self, **kwargs):
         self.elements = kwargs.pop('elements')
+        self.photonstore = kwargs.pop('photonstore', False)
+        self.compact = kwargs.pop('compact', 'never')
+        if isinstance(self.compact, six.string_types):
+            valid = self.compact in ['never', 'always']
+        else:
+            valid = 0 <= self.compact <= 1
+        if not valid:
+            raise ValueError("compact must be 'never', 'always' or a number between 0 and 1.")
+        self.checkpoint_dir = kwargs.pop('checkpoint_dir', None)
+        self.checkpoint_after = kwargs.pop('checkpoint_after', None)
         super(Sequence, self).__init__(**kwargs)
 
+    def compact_photons(self, photons):
+        '''Remove photons with zero probability according to the `compact` policy.
+
+        Parameters
+        ----------
+        photons : `astropy.table.Table` or `marxs.base.PhotonStore`
+            Photon list.
+
+        Returns
+        -------
+        photons : `astropy.table.Table` or `marxs.base.PhotonStore`
+            Photon list. If photons are removed, this is a new object.
+        '''
+        if (self.compact == 'never') or (len(photons) == 0):
+            return photons
+        alive = np.asarray(photons['probability']) > 0
+        n_dead = len(photons) - alive.sum()
+        threshold = 0 if self.compact == 'always' else self.compact
+        if (n_dead == 0) or (n_dead < threshold * len(photons)):
+            return photons
+        if self.compact_index_col not in photons.colnames:
+            photons[self.compact_index_col] = np.arange(len(photons))
+        return photons[alive]
+
+    def process_photons(self, photons):
+        if self.photonstore and isinstance(photons, Table):
+            photons = PhotonStore.from_table(photons)
+            photons = self._process_elements(photons)
+            return photons.to_table()
+        else:
+            return self._process_elements(photons)
+
+    def checkpoint_filenames(self, photons):
+        '''File names of the checkpoints for an input photon list.
+
+        Parameters
+        ----------
+        photons : `astropy.table.Table` or `marxs.base.PhotonStore`
+            Input photon list.
+
+        Returns
+        -------
+        filenames : dict
+            Keys are the indices of the elements after which a checkpoint is
+            written, values are the file names.
+        '''
+        if self.checkpoint_after is None:
+            steps = range(len(self.elements))
+        else:
+            steps = self.checkpoint_after
+        key = fingerprint(photons, rng_fingerprint())
+        filenames = {}
+        for i, elem in enumerate(self.elements):
+            key = fingerprint(key, elem, self.preprocess_steps,
+                              self.postprocess_steps, self.compact)
+            if i in steps:
+                filenames[i] = os.path.join(self.checkpoint_dir, key + '.npz')
+        return filenames
+
+    def _process_elements(self, photons):
+        start = 0
+        filenames = {}
+        if self.checkpoint_dir is not None:
+            filenames = self.checkpoint_filenames(photons)
+            for i in sorted(filenames, reverse=True):
+                if os.path.exists(filenames[i]):
+                    is_store = isinstance(photons, PhotonStore)
+                    photons = load_photons(filenames[i])
+                    if is_store:
+                        photons = PhotonStore.from_table(photons)
+                    start = i + 1
+                    break
+            if not os.path.exists(self.checkpoint_dir):
+                os.makedirs(self.checkpoint_dir)
+        for i in range(start, len(self.elements)):
+            for p in self.preprocess_steps:
+                p(photons)
+            photons = self.elements[i](photons)
+            for p in self.postprocess_steps:
+                p(photons)
+            photons = self.compact_photons(photons)
+            if i in filenames:
+                save_photons(filenames[i], photons)
+        return photons
+
+    def process_photons_chunked(self, chunks):
+        '''Process photons chunk by chunk.
+
+        This is a generator that processes one photon list at a time, such that
+        the memory needed does not depend on the total number of photons, but
+        only on the size of each chunk.
+
+        Parameters
+        ----------
+        chunks : iterable
+            Iterable (e.g. a list or a generator) of photon lists.
+
+        Returns
+        -------
+        processed : generator
+            Generator that yields the processed photon list for each chunk.
+
+        Examples
+        --------
+        >>> from marxs import source, optics
+        >>> from marxs.simulator import Sequence
+        >>> mysource = source.PointSource(coords=(30., 30.), energy=2., flux=1.)
+        >>> sky2mission = source.FixedPointing(coords=(30., 30.))
+        >>> aper = optics.RectangleAperture(position=[50., 0., 0.])
+        >>> ccd = optics.FlatDetector(pixsize=0.05)
+        >>> instrument = Sequence(elements=[sky2mission, aper, ccd])
+        >>> chunks = mysource.generate_photons_chunked(1e4, chunktime=1e3)
+        >>> n = 0
+        >>> for photons in instrument.process_photons_chunked(chunks):
+        ...     n += len(photons)
+        >>> n
+        10000
+        '''
+        for photons in chunks:
+            yield self(photons)
+
 
 class Parallel(BaseContainer):
     '''A container for several identical optical elements.
@@ -173,6 +357,29 @@ class Parallel(BaseContainer):
         Sub-classes of `Parallel` can implement a method `calculate_elempos` to
         determine the position of their elements automatically. In this case, they should set
         ``elem_pos=None``.
+    dispatch : string
+        Sets how photons are assigned to the elements (*default*: ``'all'``):
+
+        - ``'all'``: Every element processes the full photon list.
+        - ``'bbox'``: Build a `~marxs.simulator.index.BoundingBoxIndex` from the
+          bounding boxes of the elements and calculate the exact intersection point
+          only for those photons that pass through the bounding box of an element.
+          This is much faster for containers with many elements, but it only
+          accelerates elements that implement ``intersect`` and
+          ``specific_process_photons`` (see `~marxs.optics.FlatOpticalElement`); all
+          other elements still process the full photon list.
+          Candidates are selected based on the direction and position of the
+          photons when they enter the `Parallel` container, so a photon that is
+          redirected by one element will not be sent to another element that
+          it did not point to initially.
+        - ``'bank'``: Stack the geometry of all elements into a
+          `~marxs.simulator.index.FlatElementBank` and find the first element
+          that each photon hits in a single vectorized calculation. Each element
+          then processes only the photons that hit it, which removes the
+          per-element overhead for containers with many small elements.
+          All elements must be flat elements with the default box geometry that
+          implement ``specific_process_photons`` (e.g. gratings and flat
+          detectors).
 
     Examples
     --------
@@ -193,6 +400,8 @@ class Parallel(BaseContainer):
 
     id_col = 'element'
 
+    _derived_attributes = ('_elem_index', )
+
     uncertainty = np.eye(4)
     '''Uncertainty of pos4d.
 
@@ -205,6 +414,11 @@ class Parallel(BaseContainer):
     def __init__(self, **kwargs):
         self.pos4d = _parse_position_keywords(kwargs)
 
+        self.dispatch = kwargs.pop('dispatch', 'all')
+        if self.dispatch not in ['all', 'bbox', 'bank']:
+            raise ValueError('dispatch must be "all", "bbox", or "bank".')
+        self._elem_index = None
+
         self.elem_class = kwargs.pop('elem_class')
         # Need to operate on a copy here, to avoid changing elem_args of outer level
         self.elem_args = kwargs.pop('elem_args', {}).copy()
@@ -266,6 +480,7 @@ class Parallel(BaseContainer):
         '''
 
         self.elements = []
+        self._elem_index = None
 
         for i in range(len(self.elem_pos)):
             # _parse_position_keywords pops off keywords, thus operate on a copy here
@@ -308,6 +523,77 @@ class Parallel(BaseContainer):
                 f_pos4d = np.dot(m, f_pos4d)
             self.elements.append(self.elem_class(pos4d = f_pos4d, id_num=i, **specific_elem_args))
 
+    @property
+    def elem_index(self):
+        '''Spatial index of the elements used for ``dispatch='bbox'`` or ``'bank'``.
+
+        The index is built when it is first needed and it is rebuilt automatically
+        when the list of elements changes, e.g. after `generate_elements` was called
+        to apply new ``elem_pos`` or ``elem_uncertainty`` values.
+        '''
+        if (self._elem_index is None) or not self._elem_index.is_current(self.elements):
+            if self.dispatch == 'bank':
+                for e in self.elements:
+                    if not hasattr(e, 'specific_process_photons'):
+                        raise SimulationSetupError('{0} does not implement specific_process_photons and cannot be used with dispatch="bank".'.format(e))
+                self._elem_index = FlatElementBank(self.elements)
+            else:
+                self._elem_index = BoundingBoxIndex(self.elements)
+        return self._elem_index
+
+    def process_photons(self, photons):
+        if self.dispatch == 'all':
+            return super(Parallel, self).process_photons(photons)
+        elif self.dispatch == 'bank':
+            return self._process_photons_bank(photons)
+
+        n = len(photons)
+        candidates = self.elem_index.candidates(np.asarray(photons['dir']), np.asarray(photons['pos']))
+        # Elements only look at the rows where intersect is True, so these buffers
+        # can be allocated once and reused for all elements.
+        intersect = np.zeros(n, dtype=bool)
+        interpos = np.empty((n, 4))
+        intercoos = np.empty((n, 2))
+        for elem, cand in zip(self.elements, candidates):
+            for p in self.preprocess_steps:
+                p(photons)
+            if (cand is None) or not hasattr(elem, 'specific_process_photons'):
+                photons = elem(photons)
+            elif len(cand) > 0:
+                i, ipos, icoos = elem.intersect(np.asarray(photons['dir'])[cand],
+                                                np.asarray(photons['pos'])[cand])
+                intersect[cand] = i
+                interpos[cand] = ipos
+                intercoos[cand] = icoos
+                photons = elem.process_photons(photons, intersect=intersect,
+                                               interpos=interpos, intercoos=intercoos)
+                intersect[cand] = False
+            for p in self.postprocess_steps:
+                p(photons)
+        return photons
+
+    def _process_photons_bank(self, photons):
+        '''Process photons with the first-hit calculation of a `FlatElementBank`.'''
+        n = len(photons)
+        index, interpos, intercoos = self.elem_index.intersect(np.asarray(photons['dir']),
+                                                               np.asarray(photons['pos']))
+        # Sort once, so that the photons for each element are a contiguous slice
+        order = np.argsort(index, kind='mergesort')
+        bounds = np.searchsorted(index[order], np.arange(len(self.elements) + 1))
+        intersect = np.zeros(n, dtype=bool)
+        for i, elem in enumerate(self.elements):
+            for p in self.preprocess_steps:
+                p(photons)
+            rows = order[bounds[i]: bounds[i + 1]]
+            if len(rows) > 0:
+                intersect[rows] = True
+                photons = elem.process_photons(photons, intersect=intersect,
+                                               interpos=interpos, intercoos=intercoos)
+                intersect[rows] = False
+            for p in self.postprocess_steps:
+                p(photons)
+        return photons
+
 
 
 class KeepCol(object):
@@ -337,3 +623,55 @@ class KeepCol(object):
             raise KeyError('photon list has no column {0}.'.format(self.colname))
         else:
             self.data.append(photons[self.colname].copy())
+
+
+class RussianRoulette(object):
+    '''Terminate photons with low probability in an unbiased way.
+
+    After many optical elements, photons can carry a very small
+    ``probability``, but still cost as much to trace as photons with high
+    probability. `RussianRoulette` is meant to be used with the
+    ``postprocess_steps`` parameter of `Sequence`. Each photon with a
+    probability :math:`p` below ``threshold`` survives with a chance of
+    :math:`p / w`, where :math:`w` is the ``weight``; the probability of
+    surviving photons is set to :math:`w`, the probability of all others is
+    set to 0. The expectation value for the sum of the probabilities (e.g. the
+    effective area) does not change, but more photons have ``probability == 0``
+    and can be removed from the simulation (see the ``compact`` option of
+    `Sequence`).
+
+    Parameters
+    ----------
+    threshold : float
+        Photons with a probability below this threshold take part in the
+        roulette.
+    weight : float or ``None``
+        Probability assigned to the photons that survive. This must be larger
+        than or equal to ``threshold``. If ``None``, ``threshold`` is used.
+    colname : string
+        Name of the column that holds the photon probability.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from marxs.simulator import Sequence, RussianRoulette
+    >>> from marxs.optics import EnergyFilter, FlatDetector
+    >>> filt = EnergyFilter(filterfunc=lambda e: 0.01 * np.ones_like(e))
+    >>> det = FlatDetector()
+    >>> instrument = Sequence(elements=[filt, det], compact='always',
+    ...                       postprocess_steps=[RussianRoulette(0.1)])
+    '''
+    def __init__(self, threshold, weight=None, colname='probability'):
+        self.threshold = threshold
+        self.weight = threshold if weight is None else weight
+        if self.weight < self.threshold:
+            raise ValueError('weight must be larger than or equal to threshold.')
+        if self.weight <= 0:
+            raise ValueError('weight must be positive.')
+        self.colname = colname
+
+    def __call__(self, photons):
+        prob = np.asarray(photons[self.colname])
+        ind = (prob > 0) & (prob < self.threshold)
+        survive = np.random.uniform(size=ind.sum()) < (prob[ind] / self.weight)
+        photons[self.colname][ind] = np.where(survive, self.weight, 0.)
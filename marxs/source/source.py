@@ -111,6 +111,9 @@ class Source(SimulationSequenceElement):
           and must return an array of equal length that contains the polarization angles in
           radian.
     '''
+    _time_offset = 0.
+    '''Start time of the photon list. This is set by `generate_photons_chunked`.'''
+
     def __init__(self, **kwargs):
         self.energy = kwargs.pop('energy', 1.)
         self.flux = kwargs.pop('flux', 1.)
@@ -200,7 +203,7 @@ class Source(SimulationSequenceElement):
         photons : `astropy.table.Table`
             Table with photon properties.
         '''
-        times = self.generate_times(exposuretime)
+        times = self.generate_times(exposuretime) + self._time_offset
         energies = self.generate_energies(times)
         pol = self.generate_polarization(times, energies)
         n = len(times)
@@ -211,6 +214,55 @@ class Source(SimulationSequenceElement):
         #photons.meta['DATE-OBS'] =
         return photons
 
+    def generate_photons_chunked(self, exposuretime, chunktime):
+        '''Generate photons in chunks of limited size.
+
+        The exposure time is split into windows of length ``chunktime`` and
+        photons are generated for one window at a time with
+        `generate_photons`, such that the number of photons in memory at any
+        time does not depend on the total exposure time. All chunks together
+        are equivalent to one call of ``generate_photons(exposuretime)``,
+        except for the random numbers drawn: The photon times in each chunk
+        are shifted to the start of the window, and the ``EXPOSURE`` keyword
+        in the meta data is set to the total ``exposuretime``.
+
+        If `flux` is a number, ``chunktime`` should be an integer multiple of
+        ``1 / flux`` to keep the spacing between photons constant across
+        the boundaries of the windows.
+
+        Parameters
+        ----------
+        exposuretime : float
+            Total exposure time in seconds.
+        chunktime : float
+            Exposure time in seconds that is simulated in each chunk.
+
+        Returns
+        -------
+        chunks : generator
+            Generator that yields `astropy.table.Table` objects with photon
+            properties.
+
+        See also
+        --------
+        marxs.simulator.Sequence.process_photons_chunked
+        '''
+        if chunktime <= 0:
+            raise ValueError('chunktime must be positive.')
+        for tstart in np.arange(0, exposuretime, chunktime):
+            yield self._generate_photons_window(tstart, min(chunktime, exposuretime - tstart),
+                                                exposuretime)
+
+    def _generate_photons_window(self, tstart, length, exposuretime):
+        '''Generate photons for the time interval ``tstart`` to ``tstart + length``.'''
+        self._time_offset = tstart
+        try:
+            photons = self.generate_photons(length)
+        finally:
+            self._time_offset = 0.
+        photons.meta['EXPOSURE'] = (exposuretime, 'total exposure time [s]')
+        return photons
+
 
 class PointSource(Source):
     '''Astrophysical point source.
@@ -386,10 +438,10 @@ class FixedPointing(PointingModel):
         photons : astropy.table.Table
         '''
         photons = super(FixedPointing, self).process_photons(photons)
-        ra = np.deg2rad(photons['ra'].data)
-        dec = np.deg2rad(photons['dec'].data)
-        photons['dir'] = self.photons_dir(ra, dec, photons['time'].data)
-        photons['polarization'] = self.photons_pol(ra, dec, photons['time'].data, photons['polangle'].data)
+        ra = np.deg2rad(np.asarray(photons['ra']))
+        dec = np.deg2rad(np.asarray(photons['dec']))
+        photons['dir'] = self.photons_dir(ra, dec, np.asarray(photons['time']))
+        photons['polarization'] = self.photons_pol(ra, dec, np.asarray(photons['time']), np.asarray(photons['polangle']))
         photons.meta['RA_PNT'] = (self.ra, '[deg] Pointing RA')
         photons.meta['DEC_PNT'] = (self.dec, '[deg] Pointing Dec')
         photons.meta['ROLL_PNT'] = (self.roll, '[deg] Pointing Roll')
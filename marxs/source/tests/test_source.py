@@ -130,3 +130,22 @@ def test_poisson_process():
     times = p(100.)
     assert (len(times) > 1500) and (len(times) < 2500)
     assert (times[-1] > 99.) and (times[-1] < 100.)
+
+def test_chunked_generation():
+    '''Chunks together give the same photons as one large call.'''
+    s = Source(flux=2., energy=lambda t: t)
+    photons = s.generate_photons(10.)
+    chunks = list(s.generate_photons_chunked(10., chunktime=3.))
+    assert len(chunks) == 4
+    assert [len(c) for c in chunks] == [6, 6, 6, 2]
+    times = np.hstack([c['time'] for c in chunks])
+    assert np.allclose(times, photons['time'])
+    # energy function was called with the global times
+    assert np.allclose(np.hstack([c['energy'] for c in chunks]), times)
+    for c in chunks:
+        assert c.meta['EXPOSURE'][0] == 10.
+    # Offset is reset after the generator is done.
+    assert s.generate_photons(1.)['time'][0] == 0.
+
+    with pytest.raises(ValueError):
+        next(s.generate_photons_chunked(10., chunktime=0))
@@ -0,0 +1,122 @@
+import numpy as np
+from astropy.table import Table, Column
+import pytest
+
+from ..base import PhotonStore
+from ..base.photonstore import HAS_SHARED_MEMORY
+from .. import source, optics
+from ..simulator import Sequence
+
+
+def test_roundtrip_table():
+    '''Columns are views and conversion keeps data and meta.'''
+    tab = Table({'a': np.arange(5.), 'pos': np.ones((5, 4))})
+    tab.meta['EXPOSURE'] = (5., 'time')
+    tab['a'].unit = 'keV'
+    tab['a'].description = 'energy'
+    tab['a'].meta['origin'] = 'test'
+    store = PhotonStore.from_table(tab)
+    assert len(store) == 5
+    assert set(store.colnames) == set(['a', 'pos'])
+    store['a'][0] = 7
+    assert tab['a'][0] == 7
+    out = store.to_table()
+    assert isinstance(out, Table)
+    assert out.meta['EXPOSURE'][0] == 5.
+    assert np.all(out['pos'] == 1)
+    # Column attributes survive indexing, copies, and new values.
+    store = store[1:4].copy()
+    store['a'] = np.zeros(3)
+    store.rename_column('a', 'b')
+    out = store.to_table()
+    assert out['b'].unit == 'keV'
+    assert out['b'].description == 'energy'
+    assert out['b'].meta['origin'] == 'test'
+    assert out['pos'].unit is None
+
+
+def test_indexing():
+    store = PhotonStore({'a': np.arange(5), 'b': np.arange(10).reshape((5, 2))})
+    sub = store[store['a'] > 2]
+    assert isinstance(sub, PhotonStore)
+    assert len(sub) == 2
+    assert np.all(sub['b'] == [[6, 7], [8, 9]])
+    assert len(store[1:3]) == 2
+    assert len(store[::-2]) == 3
+    assert len(store[10:]) == 0
+    assert len(store[[0, 0, 1]]) == 3
+    row = store[4]
+    assert row['a'] == 4
+    rows = list(store)
+    assert len(rows) == 5
+    assert rows[2]['a'] == 2
+
+
+def test_setting_columns():
+    store = PhotonStore({'a': np.arange(5.)})
+    store['b'] = 3.
+    assert np.all(store['b'] == 3.)
+    store['c'] = [1., 2., 3.]
+    assert store['c'].shape == (5, 3)
+    store.add_column(Column(name='d', data=np.zeros(5)))
+    assert 'd' in store
+    with pytest.raises(ValueError):
+        store.add_column(np.zeros(5), name='a')
+    # in-place operators do not break the column
+    a = store['a']
+    store['a'] *= 2
+    assert store['a'] is a
+    assert store['a'][1] == 2.
+    store.rename_column('d', 'e')
+    assert store.colnames == ['a', 'b', 'c', 'e']
+    store.remove_column('e')
+    assert 'e' not in store
+    c = store.copy()
+    c['a'][0] = 100
+    assert store['a'][0] == 0
+
+
+def test_sequence_photonstore():
+    '''A simulation gives the same result with and without PhotonStore.'''
+    mysource = source.PointSource(coords=(30., 30.), flux=1e-3, energy=2.)
+    sky2mission = source.FixedPointing(coords=(30., 30.))
+    aper = optics.RectangleAperture(position=[50., 0., 0.])
+    mirr = optics.ThinLens(focallength=10, position=[10., 0., 0.])
+    ccd = optics.FlatDetector(pixsize=0.05)
+    photons = mysource.generate_photons(100)
+    photons['energy'].unit = 'keV'
+    photons['energy'].description = 'photon energy'
+    np.random.seed(0)
+    p1 = Sequence(elements=[sky2mission, aper, mirr, ccd])(photons.copy())
+    np.random.seed(0)
+    p2 = Sequence(elements=[sky2mission, aper, mirr, ccd],
+                  photonstore=True)(photons.copy())
+    assert isinstance(p2, Table)
+    assert p1.colnames == p2.colnames
+    for c in p1.colnames:
+        assert np.allclose(p1[c], p2[c], equal_nan=True)
+    assert p2['energy'].unit == 'keV'
+    assert p2['energy'].description == 'photon energy'
+    assert p2.meta['RA_PNT'] == p1.meta['RA_PNT']
+
+
+@pytest.mark.skipif(not HAS_SHARED_MEMORY, reason='requires multiprocessing.shared_memory (Python 3.8+)')
+def test_sharedstore():
+    from ..base import SharedPhotonStore
+    photons = PhotonStore({'a': np.arange(5.), 'pos': np.ones((5, 4))})
+    with SharedPhotonStore.from_store(photons, extra_columns={'b': -1}) as shared:
+        assert shared.colnames == ['a', 'pos', 'b']
+        assert np.all(shared['b'] == -1)
+        other = SharedPhotonStore.attach(shared.handle)
+        other['pos'][1:3, 2] = 5.
+        sub = other[3:]
+        sub['a'][:] = 10
+        del sub
+        other.close()
+        assert np.all(shared['pos'][:, 2] == [1, 5, 5, 1, 1])
+        assert np.all(shared['a'] == [0, 1, 2, 10, 10])
+        local = shared.to_store()
+    assert isinstance(local, PhotonStore)
+    assert np.all(local['a'] == [0, 1, 2, 10, 10])
+    # Input was copied, not modified.
+    assert np.all(photons['a'] == np.arange(5.))
@@ -1,9 +1,15 @@
 import numpy as np
-from astropy.table import Table
+from astropy.table import Table, Column
 import pytest
 
-from ..simulator import Sequence, SimulationSetupError, Parallel, KeepCol
-from ..optics import ThinLens, FlatGrating, uniform_efficiency_factory
+from ..simulator import Sequence, SimulationSetupError, Parallel, KeepCol, RussianRoulette
+from ..simulator.index import FlatElementBank
+from ..simulator.checkpoint import fingerprint
+from ..base.photonstore import HAS_SHARED_MEMORY
+from ..optics import ThinLens, FlatGrating, FlatDetector, uniform_efficiency_factory
+from ..math.utils import translation2aff
+from ..math.pluecker import h2e
+from ..utils import generate_test_photons
 
 def test_pre_post_process():
     '''test pre-processing and post-processing in sequences'''
@@ -89,3 +95,301 @@ def test_keepcols():
     s = Sequence(elements=[double_a, double_a], preprocess_steps=[keeper])
     t = s(t)
     assert np.all(np.hstack(keeper.data) == [1, 2, 2, 4])
+
+def test_parallel_bbox_dispatch():
+    '''Bounding box index gives the same result as processing every element.'''
+    pos = {'position': [[0, -10.1, -10.1], [0, .1, -10.1], [0, -10.1, .1], [0, .1, .1]]}
+    det = Parallel(elem_class=FlatDetector, elem_args={'pixsize': 0.01, 'zoom': 5},
+                   elem_pos=pos, id_col='CCD_ID')
+    detbbox = Parallel(elem_class=FlatDetector, elem_args={'pixsize': 0.01, 'zoom': 5},
+                       elem_pos=pos, id_col='CCD_ID', dispatch='bbox')
+
+    photons = generate_test_photons(1000)
+    photons['pos'][:, 1:3] = np.random.uniform(-25, 25, size=(1000, 2))
+    photons['dir'][:, 1:3] = np.random.uniform(-.1, .1, size=(1000, 2))
+    p1 = det(photons.copy())
+    p2 = detbbox(photons.copy())
+    for col in ['CCD_ID', 'det_x', 'det_y', 'pos']:
+        assert np.allclose(p1[col], p2[col], equal_nan=True)
+    # Some photons miss all CCDs, others hit
+    assert np.any(p2['CCD_ID'] < 0)
+    assert np.all(np.in1d([0, 1, 2, 3], p2['CCD_ID']))
+
+def test_parallel_bbox_index_regenerated():
+    '''The index is rebuilt when the elements change.'''
+    det = Parallel(elem_class=FlatDetector, elem_args={'zoom': 5},
+                   elem_pos={'position': [[0, -10.1, -10.1], [0, .1, .1]]},
+                   dispatch='bbox')
+    index = det.elem_index
+    assert det.elem_index is index
+    det.elem_uncertainty = [np.eye(4), translation2aff([0, 20, 20])]
+    det.generate_elements()
+    assert det.elem_index is not index
+    assert det.elem_index.boxes[1, 0, 1] > 15
+
+def test_bbox_index_elements():
+    '''Only elements with a known extent are indexed.'''
+    from ..optics import CircularDetector
+    from ..simulator.index import BoundingBoxIndex
+
+    class Boxed(object):
+        def bounding_box(self):
+            return [[0, 0, 0], [1, 2, 3]]
+
+    index = BoundingBoxIndex([FlatDetector(zoom=2), CircularDetector(), h2e, Boxed()])
+    assert list(index.indexed) == [True, False, False, True]
+    assert np.allclose(index.boxes[0], [[-2, -2, -2], [2, 2, 2]])
+    assert np.allclose(index.boxes[3], [[0, 0, 0], [1, 2, 3]])
+
+
+def test_parallel_bank_dispatch():
+    '''Vectorized first-hit calculation gives the same result as processing every element.'''
+    pos = {'position': [[0, -10.1, -10.1], [0, .1, -10.1], [0, -10.1, .1], [0, .1, .1]]}
+    det = Parallel(elem_class=FlatDetector, elem_args={'pixsize': 0.01, 'zoom': 5},
+                   elem_pos=pos, id_col='CCD_ID')
+    detbank = Parallel(elem_class=FlatDetector, elem_args={'pixsize': 0.01, 'zoom': 5},
+                       elem_pos=pos, id_col='CCD_ID', dispatch='bank')
+    detbank.elem_index.chunksize = 50
+
+    photons = generate_test_photons(1000)
+    photons['pos'][:, 1:3] = np.random.uniform(-25, 25, size=(1000, 2))
+    photons['dir'][:, 1:3] = np.random.uniform(-.1, .1, size=(1000, 2))
+    p1 = det(photons.copy())
+    p2 = detbank(photons.copy())
+    for col in ['CCD_ID', 'det_x', 'det_y']:
+        assert np.allclose(p1[col], p2[col], equal_nan=True)
+    assert np.allclose(h2e(p1['pos']), h2e(p2['pos']))
+
+def test_bank_first_hit():
+    '''If a ray passes through several elements, the first one is hit.'''
+    bank = FlatElementBank([FlatDetector(position=[x, 0, 0]) for x in [-3, -1, 2]])
+    photons = generate_test_photons(2)
+    photons['pos'][1, :] = [-2, 0, 0, 1]
+    index, interpos, intercoos = bank.intersect(photons['dir'].data, photons['pos'].data)
+    assert np.all(index == [1, 0])
+    assert np.allclose(interpos[:, 0], [-1, -3])
+    assert np.allclose(intercoos, 0)
+
+    with pytest.raises(ValueError) as e:
+        bank = FlatElementBank([ThinLens(focallength=1), set])
+    assert 'is not a flat optical element' in str(e.value)
+
+def test_sequence_chunked():
+    '''Chunked processing gives one output per chunk.'''
+    def set_energy2(photons):
+        photons['energy'] = 2
+        return photons
+
+    s = Sequence(elements=[set_energy2])
+    chunks = (Table({'energy': np.ones(5) * i}) for i in range(3))
+    out = list(s.process_photons_chunked(chunks))
+    assert len(out) == 3
+    for o in out:
+        assert np.all(o['energy'] == 2)
+
+def test_parallelrunner_reproducible():
+    '''Same seed and number of chunks give identical results.'''
+    from ..simulator import ParallelRunner
+
+    def randomize(photons):
+        photons['energy'] = np.random.uniform(size=len(photons))
+        return photons
+
+    s = Sequence(elements=[randomize])
+    photons = Table({'energy': np.ones(100), 'id': np.arange(100)})
+    photons.meta['EXPOSURE'] = (100., 's')
+    p1 = ParallelRunner(s, n_workers=3, seed=5).run(photons.copy(), n_chunks=4)
+    np.random.seed(0)
+    p2 = ParallelRunner(s, n_workers=1, seed=5).run(photons.copy(), n_chunks=4)
+    # A serial run does not change the random state of the caller
+    r = np.random.rand()
+    np.random.seed(0)
+    assert np.random.rand() == r
+    p3 = ParallelRunner(s, n_workers=2, seed=6).run(photons.copy(), n_chunks=4)
+    assert np.all(p1['id'] == np.arange(100))
+    assert np.all(p1['energy'] == p2['energy'])
+    assert not np.all(p1['energy'] == p3['energy'])
+    assert p1.meta['EXPOSURE'][0] == 100.
+
+
+def test_parallelrunner_source():
+    from ..simulator import ParallelRunner
+    from ..source import Source
+
+    def randomize(photons):
+        photons['energy'] = np.random.uniform(size=len(photons))
+        return photons
+
+    s = Sequence(elements=[randomize])
+    runner = ParallelRunner(s, n_workers=2, seed=1)
+    p = runner.run_source(Source(flux=10.), 10., n_chunks=5)
+    assert len(p) == 100
+    assert np.allclose(p['time'], np.arange(0, 10, .1))
+    assert p.meta['EXPOSURE'][0] == 10.
+    assert np.all(p['energy'] == runner.run_source(Source(flux=10.), 10., n_chunks=5)['energy'])
+
+
+@pytest.mark.skipif(not HAS_SHARED_MEMORY, reason='requires multiprocessing.shared_memory (Python 3.8+)')
+def test_parallelrunner_shared():
+    '''Shared memory runner gives the same result as the pickling runner.'''
+    from ..simulator import ParallelRunner
+
+    def randomize(photons):
+        photons['energy'][:] = np.random.uniform(size=len(photons))
+        photons['newcol'] = photons['energy'] * 2
+        photons['probability'] = 0.5
+        photons['det_x'][:] = 3.
+        photons.meta['NPHOT'] = [len(photons)]
+        return photons
+
+    s = Sequence(elements=[randomize])
+    photons = Table({'energy': np.ones(100), 'probability': np.ones(100)})
+    photons.meta['EXPOSURE'] = (100., 's')
+    p1 = ParallelRunner(s, n_workers=2, seed=5).run_shared(photons, n_chunks=4,
+                                                           extra_columns={'det_x': np.nan})
+    p2 = ParallelRunner(s, n_workers=1, seed=5).run_shared(photons, n_chunks=4,
+                                                           extra_columns={'det_x': np.nan})
+    # input is not modified
+    assert np.all(photons['energy'] == 1)
+    assert np.all(p1['energy'] == p2['energy'])
+    assert np.all(p1['energy'] != 1)
+    assert np.allclose(p1['newcol'], 2 * p1['energy'])
+    assert np.all(p1['probability'] == 0.5)
+    assert np.all(p1['det_x'] == 3.)
+    assert p1.meta['EXPOSURE'][0] == 100.
+    # meta of all chunks is merged
+    assert p1.meta['NPHOT'] == [25] * 4
+
+
+@pytest.mark.skipif(not HAS_SHARED_MEMORY, reason='requires multiprocessing.shared_memory (Python 3.8+)')
+def test_parallelrunner_shared_rowcount():
+    from ..simulator import ParallelRunner
+
+    s = Sequence(elements=[lambda photons: photons[:2]])
+    photons = Table({'energy': np.ones(10)})
+    with pytest.raises(SimulationSetupError):
+        ParallelRunner(s, n_workers=1).run_shared(photons)
+
+
+def test_sequence_compact():
+    '''Test the different policies to remove absorbed photons.'''
+    def kill_first(photons):
+        photons['probability'][:2] = 0
+        return photons
+
+    def kill_none(photons):
+        return photons
+
+    def kill_third_fourth(photons):
+        photons['probability'][(photons['energy'] == 2) | (photons['energy'] == 3)] = 0
+        return photons
+
+    photons = Table({'probability': np.ones(10), 'energy': np.arange(10)})
+    out = Sequence(elements=[kill_first, kill_none])(photons.copy())
+    assert len(out) == 10
+    assert 'photon_index' not in out.colnames
+
+    out = Sequence(elements=[kill_first, kill_first], compact='always')(photons.copy())
+    assert len(out) == 6
+    assert np.all(out['photon_index'] == [4, 5, 6, 7, 8, 9])
+    assert np.all(out['energy'] == out['photon_index'])
+
+    out = Sequence(elements=[kill_first, kill_none], compact=0.3)(photons.copy())
+    assert len(out) == 10
+    out = Sequence(elements=[kill_first, kill_third_fourth], compact=0.3)(photons.copy())
+    assert len(out) == 6
+    assert np.all(out['photon_index'] == [4, 5, 6, 7, 8, 9])
+
+    with pytest.raises(ValueError) as e:
+        Sequence(elements=[], compact='sometimes')
+    assert 'compact must be' in str(e.value)
+
+
+def test_russianroulette():
+    '''Roulette keeps the expectation value of the summed probability.'''
+    np.random.seed(0)
+    prob = np.hstack([np.ones(10), np.zeros(10), 0.01 * np.ones(100000)])
+    photons = Table({'probability': prob.copy()})
+    rr = RussianRoulette(0.1, weight=0.2)
+    rr(photons)
+    p = photons['probability']
+    assert np.all(p[:10] == 1)
+    assert np.all(p[10:20] == 0)
+    assert set(p[20:]) == set([0., 0.2])
+    assert np.isclose(p.sum(), prob.sum(), rtol=0.02)
+    # about 95 % of the low-probability photons are terminated
+    assert np.isclose((p[20:] == 0).mean(), 0.95, atol=0.01)
+
+    with pytest.raises(ValueError):
+        RussianRoulette(0.1, weight=0.05)
+
+
+calls = []
+
+
+def add_noise(photons):
+    calls.append('noise')
+    photons['energy'] = photons['energy'] + np.random.rand(len(photons))
+    return photons
+
+
+def test_checkpoints(tmpdir):
+    '''Upstream elements are skipped if a checkpoint exists and the result is
+    the same as without checkpoints.'''
+    del calls[:]
+    lens = ThinLens(focallength=10., zoom=20)
+    det = FlatDetector(position=[-10., 0., 0.], zoom=1e3)
+    photons = generate_test_photons(100)
+    photons['pos'][:, 1] = np.linspace(-5, 5, 100)
+    photons.meta['EXPOSURE'] = (1., 'exposure time')
+    # Column that no element replaces, so its attributes are the same with and
+    # without checkpoints, independent of the astropy version.
+    photons['time'] = Column(np.arange(100.), unit='s', description='arrival time')
+
+    np.random.seed(0)
+    expected = Sequence(elements=[add_noise, lens, add_noise, det])(photons.copy())
+    next_random = np.random.rand()
+    seq = Sequence(elements=[add_noise, lens, add_noise, det],
+                   checkpoint_dir=str(tmpdir.join('cache')), checkpoint_after=[1])
+    for photonstore, n_calls in [(False, 2), (True, 1), (False, 1)]:
+        del calls[:]
+        seq.photonstore = photonstore
+        np.random.seed(0)
+        out = seq(photons.copy())
+        assert len(calls) == n_calls
+        for n in expected.colnames:
+            assert np.all(out[n] == expected[n])
+        assert out['time'].unit == 's'
+        assert out['time'].description == 'arrival time'
+        assert out.meta['EXPOSURE'] == expected.meta['EXPOSURE']
+        # The state of the random number generator is restored from the checkpoint
+        assert np.random.rand() == next_random
+    assert len(tmpdir.join('cache').listdir()) == 1
+
+    # Different state of the random number generator -> new simulation
+    del calls[:]
+    np.random.seed(1)
+    out = seq(photons.copy())
+    assert calls == ['noise', 'noise']
+    assert not np.all(out['energy'] == expected['energy'])
+    # Changed configuration of upstream element -> new simulation
+    del calls[:]
+    np.random.seed(0)
+    lens.focallength = 11.
+    out = seq(photons.copy())
+    assert calls == ['noise', 'noise']
+    assert len(tmpdir.join('cache').listdir()) == 3
+
+
+def test_fingerprint():
+    '''Configuration is compared, cached values are not.'''
+    det1 = FlatDetector(position=[1., 2., 3.], pixsize=0.1)
+    det2 = FlatDetector(position=[1., 2., 3.], pixsize=0.1)
+    assert fingerprint(det1) == fingerprint(det2)
+    det1(generate_test_photons(2))
+    det1.invpos4d
+    assert fingerprint(det1) == fingerprint(det2)
+    det2.pixsize = 0.2
+    assert fingerprint(det1) != fingerprint(det2)
+    assert fingerprint(uniform_efficiency_factory(2)) == fingerprint(uniform_efficiency_factory(2))
+    assert fingerprint(uniform_efficiency_factory(2)) != fingerprint(uniform_efficiency_factory(3))